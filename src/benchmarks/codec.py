@@ -0,0 +1,98 @@
+"""Compare the text/JSON wire format with the binary codec.
+
+Run from the src directory with `python -m benchmarks.codec`.
+"""
+
+import argparse
+import timeit
+from datetime import datetime
+
+from communic8.model.messages import *
+from communic8.protocol.codec import text_codec, binary_codec
+
+
+MESSAGES = [
+    Connect(('pipeline', 'binary')),
+    Login('some_user_name'),
+    ListUsers(),
+    RequestChat('another_user'),
+    SendChat('the quick brown fox jumps over the lazy dog ' * 3),
+    RequestFileTransfer('report.pdf', 'application/pdf',
+                        datetime(2014, 10, 1, 12, 30), 1048576L, 512),
+]
+
+RESPONSE = {
+    'state': 'logged_in',
+    'user': {'name': 'some_user_name', 'host': '192.168.10.20',
+             'port': 51234, 'connected_at': '2014-10-01T12:30:00.000000'}
+}
+
+
+def round_trip_message(codec, dispatcher, message):
+    frame = codec.encode_message(message, 42)
+    if codec.framed:
+        frames, _ = codec.split_frames(frame)
+        frame = frames[0]
+    else:
+        frame = frame[:-2]
+
+    _, request_id, body = codec.split_frame(frame)
+    return codec.decode_message(body, dispatcher)
+
+
+def round_trip_response(codec):
+    frame = codec.encode_response(RESPONSE, 42)
+    if codec.framed:
+        frames, _ = codec.split_frames(frame)
+        frame = frames[0]
+    else:
+        frame = frame[:-2]
+
+    _, request_id, body = codec.split_frame(frame)
+    return codec.decode_response(body)
+
+
+def measure(f, number, repeat):
+    return min(timeit.repeat(f, number=number, repeat=repeat)) / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--number', type=int, default=20000)
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    dispatcher = MessageDispatcher().register(
+        *set(type(m) for m in MESSAGES))
+
+    row = '{0:<24} {1:>10} {2:>10} {3:>8} {4:>8}'
+    print row.format('message', 'text us', 'binary us', 'text B',
+                     'binary B')
+
+    for message in MESSAGES:
+        results = []
+        for codec in (text_codec, binary_codec):
+            results.append(measure(
+                lambda: round_trip_message(codec, dispatcher, message),
+                args.number, args.repeat))
+
+        print row.format(
+            message.command,
+            '{0:.2f}'.format(results[0] * 1e6),
+            '{0:.2f}'.format(results[1] * 1e6),
+            len(text_codec.encode_message(message, 42)),
+            len(binary_codec.encode_message(message, 42)))
+
+    results = [measure(lambda: round_trip_response(codec), args.number,
+                       args.repeat)
+               for codec in (text_codec, binary_codec)]
+    print row.format(
+        'response',
+        '{0:.2f}'.format(results[0] * 1e6),
+        '{0:.2f}'.format(results[1] * 1e6),
+        len(text_codec.encode_response(RESPONSE, 42)),
+        len(binary_codec.encode_response(RESPONSE, 42)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+"""Transfer throughput with and without compression, over a mixed corpus.
+
+Generates `--size` MB each of prose, server logs, JSON records, random
+bytes and gzipped text, and sends every file over loopback TCP through a
+proxy limited to `--link` MB/s, as it is and compressed at each of the
+`--levels`. Compressed transfers are skipped for types that
+`is_compressible` rejects, as P2P transfers do. Throughput is measured
+until the receiver has decompressed every byte. Run from the src directory
+with `python -m benchmarks.compression`.
+"""
+
+import argparse
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import zlib
+from collections import deque
+
+from twisted.internet import defer, protocol, reactor, task
+
+from communic8.transfer.compression import CompressingSender, \
+    DecompressingConsumer, is_compressible
+from communic8.transfer.sender import ChunkedSender
+
+
+WORDS = ('the of and to in is was that for on are with as his they be at '
+         'one have this from or had by hot word but what some we can out '
+         'other were all there when up use your how said an each she which '
+         'transfer connection server client message request').split()
+
+
+def prose(rnd, size):
+    lines = []
+    total = 0
+    while total < size:
+        line = ' '.join(rnd.choice(WORDS) for _ in xrange(rnd.randint(8, 16)))
+        lines.append(line.capitalize() + '.\n')
+        total += len(lines[-1])
+
+    return ''.join(lines)
+
+
+def logs(rnd, size):
+    lines = []
+    total = 0
+    n = 0
+    while total < size:
+        n += 1
+        lines.append(
+            '2014-10-01T12:{0:02d}:{1:02d}.{2:06d} [{3}] 10.0.{4}.{5} '
+            '"{6} /{7}/{8} HTTP/1.1" {9} {10}\n'.format(
+                n // 3600 % 60, n // 60 % 60, rnd.randint(0, 999999),
+                rnd.choice(('INFO', 'INFO', 'INFO', 'WARN', 'ERROR')),
+                rnd.randint(0, 255), rnd.randint(0, 255),
+                rnd.choice(('GET', 'GET', 'POST')), rnd.choice(WORDS),
+                rnd.randint(1, 5000), rnd.choice((200, 200, 304, 404, 500)),
+                rnd.randint(100, 100000)))
+        total += len(lines[-1])
+
+    return ''.join(lines)
+
+
+def records(rnd, size):
+    lines = []
+    total = 0
+    while total < size:
+        lines.append(json.dumps({
+            'user': 'user{0}'.format(rnd.randint(0, 10000)),
+            'event': rnd.choice(('login', 'logout', 'chat', 'transfer')),
+            'bytes': rnd.randint(0, 1 << 30),
+            'tags': rnd.sample(WORDS, 3)}) + '\n')
+        total += len(lines[-1])
+
+    return ''.join(lines)
+
+
+def gzipped(rnd, size):
+    # Hex digits are about half entropy, so this compresses to about `size`
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    text = os.urandom(size).encode('hex')
+    return (compressor.compress(text) + compressor.flush())[:size]
+
+
+CORPUS = [
+    ('prose.txt', 'text/plain', prose),
+    ('access.log', 'text/plain', logs),
+    ('events.json', 'application/json', records),
+    ('random.bin', None, lambda rnd, size: os.urandom(size)),
+    ('logs.gz', 'application/gzip', gzipped),
+]
+
+
+class CountingConsumer(object):
+    offset = 0
+
+    def __init__(self, size):
+        self.size = size
+        self.received = 0
+        self.deferred = defer.Deferred()
+
+    def registerProducer(self, producer, streaming):
+        return self.deferred
+
+    def unregisterProducer(self):
+        pass
+
+    def finish(self):
+        pass
+
+    def write(self, data):
+        self.received += len(data)
+        if self.received >= self.size:
+            self.deferred.callback(time.time())
+
+
+class Receiver(protocol.Protocol):
+    def connectionMade(self):
+        factory = self.factory
+        self.consumer = CountingConsumer(factory.size)
+        if factory.compressed:
+            self.consumer = DecompressingConsumer(self.consumer)
+
+        self.consumer.registerProducer(self.transport, True).chainDeferred(
+            factory.done)
+
+    def dataReceived(self, data):
+        self.consumer.write(data)
+
+
+class ReceiverFactory(protocol.ServerFactory):
+    protocol = Receiver
+
+    def __init__(self, size, compressed):
+        self.size = size
+        self.compressed = compressed
+        self.done = defer.Deferred()
+
+
+class ThrottledPipe(protocol.Protocol):
+    """Forwards what it receives to `peer` at `rate` bytes per second"""
+
+    interval = 0.01
+
+    def connectionMade(self):
+        self.queue = deque()
+        self.queued = 0
+        self.paused = False
+        self.peer = None
+        self.call = task.LoopingCall(self.deliver)
+        self.call.start(self.interval, now=False)
+
+    def dataReceived(self, data):
+        self.queue.append(data)
+        self.queued += len(data)
+        if self.queued > self.factory.rate and not self.paused:
+            self.paused = True
+            self.transport.pauseProducing()
+
+    def deliver(self):
+        if self.peer is None:
+            return
+
+        budget = max(1, int(self.factory.rate * self.interval))
+        while self.queue and budget > 0:
+            data = self.queue.popleft()
+            if len(data) > budget:
+                self.queue.appendleft(data[budget:])
+                data = data[:budget]
+
+            budget -= len(data)
+            self.queued -= len(data)
+            self.peer.transport.write(data)
+
+        if self.paused and self.queued < self.factory.rate // 2:
+            self.paused = False
+            self.transport.resumeProducing()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        self.call.stop()
+        if self.peer is not None:
+            self.peer.transport.loseConnection()
+
+
+class ThrottlingProxy(protocol.ServerFactory):
+    protocol = ThrottledPipe
+
+    def __init__(self, port, rate):
+        self.port = port
+        self.rate = rate
+
+    def buildProtocol(self, addr):
+        incoming = protocol.ServerFactory.buildProtocol(self, addr)
+
+        def connected(outgoing):
+            incoming.peer = outgoing
+
+        protocol.ClientCreator(reactor, protocol.Protocol) \
+            .connectTCP('127.0.0.1', self.port).addCallback(connected)
+        return incoming
+
+
+@defer.inlineCallbacks
+def run(path, size, level, rate):
+    receiver = ReceiverFactory(size, level is not None)
+    port = reactor.listenTCP(0, receiver, interface='127.0.0.1')
+    proxy = None
+    target = port.getHost().port
+    if rate:
+        proxy = reactor.listenTCP(0, ThrottlingProxy(target, rate),
+                                  interface='127.0.0.1')
+        target = proxy.getHost().port
+
+    client = yield protocol.ClientCreator(reactor, protocol.Protocol) \
+        .connectTCP('127.0.0.1', target)
+
+    if level is None:
+        sender = ChunkedSender(open(path, 'rb'), 0, size)
+    else:
+        sender = CompressingSender(open(path, 'rb'), 0, size, level)
+
+    started_at = time.time()
+    sender.start(client.transport)
+    finished_at = yield receiver.done
+
+    client.transport.loseConnection()
+    yield port.stopListening()
+    if proxy is not None:
+        yield proxy.stopListening()
+
+    ratio = sender.ratio() if level is not None else 1.0
+    defer.returnValue((finished_at - started_at, ratio))
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--size', type=int, default=8,
+                        help="Size of each file in MB")
+    parser.add_argument('-l', '--link', type=float, default=10,
+                        help="Link speed in MB/s, 0 for unlimited")
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 6])
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    rate = int(args.link * 1024 * 1024)
+    rnd = random.Random(42)
+    directory = tempfile.mkdtemp()
+    try:
+        row = '{0:<14} {1:<8} {2:>8} {3:>10} {4:>10} {5:>8}'
+        print row.format('file', 'mode', 'ratio', 'seconds', 'MB/s',
+                         'speedup')
+
+        for name, mime_type, generate in CORPUS:
+            path = os.path.join(directory, name)
+            data = generate(rnd, size)[:size]
+
+            with open(path, 'wb') as f:
+                f.write(data)
+
+            modes = [('raw', None)]
+            if is_compressible(mime_type):
+                modes += [('zlib-{0}'.format(level), level)
+                          for level in args.levels]
+
+            baseline = None
+            for mode, level in modes:
+                elapsed, ratio = yield run(path, len(data), level, rate)
+                baseline = baseline or elapsed
+                print row.format(
+                    name, mode, '{0:.1%}'.format(ratio),
+                    '{0:.3f}'.format(elapsed),
+                    '{0:.1f}'.format(len(data) / elapsed / (1024 * 1024)),
+                    '{0:.1f}x'.format(baseline / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    task.react(main)
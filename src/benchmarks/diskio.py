@@ -0,0 +1,194 @@
+"""Reactor latency while a transfer waits on a slow disk.
+
+Sends `--size` MB over loopback TCP, read by `ChunkedSender` and written by
+`FileConsumer` through files that stand in for a disk taking `--latency`
+ms per operation plus `--rate` MB/s. It is run with the disk I/O done on
+the reactor, as it was before the disk pool, then through the pool with
+each `--depth` of read-ahead. A timer that should fire every millisecond
+records how late it runs, which is the delay every other connection of the
+process, such as a chat, would see. Run from the src directory with
+`python -m benchmarks.diskio`.
+"""
+
+import argparse
+import time
+
+from twisted.internet import defer, protocol, reactor, task
+
+from communic8.protocol.client import FileConsumer
+from communic8.transfer.sender import ChunkedSender
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class SlowFile(object):
+    """Reads zeroes and discards writes, taking `latency` seconds per call
+    plus `rate` bytes per second"""
+
+    def __init__(self, latency, rate):
+        self.latency = latency
+        self.rate = rate
+
+    def wait(self, length):
+        time.sleep(self.latency + length / float(self.rate))
+
+    def truncate(self, size):
+        pass
+
+    def seek(self, offset):
+        pass
+
+    def read(self, length):
+        self.wait(length)
+        return '\0' * length
+
+    def write(self, data):
+        self.wait(len(data))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class InlineIO(object):
+    """Reads and writes `file_object` on the reactor, in place of a
+    `ReadAhead` or a `WriteBehind`"""
+
+    def __init__(self, file_object, chunk_size=None):
+        self.file_object = file_object
+        self.chunk_size = chunk_size
+
+    def read(self):
+        return defer.succeed(self.file_object.read(self.chunk_size))
+
+    def write(self, data, flush=False):
+        self.file_object.write(data)
+        return defer.succeed(len(data))
+
+    def close(self):
+        self.file_object.close()
+
+
+class InlineSender(ChunkedSender):
+    def _start(self):
+        self.reader = InlineIO(self.file_object, self.chunk_size)
+        self.transport.registerProducer(self, True)
+        self._schedule()
+
+
+class Receiver(protocol.Protocol):
+    def connectionMade(self):
+        factory = self.factory
+        self.consumer = FileConsumer(factory.file(), factory.size)
+        if factory.inline:
+            self.consumer.writer = InlineIO(factory.file())
+
+        self.consumer.registerProducer(self, True).addCallback(
+            factory.done.callback)
+
+    def dataReceived(self, data):
+        self.consumer.write(data)
+
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+
+class ReceiverFactory(protocol.ServerFactory):
+    protocol = Receiver
+
+    def __init__(self, file, size, inline):
+        self.file = file
+        self.size = size
+        self.inline = inline
+        self.done = defer.Deferred()
+
+
+class LatencyProbe(object):
+    interval = 0.001
+
+    def __init__(self):
+        self.delays = []
+        self.last = None
+        self.call = task.LoopingCall(self.tick)
+
+    def start(self):
+        self.last = time.time()
+        self.call.start(self.interval, now=False)
+
+    def stop(self):
+        self.call.stop()
+
+    def tick(self):
+        now = time.time()
+        self.delays.append(max(0.0, now - self.last - self.interval))
+        self.last = now
+
+
+@defer.inlineCallbacks
+def run(file, size, depth):
+    inline = depth is None
+    factory = ReceiverFactory(file, size, inline)
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    client = yield protocol.ClientCreator(reactor, protocol.Protocol) \
+        .connectTCP('127.0.0.1', port.getHost().port)
+
+    if inline:
+        sender = InlineSender(file(), 0, size)
+    else:
+        sender = ChunkedSender(file(), 0, size)
+        sender.read_ahead = depth
+
+    probe = LatencyProbe()
+    probe.start()
+    started_at = time.time()
+    sender.start(client.transport)
+    yield factory.done
+    elapsed = time.time() - started_at
+    probe.stop()
+
+    client.transport.loseConnection()
+    yield port.stopListening()
+
+    defer.returnValue((elapsed, probe.delays))
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--size', type=int, default=64,
+                        help="Transfer size in MB")
+    parser.add_argument('-l', '--latency', type=float, default=4,
+                        help="Disk latency per operation in ms")
+    parser.add_argument('-r', '--rate', type=int, default=200,
+                        help="Disk speed in MB/s")
+    parser.add_argument('-d', '--depth', type=int, action='append',
+                        help="Chunks read ahead (repeatable)")
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+
+    def file():
+        return SlowFile(args.latency / 1000.0, args.rate * 1024 * 1024)
+
+    row = '{0:<12} {1:>8} {2:>12} {3:>12}'
+    print row.format('disk I/O', 'MB/s', 'reactor p99', 'reactor max')
+
+    for depth in [None] + (args.depth or [1, 4]):
+        elapsed, delays = yield run(file, size, depth)
+        print row.format(
+            'reactor' if depth is None else 'depth {0}'.format(depth),
+            '{0:.1f}'.format(size / elapsed / (1024 * 1024)),
+            '{0:.0f}us'.format(percentile(delays, 0.99) * 1e6),
+            '{0:.0f}us'.format(max(delays) * 1e6))
+
+
+if __name__ == '__main__':
+    task.react(main)
@@ -0,0 +1,90 @@
+"""Messages per second through the server protocol's lineReceived.
+
+Compares the class-level handler table with the previous per-message dict
+of lambdas and isinstance walk. Run from the src directory with
+`python -m benchmarks.dispatch`.
+"""
+
+import argparse
+import time
+
+from twisted.internet import address
+from twisted.test.proto_helpers import StringTransport
+
+from communic8.model.messages import *
+from communic8.protocol import server
+
+
+class LegacyProtocol(server.Protocol):
+    def on_message_received(self, message):
+        for msg_cls, action in {
+            Connect:
+                lambda m: self.connect(m.features),
+            Login:
+                lambda m: self.login(m.user),
+            Quit:
+                lambda m: self.disconnect(),
+            Logout:
+                lambda m: self.logout(),
+            ListUsers:
+                lambda m: self.send_user_list(m.offset, m.limit),
+            RequestChat:
+                lambda m: self.chat_initiate(m.user),
+            EndChat:
+                lambda m: self.ending_chat(m.user)
+        }.items():
+            if isinstance(message, msg_cls):
+                action(message)
+                return
+
+        raise MessageError("Unhandled message {0}".format(message.command))
+
+
+def make_protocol(protocol_cls):
+    factory = server.Factory()
+    factory.protocol = protocol_cls
+
+    peer = address.IPv4Address('TCP', '127.0.0.1', 40000)
+    proto = factory.buildProtocol(peer)
+    proto.makeConnection(StringTransport(peerAddress=peer))
+    proto.lineReceived('CONNECT')
+    proto.lineReceived('LOGIN bench')
+    return proto
+
+
+def run(protocol_cls, line, count, logging=False):
+    proto = make_protocol(protocol_cls)
+    transport = proto.transport
+    if not logging:
+        # Logging dominates otherwise, hiding the dispatch cost
+        proto.log = lambda *args, **kwargs: None
+
+    start = time.time()
+    for n in xrange(count):
+        proto.lineReceived(line)
+        if n % 1000 == 0:
+            transport.clear()
+    elapsed = time.time() - start
+
+    return count / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=50000)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--logging', action='store_true',
+                        help="Keep protocol logging enabled")
+    parser.add_argument('line', nargs='?', default='LIST_USERS',
+                        help="Line to feed to the protocol")
+    args = parser.parse_args()
+
+    for name, protocol_cls in [('isinstance loop', LegacyProtocol),
+                               ('handler table', server.Protocol)]:
+        rate = max(run(protocol_cls, args.line, args.count, args.logging)
+                   for _ in range(args.repeat))
+        print '{0:<16} {1:>10.0f} messages/s'.format(name, rate)
+
+
+if __name__ == '__main__':
+    main()
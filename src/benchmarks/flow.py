@@ -0,0 +1,148 @@
+"""Memory held by a receiver writing to a disk slower than the network.
+
+Sends a `--size` MB file over loopback TCP with the chunked engine, into a
+`FileConsumer` writing to a sink that takes `--rate` MB/s, far less than
+loopback carries. It is run once with the consumer's default window, and
+once with a window too large to ever pause the connection. For each, the
+most bytes the consumer held and the growth of the process's resident
+memory are reported: with flow control both stay near the window, without
+it the whole file ends up in memory. Run from the src directory with
+`python -m benchmarks.flow`.
+"""
+
+import argparse
+import os
+import resource
+import tempfile
+import time
+
+from twisted.internet import defer, protocol, reactor, task
+
+from communic8.protocol.client import FileConsumer
+from communic8.transfer.sender import ChunkedSender
+
+
+def resident_size():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * resource.getpagesize()
+
+
+class SlowFile(object):
+    """Discards what is written to it, at `rate` bytes per second"""
+
+    def __init__(self, rate):
+        self.rate = rate
+
+    def truncate(self, size):
+        pass
+
+    def seek(self, offset):
+        pass
+
+    def write(self, data):
+        time.sleep(len(data) / float(self.rate))
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Receiver(protocol.Protocol):
+    def connectionMade(self):
+        factory = self.factory
+        self.consumer = factory.consumer(SlowFile(factory.rate), factory.size)
+        factory.window = self.consumer.window
+        self.consumer.registerProducer(self, True).addCallback(
+            factory.done.callback)
+
+    def dataReceived(self, data):
+        self.consumer.write(data)
+
+    def pauseProducing(self):
+        self.transport.pauseProducing()
+
+    def resumeProducing(self):
+        self.transport.resumeProducing()
+
+
+class ReceiverFactory(protocol.ServerFactory):
+    protocol = Receiver
+
+    def __init__(self, consumer, size, rate):
+        self.consumer = consumer
+        self.size = size
+        self.rate = rate
+        self.window = None
+        self.done = defer.Deferred()
+
+
+class UnboundedFileConsumer(FileConsumer):
+    window_size = 1 << 62
+
+
+CONSUMERS = [
+    ('window', FileConsumer),
+    ('unbounded', UnboundedFileConsumer),
+]
+
+
+@defer.inlineCallbacks
+def run(consumer, source, size, rate):
+    factory = ReceiverFactory(consumer, size, rate)
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    client = yield protocol.ClientCreator(reactor, protocol.Protocol) \
+        .connectTCP('127.0.0.1', port.getHost().port)
+
+    baseline = resident_size()
+    samples = [baseline]
+    sampler = task.LoopingCall(lambda: samples.append(resident_size()))
+    sampler.start(0.01)
+
+    started_at = time.time()
+    ChunkedSender(open(source, 'rb'), 0, size).start(client.transport)
+    yield factory.done
+    elapsed = time.time() - started_at
+    sampler.stop()
+
+    client.transport.loseConnection()
+    yield port.stopListening()
+
+    defer.returnValue((elapsed, factory.window, max(samples) - baseline))
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--size', type=int, default=64,
+                        help="File size in MB")
+    parser.add_argument('-r', '--rate', type=int, default=32,
+                        help="Sink speed in MB/s")
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    fd, source = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for _ in xrange(args.size):
+                f.write(os.urandom(1024 * 1024))
+
+        row = '{0:<10} {1:>8} {2:>10} {3:>8} {4:>11}'
+        print row.format('consumer', 'MB/s', 'held max', 'pauses',
+                         'RSS growth')
+
+        for name, consumer in CONSUMERS:
+            elapsed, window, growth = yield run(consumer, source, size,
+                                                args.rate * 1024 * 1024)
+            print row.format(
+                name, '{0:.1f}'.format(size / elapsed / (1024 * 1024)),
+                '{0:.1f}MB'.format(window.peak / (1024.0 * 1024)),
+                window.pauses,
+                '{0:.1f}MB'.format(growth / (1024.0 * 1024)))
+    finally:
+        os.remove(source)
+
+
+if __name__ == '__main__':
+    task.react(main)
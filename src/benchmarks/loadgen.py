@@ -0,0 +1,498 @@
+"""Load generator for the chat server.
+
+Runs a `communic8.protocol.server.Factory` in this process and drives it
+with simulated clients, over in-memory transports or loopback TCP. Clients
+come in pairs: the first of each pair loops over LIST_USERS, HEARTBEAT,
+REQUEST_CHAT and END_CHAT with its partner, while the second only sends
+HEARTBEAT, which is allowed while chatting, accepts the chats it is asked
+for and logs out after its partner. Every client negotiates pipelining on
+CONNECT, as the bundled client does, so that requests and chat
+confirmations can interleave, logs in, and ends with LOGOUT and QUIT.
+
+Scenarios:
+
+  ramp-up       clients join at --rate per second, then all of them keep
+                going for --duration seconds
+  steady-state  all clients log in first; only the following --duration
+                seconds are measured
+  login-storm   all clients connect and log in at once, then log out
+
+Latency percentiles and throughput per command, a per-second timeline and
+the resident memory per logged in session (which includes the simulated
+client objects) are written as JSON. Run from the src directory with
+`python -m benchmarks.loadgen`.
+"""
+
+import argparse
+import gc
+import itertools
+import json
+import resource
+import sys
+import time
+
+from twisted.internet import address, defer, protocol, reactor, task
+from twisted.protocols.basic import LineReceiver
+from twisted.test.proto_helpers import StringTransport
+
+from communic8.protocol import server
+from communic8.util import logger
+
+
+SCENARIOS = ('ramp-up', 'steady-state', 'login-storm')
+
+
+def resident_memory():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # Peak rather than current usage, but better than nothing
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+
+    index = min(len(ordered) - 1, int(fraction * len(ordered)))
+    return ordered[index]
+
+
+class Stats(object):
+    """Latency samples by command, plus a per-second timeline"""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.started_at = time.time()
+        self.latencies = {}
+        self.errors = {}
+        self.timeline = {}
+
+    def record(self, command, latency, error=None):
+        self.latencies.setdefault(command, []).append(latency)
+        if error:
+            errors = self.errors.setdefault(command, {})
+            errors[error] = errors.get(error, 0) + 1
+
+        second = int(time.time() - self.started_at)
+        self.timeline.setdefault(second, []).append(latency)
+
+    def report(self, elapsed):
+        commands = {}
+        total = 0
+        for command, samples in sorted(self.latencies.iteritems()):
+            samples.sort()
+            total += len(samples)
+            commands[command] = {
+                'count': len(samples),
+                'errors': self.errors.get(command, {}),
+                'throughput': len(samples) / elapsed,
+                'mean': sum(samples) / len(samples),
+                'p50': percentile(samples, 0.5),
+                'p99': percentile(samples, 0.99),
+                'p999': percentile(samples, 0.999),
+                'max': samples[-1]
+            }
+
+        timeline = []
+        for second, samples in sorted(self.timeline.iteritems()):
+            samples.sort()
+            timeline.append({'second': second, 'requests': len(samples),
+                             'p99': percentile(samples, 0.99)})
+
+        return {'elapsed': elapsed, 'requests': total,
+                'throughput': total / elapsed, 'commands': commands,
+                'timeline': timeline}
+
+
+class MemoryTransport(StringTransport):
+    """One end of an in-memory connection, delivered through a pump"""
+
+    def __init__(self, pump, host_address, peer_address):
+        StringTransport.__init__(self, hostAddress=host_address,
+                                 peerAddress=peer_address)
+        self.pump = pump
+        self.peer = None
+        self.protocol = None
+        self.connected = True
+
+    def write(self, data):
+        if self.connected:
+            self.pump.deliver(self.peer, data)
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def loseConnection(self):
+        self.pump.disconnect(self)
+
+    abortConnection = loseConnection
+
+
+class MemoryPump(object):
+    """Delivers writes between in-memory transports once per reactor
+    iteration, keeping their order"""
+
+    def __init__(self):
+        self.queue = []
+        self.flush_call = None
+
+    def connect(self, server_protocol, client_protocol, host, port):
+        server_address = address.IPv4Address('TCP', '127.0.0.1', 8125)
+        client_address = address.IPv4Address('TCP', host, port)
+
+        server_transport = MemoryTransport(self, server_address,
+                                           client_address)
+        client_transport = MemoryTransport(self, client_address,
+                                           server_address)
+        server_transport.peer = client_transport
+        server_transport.protocol = server_protocol
+        client_transport.peer = server_transport
+        client_transport.protocol = client_protocol
+
+        server_protocol.makeConnection(server_transport)
+        client_protocol.makeConnection(client_transport)
+
+    def deliver(self, transport, data):
+        self.queue.append((transport, data))
+        if self.flush_call is None:
+            self.flush_call = reactor.callLater(0, self.flush)
+
+    def flush(self):
+        self.flush_call = None
+        queue, self.queue = self.queue, []
+        for transport, data in queue:
+            if transport.connected:
+                transport.protocol.dataReceived(data)
+
+    def disconnect(self, transport):
+        for end in (transport, transport.peer):
+            if end.connected:
+                end.connected = False
+                reactor.callLater(0, end.protocol.connectionLost,
+                                  protocol.connectionDone)
+
+
+class SimulatedClient(LineReceiver):
+    MAX_LENGTH = 1024 * 1024
+
+    def __init__(self, run, name, partner=None):
+        self.load_run = run
+        self.name = name
+
+        # Pairs know each other, the one created with a partner initiates
+        self.partner = partner
+        self.initiator = partner is not None
+        if partner is not None:
+            partner.partner = self
+
+        self.logged_in = None
+        self.pipelined = False
+        self.next_request_id = 1
+        self.pending = {}
+        self.stopped = defer.Deferred()
+        self.finished = defer.Deferred()
+
+    def connectionMade(self):
+        self.script().chainDeferred(self.finished)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        for d, _, _ in self.pending.values():
+            d.errback(reason)
+        self.pending.clear()
+
+    def request(self, line):
+        command = line.split(' ', 1)[0]
+        request_id = None
+        if self.pipelined:
+            request_id = self.next_request_id
+            self.next_request_id += 1
+            line = '#{0} {1}'.format(request_id, line)
+
+        d = defer.Deferred()
+        self.pending[request_id] = (d, command, time.time())
+        self.sendLine(line)
+        return d
+
+    def lineReceived(self, line):
+        if not line.startswith('{'):
+            self.message_received(line)
+            return
+
+        response = json.loads(line)
+        d, command, sent_at = self.pending.pop(response.pop('id', None))
+        self.load_run.stats.record(command, time.time() - sent_at,
+                                   response.get('error'))
+        d.callback(response)
+
+    def message_received(self, line):
+        request_id = None
+        if line.startswith('#'):
+            request_id, line = line[1:].split(' ', 1)
+            request_id = int(request_id)
+
+        if line.startswith('CHAT_REQUESTED'):
+            response = {'result': 'confirmed', 'port': 40000}
+        else:
+            response = {}
+
+        if request_id is not None:
+            response['id'] = request_id
+
+        self.sendLine(json.dumps(response))
+
+    @defer.inlineCallbacks
+    def chat(self):
+        partner_name = self.partner.name
+        response = yield self.request('REQUEST_CHAT ' + partner_name)
+        yield self.think()
+
+        if response.get('state') == 'chatting':
+            yield self.request('END_CHAT ' + partner_name)
+            yield self.think()
+
+    def think(self):
+        return task.deferLater(reactor, self.load_run.think_time,
+                               lambda: None)
+
+    @defer.inlineCallbacks
+    def script(self):
+        run = self.load_run
+
+        try:
+            response = yield self.request('CONNECT pipeline')
+            self.pipelined = 'pipeline' in response.get('features', ())
+
+            response = yield self.request('LOGIN ' + self.name)
+            self.logged_in = 'error' not in response
+            if not self.logged_in:
+                self.transport.loseConnection()
+                return
+
+            yield run.login_finished(self)
+
+            while run.running:
+                yield self.request('HEARTBEAT')
+                yield self.think()
+
+                if self.initiator and run.running:
+                    yield self.request('LIST_USERS 0 100')
+                    yield self.think()
+                    yield self.chat()
+        finally:
+            if not self.logged_in:
+                self.logged_in = False
+                run.login_finished(self)
+            self.stopped.callback(None)
+
+        if self.partner is not None and not self.initiator:
+            # Leaving in the middle of a chat is not what is being measured
+            yield self.partner.stopped
+
+        yield self.request('LOGOUT')
+        # QUIT has no response, the server just hangs up
+        self.sendLine('QUIT')
+        self.transport.loseConnection()
+
+
+class SimulatedClientFactory(protocol.ClientFactory):
+    def __init__(self, client):
+        self.client = client
+
+    def buildProtocol(self, addr):
+        return self.client
+
+    def clientConnectionFailed(self, connector, reason):
+        self.client.logged_in = False
+        self.client.load_run.login_finished(self.client)
+        self.client.stopped.callback(None)
+        self.client.finished.errback(reason)
+
+
+class LoadRun(object):
+    ramp_interval = 0.1
+
+    def __init__(self, args):
+        self.scenario = args.scenario
+        self.client_count = args.clients
+        self.transport = args.transport
+        self.rate = args.rate
+        self.duration = args.duration
+        self.think_time = args.think
+
+        self.factory = server.Factory(idle_timeout=0)
+        self.pump = MemoryPump()
+        self.port = None
+        self.stats = Stats()
+        self.running = True
+        self.clients = []
+
+        self.login_count = 0
+        self.logged_in_count = 0
+        self.all_logged_in = defer.Deferred()
+        self.memory = {}
+
+    def login_finished(self, client):
+        self.login_count += 1
+        if client.logged_in:
+            self.logged_in_count += 1
+        if self.login_count == self.client_count:
+            self.all_logged_in.callback(None)
+
+        if self.scenario == 'login-storm':
+            # Everyone logs out once the whole storm is in
+            self.running = False
+            return self.all_logged_in
+
+    def start_client(self, n):
+        name = 'user{0}'.format(n)
+        if n % 2 == 0 and n + 1 < self.client_count:
+            partner = SimulatedClient(self, 'user{0}'.format(n + 1))
+            client = SimulatedClient(self, name, partner)
+        elif n % 2 == 1:
+            client = self.clients[n - 1].partner
+        else:
+            client = SimulatedClient(self, name)
+
+        self.clients.append(client)
+
+        if self.transport == 'tcp':
+            reactor.connectTCP('127.0.0.1', self.port.getHost().port,
+                               SimulatedClientFactory(client))
+        else:
+            server_protocol = self.factory.buildProtocol(
+                address.IPv4Address('TCP', '127.0.0.1', 10000 + n))
+            self.pump.connect(server_protocol, client, '127.0.0.1',
+                              10000 + n)
+
+        return client.finished
+
+    @defer.inlineCallbacks
+    def run(self):
+        if self.transport == 'tcp':
+            self.port = reactor.listenTCP(0, self.factory,
+                                          interface='127.0.0.1')
+
+        gc.collect()
+        self.memory['before'] = resident_memory()
+        self.all_logged_in.addCallback(self.measure_memory)
+
+        started_at = time.time()
+        if self.scenario == 'ramp-up':
+            # Joining in small batches keeps up with the rate, where a
+            # delayed call per client would lag behind the reactor
+            clients = iter(xrange(self.client_count))
+            batch = max(1, int(self.rate * self.ramp_interval))
+            ramp = task.LoopingCall(
+                lambda: map(self.start_client, itertools.islice(clients,
+                                                                batch)))
+            ramp.start(self.ramp_interval)
+
+            yield self.all_logged_in
+            ramp.stop()
+            yield task.deferLater(reactor, self.duration, lambda: None)
+        else:
+            for n in xrange(self.client_count):
+                self.start_client(n)
+
+            yield self.all_logged_in
+            if self.scenario == 'steady-state':
+                self.stats.reset()
+                started_at = time.time()
+                yield task.deferLater(reactor, self.duration, lambda: None)
+
+        self.running = False
+        yield defer.DeferredList([c.finished for c in self.clients],
+                                 consumeErrors=True)
+        elapsed = time.time() - started_at
+
+        if self.port is not None:
+            yield self.port.stopListening()
+
+        defer.returnValue(self.report(elapsed))
+
+    def measure_memory(self, _):
+        gc.collect()
+        self.memory['logged_in'] = resident_memory()
+
+    def report(self, elapsed):
+        report = self.stats.report(elapsed)
+        report.update({
+            'scenario': self.scenario,
+            'clients': self.client_count,
+            'logged_in': self.logged_in_count,
+            'transport': self.transport,
+            'think_time': self.think_time,
+            'memory': {
+                'before': self.memory.get('before'),
+                'logged_in': self.memory.get('logged_in'),
+                'per_session': (self.memory.get('logged_in', 0) -
+                                self.memory['before']) /
+                               max(1, self.logged_in_count)
+            }
+        })
+        return report
+
+
+def raise_file_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        target = needed if hard == resource.RLIM_INFINITY else \
+            min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('scenario', choices=SCENARIOS)
+    parser.add_argument('-c', '--clients', type=int, default=2000)
+    parser.add_argument('-t', '--transport', choices=('memory', 'tcp'),
+                        default='memory')
+    parser.add_argument('-d', '--duration', type=float, default=10,
+                        help="Seconds to keep going once everyone is in")
+    parser.add_argument('--rate', type=float, default=500,
+                        help="Clients joining per second when ramping up")
+    parser.add_argument('--think', type=float, default=0.05,
+                        help="Seconds between the commands of a client")
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help="Write the JSON report here instead of stdout")
+    parser.add_argument('--log-level', default='warning',
+                        help="Level for the server's own logging")
+    args = parser.parse_args()
+
+    logger.configure(levels={'*': logger.parse_level(args.log_level)})
+    if args.transport == 'tcp':
+        raise_file_limit(2 * args.clients + 64)
+
+    result = {}
+
+    def done(report):
+        result['report'] = report
+        reactor.stop()
+
+    def failed(failure):
+        failure.printTraceback()
+        reactor.stop()
+
+    load_run = LoadRun(args)
+    reactor.callWhenRunning(
+        lambda: load_run.run().addCallbacks(done, failed))
+    reactor.run()
+
+    if 'report' not in result:
+        sys.exit(1)
+
+    output = json.dumps(result['report'], indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print output
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,245 @@
+"""Microbenchmarks for message parsing and serialization.
+
+Times, for every message type in `communic8.model.messages`, parsing a
+whole line with `MessageDispatcher.parse`, parsing just its arguments with
+`args_from_string` and serializing it with `str`, as well as encoding and
+decoding JSON responses with the text and binary codecs.
+
+Each benchmark runs with the garbage collector disabled, in loops long
+enough to take at least `--min-time` seconds, and the fastest of
+`--repeat` loops is reported: slower ones only measure interference from
+the rest of the system. Results can be saved with `--save` and compared
+against later with `--compare`, which fails if anything got more than
+`--threshold` slower. Run from the src directory with
+`python -m benchmarks.messages`.
+"""
+
+import argparse
+import inspect
+import json
+import platform
+import re
+import sys
+import timeit
+from datetime import datetime
+
+from communic8.model import messages
+from communic8.model.messages import *
+from communic8.protocol.codec import RawJSON, text_codec, binary_codec
+
+
+SAMPLES = [
+    Connect(('pipeline', 'binary')),
+    Quit(),
+    Login('some_user_name'),
+    Logout(),
+    ListUsers(),
+    ListUsers(200, 100),
+    RequestChat('another_user'),
+    ChatRequested('another_user'),
+    SendChat('the quick brown fox jumps over the lazy dog ' * 3),
+    EndChat('another_user'),
+    RequestFileTransfer('report.pdf', 'application/pdf',
+                        datetime(2014, 10, 1, 12, 30), 1048576L, 512),
+    RequestFileTransfer('report.pdf', 'application/pdf',
+                        datetime(2014, 10, 1, 12, 30), 1048576L, 512, 4),
+    RequestFileTransfer('report.pdf', 'application/pdf',
+                        datetime(2014, 10, 1, 12, 30), 1048576L, 512, 4,
+                        '9f86d081884c7d659a2feaa0c55ad015'
+                        'a3bf4f1b2b0b822cd15d6c15b0f00a08'),
+    BlockHashes(3, 16L, 2),
+    ResendBlocks([3, 17, 120]),
+    EndTransfer('verified'),
+    BlockChecksums(4096L, 256),
+    StartDelta(),
+    SubscribePresence(),
+    UnsubscribePresence(),
+    UserJoined(1234L, 'some_user_name', '2014-10-01T12:30:00.000000'),
+    UserLeft(1235L, 'some_user_name'),
+    Heartbeat(),
+    Stats(),
+    ClaimUser('some_user_name', '192.168.10.20', 51234),
+    ReleaseUser('some_user_name'),
+    UserClaimed('some_user_name', '192.168.10.20', 51234,
+                '2014-10-01T12:30:00.000000'),
+    UserReleased('some_user_name'),
+    RouteEvent('some_user_name', 'chat_finished', '["another_user"]'),
+]
+
+RESPONSES = {
+    'login': {
+        'state': 'logged_in',
+        'user': {'name': 'some_user_name', 'host': '192.168.10.20',
+                 'port': 51234, 'connected_at': '2014-10-01T12:30:00.000000'}
+    },
+    'user_page': {
+        'state': 'logged_in', 'result': 'ok', 'total': 250,
+        'generation': 42, 'next_offset': 100,
+        'users': RawJSON(json.dumps([
+            {'name': 'user{0}'.format(n),
+             'connected_at': '2014-10-01T12:30:00.000000'}
+            for n in range(100)]))
+    }
+}
+
+
+def message_types():
+    return [cls for _, cls in inspect.getmembers(messages, inspect.isclass)
+            if issubclass(cls, Message) and cls is not Message]
+
+
+def sample_name(message):
+    name = message.command
+    args = message.args()
+    required = type(message).required_args
+    if required is not None and required < len(type(message).arg_types) \
+            and args:
+        # Distinguishes messages sent with and without optional arguments
+        name += '/{0}'.format(len(args))
+
+    return name
+
+
+def benchmarks():
+    """(name, function) pairs for everything to be timed"""
+
+    types = message_types()
+    missing = set(types) - set(type(m) for m in SAMPLES)
+    if missing:
+        raise RuntimeError("No samples for {0}".format(
+            ', '.join(sorted(cls.__name__ for cls in missing))))
+
+    dispatcher = MessageDispatcher().register(*types)
+
+    cases = []
+    for message in SAMPLES:
+        name = sample_name(message)
+        line = str(message)
+        arg_string = line.split(' ', 1)[1] if ' ' in line else ''
+        cls = type(message)
+
+        cases.append((name + ' parse',
+                      lambda line=line: dispatcher.parse(line)))
+        cases.append((name + ' args_from_string',
+                      lambda cls=cls, s=arg_string: cls.args_from_string(s)))
+        cases.append((name + ' str',
+                      lambda message=message: str(message)))
+
+        if isinstance(message, RequestFileTransfer):
+            cases.append((name + ' mtime_timestamp',
+                          message.mtime_timestamp))
+
+    for name, data in sorted(RESPONSES.items()):
+        for codec in (text_codec, binary_codec):
+            frame = codec.encode_response(data, 42)
+            if codec.framed:
+                frames, _ = codec.split_frames(frame)
+                frame = frames[0]
+            else:
+                frame = frame[:-2]
+
+            prefix = 'response {0} {1}'.format(name, codec.name)
+            cases.append((prefix + ' encode',
+                          lambda codec=codec, data=data:
+                          codec.encode_response(data, 42)))
+            cases.append((prefix + ' decode',
+                          lambda codec=codec, frame=frame:
+                          codec.decode_response(codec.split_frame(frame)[2])))
+
+    return cases
+
+
+def measure(f, min_time, repeat):
+    """Seconds per call: the fastest of `repeat` loops, each of them long
+    enough to take `min_time`"""
+
+    timer = timeit.Timer(f)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+
+    timings = [elapsed] + timer.repeat(repeat - 1, number)
+    timings.sort()
+    return timings[0] / number, timings[len(timings) // 2] / number
+
+
+def environment():
+    return {'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'machine': platform.machine(),
+            'platform': platform.platform()}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('-k', '--filter', metavar='REGEX',
+                        help="Only run benchmarks whose name matches")
+    parser.add_argument('-r', '--repeat', type=int, default=7)
+    parser.add_argument('--min-time', type=float, default=0.05,
+                        help="Minimum seconds per timed loop")
+    parser.add_argument('--save', metavar='FILE',
+                        help="Save the results as a baseline")
+    parser.add_argument('--compare', metavar='FILE',
+                        help="Compare against a saved baseline")
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help="Slowdown over the baseline counted as a "
+                             "regression, as a fraction (default 0.1)")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline['environment'] != environment():
+            print >> sys.stderr, ("Warning: the baseline was recorded on "
+                                  "{0}".format(baseline['environment']))
+
+    pattern = re.compile(args.filter) if args.filter else None
+
+    row = '{0:<44} {1:>9} {2:>9} {3:>9} {4:>8}'
+    print row.format('benchmark', 'best ns', 'median ns', 'base ns',
+                     'change')
+
+    results = {}
+    regressions = []
+    for name, f in benchmarks():
+        if pattern and not pattern.search(name):
+            continue
+
+        best, median = measure(f, args.min_time, args.repeat)
+        results[name] = best
+
+        base = change = ''
+        if baseline and name in baseline['results']:
+            base_time = baseline['results'][name]
+            ratio = best / base_time - 1
+            base = '{0:.0f}'.format(base_time * 1e9)
+            change = '{0:+.1%}'.format(ratio)
+            if ratio > args.threshold:
+                regressions.append(name)
+                change += ' !'
+
+        print row.format(name, '{0:.0f}'.format(best * 1e9),
+                         '{0:.0f}'.format(median * 1e9), base, change)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'environment': environment(), 'results': results}, f,
+                      indent=2, sort_keys=True)
+            f.write('\n')
+
+    if regressions:
+        print
+        print '{0} benchmark(s) more than {1:.0%} slower than the ' \
+              'baseline:'.format(len(regressions), args.threshold)
+        for name in regressions:
+            print '  ' + name
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
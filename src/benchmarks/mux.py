@@ -0,0 +1,151 @@
+"""Chat latency while a file transfer fills the connection.
+
+Two peers on loopback TCP, with only pipelining and the binary codec
+besides channels, send a `--size` MB file from one to the other. Every
+`--interval` ms the sender sends a chat message and times the response.
+With channels, chat takes turns with the file data; without them, chat is
+refused until the transfer is over, so each message is held and sent once
+it is, and its time counts from when it was written. Run from the src
+directory with `python -m benchmarks.mux`.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from twisted.internet import defer, reactor, task
+
+from communic8.model.messages import SendChat
+from communic8.protocol import CommonClientFactory, CommonFactory, client
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def peer_class(mux):
+    features = ('pipeline', 'binary') + (('mux',) if mux else ())
+
+    class Peer(client.Protocol):
+        supported_features = features
+        done = None
+
+        def on_leave_receiving_file(self, event):
+            client.Protocol.on_leave_receiving_file(self, event)
+            self.done.callback(None)
+
+    return Peer
+
+
+class ChatProbe(object):
+    def __init__(self, protocol, interval):
+        self.protocol = protocol
+        self.times = []
+        self.held = []
+        self.call = task.LoopingCall(self.send)
+        self.interval = interval
+
+    def start(self):
+        self.call.start(self.interval, now=False)
+
+    def stop(self):
+        self.call.stop()
+
+    def send(self, written_at=None):
+        if written_at is None:
+            written_at = time.time()
+
+        proto = self.protocol
+        if proto.mux is None and proto.current != 'connected':
+            self.held.append(written_at)
+            return
+
+        d = proto.send_message(SendChat('ping'))
+        d.addCallback(lambda _: self.times.append(time.time() - written_at))
+        return d
+
+    def flush(self):
+        held, self.held = self.held, []
+        return defer.gatherResults([self.send(t) for t in held])
+
+
+@defer.inlineCallbacks
+def run(source, mux, interval):
+    Peer = peer_class(mux)
+    receive_path = tempfile.mkdtemp()
+    receivers = []
+    senders = []
+    try:
+        port = reactor.listenTCP(
+            0, CommonFactory(Peer, receivers.append, None, 'receiver', False,
+                             receive_path),
+            interface='127.0.0.1')
+        reactor.connectTCP(
+            '127.0.0.1', port.getHost().port,
+            CommonClientFactory(Peer, senders.append, None, 'sender', True,
+                                os.path.dirname(source)))
+
+        while not senders or senders[0].current != 'connected':
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+        sender = senders[0]
+        done = receivers[0].done = defer.Deferred()
+        probe = ChatProbe(sender, interval)
+
+        started_at = time.time()
+        sender.send_file(client.TransferFile.from_path(source))
+        probe.start()
+        yield done
+        elapsed = time.time() - started_at
+        probe.stop()
+
+        while sender.current != 'connected':
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        yield probe.flush()
+
+        sender.transport.loseConnection()
+        yield port.stopListening()
+    finally:
+        shutil.rmtree(receive_path)
+
+    defer.returnValue((elapsed, probe.times))
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help="File size in MB")
+    parser.add_argument('-i', '--interval', type=float, default=20,
+                        help="Time between chat messages in ms")
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    fd, source = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for _ in xrange(args.size):
+                f.write(os.urandom(1024 * 1024))
+
+        row = '{0:<10} {1:>8} {2:>6} {3:>10} {4:>10} {5:>10}'
+        print row.format('channels', 'MB/s', 'chats', 'chat p50', 'chat p99',
+                         'chat max')
+
+        for mux in (True, False):
+            elapsed, times = yield run(source, mux, args.interval / 1000.0)
+            print row.format(
+                'on' if mux else 'off',
+                '{0:.1f}'.format(size / elapsed / (1024 * 1024)),
+                len(times),
+                '{0:.1f}ms'.format(percentile(times, 0.5) * 1000),
+                '{0:.1f}ms'.format(percentile(times, 0.99) * 1000),
+                '{0:.1f}ms'.format(max(times) * 1000))
+    finally:
+        os.remove(source)
+
+
+if __name__ == '__main__':
+    task.react(main)
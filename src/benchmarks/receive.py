@@ -0,0 +1,153 @@
+"""Receive throughput and reactor latency of the file consumers.
+
+Sends a `--size` MB file over loopback TCP with the chunked engine, into
+`FileConsumer` and `MappedFileConsumer` in turn, writing to a file in
+`--dir`. Throughput is measured until the file is on disk: the mapped
+consumer syncs it before reporting it done, the plain one leaves it to the
+page cache, so it is synced afterwards, in a thread. Meanwhile, a timer
+that should fire every millisecond records how late it runs, which is how
+long the reactor is kept from everything else, and every write to the
+consumer is timed. Run from the src directory with
+`python -m benchmarks.receive`.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from twisted.internet import defer, protocol, reactor, task, threads
+
+from communic8.protocol.client import FileConsumer
+from communic8.transfer.mapped import MappedFileConsumer
+from communic8.transfer.sender import ChunkedSender
+
+
+CONSUMERS = [
+    ('FileConsumer', FileConsumer),
+    ('MappedFileConsumer', MappedFileConsumer),
+]
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Receiver(protocol.Protocol):
+    def connectionMade(self):
+        factory = self.factory
+        fp = open(factory.path, 'w+b')
+        self.consumer = factory.consumer(fp, factory.size)
+        self.consumer.registerProducer(self.transport, True).addCallback(
+            lambda _: factory.done.callback(None))
+
+    def dataReceived(self, data):
+        if self.factory.done.called:
+            return
+
+        started_at = time.time()
+        self.consumer.write(data)
+        self.factory.write_times.append(time.time() - started_at)
+
+
+class ReceiverFactory(protocol.ServerFactory):
+    protocol = Receiver
+
+    def __init__(self, consumer, path, size):
+        self.consumer = consumer
+        self.path = path
+        self.size = size
+        self.write_times = []
+        self.done = defer.Deferred()
+
+
+class LatencyProbe(object):
+    interval = 0.001
+
+    def __init__(self):
+        self.delays = []
+        self.last = None
+        self.call = task.LoopingCall(self.tick)
+
+    def start(self):
+        self.last = time.time()
+        self.call.start(self.interval, now=False)
+
+    def stop(self):
+        self.call.stop()
+
+    def tick(self):
+        now = time.time()
+        self.delays.append(max(0.0, now - self.last - self.interval))
+        self.last = now
+
+
+@defer.inlineCallbacks
+def run(consumer, source, path, size):
+    factory = ReceiverFactory(consumer, path, size)
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    client = yield protocol.ClientCreator(reactor, protocol.Protocol) \
+        .connectTCP('127.0.0.1', port.getHost().port)
+
+    probe = LatencyProbe()
+    probe.start()
+    started_at = time.time()
+    ChunkedSender(open(source, 'rb'), 0, size).start(client.transport)
+    yield factory.done
+    with open(path, 'rb') as f:
+        yield threads.deferToThread(os.fsync, f.fileno())
+
+    finished_at = time.time()
+    probe.stop()
+
+    client.transport.loseConnection()
+    yield port.stopListening()
+    os.remove(path)
+
+    defer.returnValue((finished_at - started_at, factory.write_times,
+                       probe.delays))
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help="File size in MB")
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    parser.add_argument('--dir', default=None,
+                        help="Directory to receive into")
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    fd, source = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for _ in xrange(args.size):
+                f.write(os.urandom(1024 * 1024))
+
+        row = '{0:<20} {1:>8} {2:>11} {3:>10} {4:>10} {5:>12} {6:>12}'
+        print row.format('consumer', 'MB/s', 'write total', 'write p99',
+                         'write max', 'reactor p99', 'reactor max')
+
+        for name, consumer in CONSUMERS:
+            results = []
+            for _ in xrange(args.repeat):
+                fd, path = tempfile.mkstemp(dir=args.dir)
+                os.close(fd)
+                results.append((yield run(consumer, source, path, size)))
+
+            elapsed, writes, delays = sorted(results)[len(results) // 2]
+            print row.format(
+                name, '{0:.1f}'.format(size / elapsed / (1024 * 1024)),
+                '{0:.3f}s'.format(sum(writes)),
+                '{0:.0f}us'.format(percentile(writes, 0.99) * 1e6),
+                '{0:.0f}us'.format(max(writes) * 1e6),
+                '{0:.0f}us'.format(percentile(delays, 0.99) * 1e6),
+                '{0:.0f}us'.format(max(delays) * 1e6))
+    finally:
+        os.remove(source)
+
+
+if __name__ == '__main__':
+    task.react(main)
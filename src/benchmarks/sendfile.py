@@ -0,0 +1,115 @@
+"""File sending throughput over loopback TCP.
+
+Sends a `--size` MB file to a receiver that discards it, with sendfile(2)
+when available, with the chunked engine, and with `FileBodyProducer` and
+512 byte reads, as P2P transfers used to. Throughput is measured until the
+receiver has every byte. Run from the src directory with
+`python -m benchmarks.sendfile`.
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+from twisted.internet import defer, protocol, reactor, task
+from twisted.web.client import FileBodyProducer
+
+from communic8.transfer import sender as transfer_sender
+from communic8.transfer.sender import ChunkedSender, SendfileSender
+
+
+class Discard(protocol.Protocol):
+    def connectionMade(self):
+        self.factory.connected.callback(self)
+
+    def dataReceived(self, data):
+        self.factory.received += len(data)
+        if self.factory.received >= self.factory.expected:
+            self.factory.done.callback(time.time())
+
+
+class DiscardFactory(protocol.ServerFactory):
+    protocol = Discard
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.received = 0
+        self.connected = defer.Deferred()
+        self.done = defer.Deferred()
+
+
+class LegacySender(object):
+    """`FileBodyProducer` reading the transfer's 512 byte blocks"""
+
+    def __init__(self, file_object, offset, length):
+        file_object.seek(offset)
+        self.producer = FileBodyProducer(file_object, readSize=512)
+
+    def start(self, transport):
+        return self.producer.startProducing(transport)
+
+
+ENGINES = [
+    ('sendfile', SendfileSender),
+    ('chunked 256K', ChunkedSender),
+    ('chunked 16K', lambda f, offset, length:
+        ChunkedSender(f, offset, length, 16 * 1024)),
+    ('FileBodyProducer 512', LegacySender),
+]
+
+
+@defer.inlineCallbacks
+def run(path, size, make_sender):
+    factory = DiscardFactory(size)
+    port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+
+    client = yield protocol.ClientCreator(reactor, protocol.Protocol) \
+        .connectTCP('127.0.0.1', port.getHost().port)
+    yield factory.connected
+
+    started_at = time.time()
+    make_sender(open(path, 'rb'), 0, size).start(client.transport)
+    finished_at = yield factory.done
+
+    client.transport.loseConnection()
+    yield port.stopListening()
+    defer.returnValue(finished_at - started_at)
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--size', type=int, default=256,
+                        help="File size in MB")
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in xrange(args.size):
+                f.write(block)
+
+        print '{0:<24} {1:>10} {2:>12}'.format('engine', 'seconds', 'MB/s')
+        for name, make_sender in ENGINES:
+            if make_sender is SendfileSender and \
+                    transfer_sender.sendfile is None:
+                print '{0:<24} {1:>10}'.format(name, 'unavailable')
+                continue
+
+            elapsed = []
+            for _ in xrange(args.repeat):
+                elapsed.append((yield run(path, size, make_sender)))
+
+            best = min(elapsed)
+            print '{0:<24} {1:>10.3f} {2:>12.1f}'.format(
+                name, best, args.size / best)
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    task.react(main)
@@ -0,0 +1,151 @@
+"""Striped transfer throughput over an emulated high-latency link.
+
+Sends a `--size` MB file over loopback TCP with 1, 2, 4 and 8 data
+connections, through a proxy that delays everything by `--delay`
+milliseconds and keeps at most `--window` KB in flight per connection, so
+a single connection is limited to about window / delay, as a TCP stream
+over a long link is by its window. Run from the src directory with
+`python -m benchmarks.striped`.
+"""
+
+import argparse
+import filecmp
+import os
+import shutil
+import tempfile
+import time
+
+from twisted.internet import defer, protocol, reactor, task
+
+from communic8.transfer.striped import StripedConsumer, StripedSender
+
+
+class DelayedPipe(protocol.Protocol):
+    """One side of a proxied connection, delaying what it forwards"""
+
+    peer = None
+
+    def connectionMade(self):
+        self.in_flight = 0
+        self.paused = False
+        self.pending = []
+
+    def connect_peer(self, peer):
+        self.peer = peer
+        for data in self.pending:
+            self.forward(data)
+        self.pending = None
+
+    def dataReceived(self, data):
+        if self.peer is None:
+            self.pending.append(data)
+        else:
+            self.forward(data)
+
+    def forward(self, data):
+        self.in_flight += len(data)
+        reactor.callLater(self.factory.delay, self.deliver, data)
+        if self.in_flight >= self.factory.window and not self.paused:
+            self.paused = True
+            self.transport.pauseProducing()
+
+    def deliver(self, data):
+        self.in_flight -= len(data)
+        self.peer.transport.write(data)
+        if self.paused and self.in_flight < self.factory.window:
+            self.paused = False
+            self.transport.resumeProducing()
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self.peer is not None:
+            reactor.callLater(self.factory.delay,
+                              self.peer.transport.loseConnection)
+
+
+class DelayProxy(protocol.ServerFactory):
+    protocol = DelayedPipe
+
+    def __init__(self, host, port, delay, window):
+        self.host = host
+        self.port = port
+        self.delay = delay
+        self.window = window
+
+    def buildProtocol(self, addr):
+        incoming = protocol.ServerFactory.buildProtocol(self, addr)
+
+        def connected(outgoing):
+            outgoing.factory = self
+            outgoing.connect_peer(incoming)
+            incoming.connect_peer(outgoing)
+
+        protocol.ClientCreator(reactor, DelayedPipe) \
+            .connectTCP(self.host, self.port).addCallback(connected)
+        return incoming
+
+
+@defer.inlineCallbacks
+def run(path, size, streams, args):
+    destination = os.path.join(args.directory, 'received')
+    consumer = StripedConsumer(destination, size, interface='127.0.0.1',
+                               range_size=args.range_size * 1024)
+    received = consumer.registerProducer(None, True)
+
+    proxy = reactor.listenTCP(
+        0, DelayProxy('127.0.0.1', consumer.port, args.delay / 1000.0,
+                      args.window * 1024),
+        interface='127.0.0.1')
+
+    sender = StripedSender(path, size, '127.0.0.1', proxy.getHost().port,
+                           consumer.token, streams,
+                           args.range_size * 1024)
+    started_at = time.time()
+    yield sender.start()
+    yield received
+    elapsed = time.time() - started_at
+
+    yield proxy.stopListening()
+    if not filecmp.cmp(path, destination, shallow=False):
+        raise RuntimeError("Received file differs from the original")
+
+    defer.returnValue(elapsed)
+
+
+@defer.inlineCallbacks
+def main(reactor):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--size', type=int, default=32,
+                        help="File size in MB")
+    parser.add_argument('-d', '--delay', type=float, default=20,
+                        help="One way delay in milliseconds")
+    parser.add_argument('-w', '--window', type=int, default=256,
+                        help="Bytes in flight per connection, in KB")
+    parser.add_argument('--range-size', type=int, default=1024,
+                        help="Range size in KB")
+    parser.add_argument('-n', '--streams', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    size = args.size * 1024 * 1024
+    args.directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(args.directory, 'original')
+        with open(path, 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for _ in xrange(args.size):
+                f.write(block)
+
+        print '{0:>8} {1:>10} {2:>10} {3:>8}'.format(
+            'streams', 'seconds', 'MB/s', 'speedup')
+        baseline = None
+        for streams in args.streams:
+            elapsed = yield run(path, size, streams, args)
+            baseline = baseline or elapsed
+            print '{0:>8} {1:>10.3f} {2:>10.1f} {3:>7.1f}x'.format(
+                streams, elapsed, args.size / elapsed, baseline / elapsed)
+    finally:
+        shutil.rmtree(args.directory)
+
+
+if __name__ == '__main__':
+    task.react(main)
@@ -0,0 +1,89 @@
+"""Cost of response timeouts with many requests in flight.
+
+Sends `--count` pipelined requests without answering them, runs a reactor
+iteration with all of them pending, then answers them all. Compares the
+shared timer wheel with a reactor delayed call per request, as
+`send_message` used to schedule them. Run from the src directory with
+`python -m benchmarks.timeouts`.
+"""
+
+import argparse
+import gc
+import time
+
+from twisted.internet import address, reactor
+from twisted.test.proto_helpers import StringTransport
+
+from communic8.model.messages import Heartbeat
+from communic8.protocol import CommonProtocol
+
+
+class ReactorTimeouts(object):
+    """One reactor delayed call per timeout"""
+
+    def call_later(self, delay, f, *args, **kwargs):
+        return reactor.callLater(delay, f, *args, **kwargs)
+
+
+def make_protocol(timeouts):
+    peer = address.IPv4Address('TCP', '127.0.0.1', 40000)
+    proto = CommonProtocol()
+    proto.makeConnection(StringTransport(peerAddress=peer))
+    proto.features = frozenset(['pipeline'])
+    proto.log = lambda *args, **kwargs: None
+    if timeouts is not None:
+        proto.timeouts = timeouts
+
+    return proto
+
+
+def run(timeouts, count):
+    proto = make_protocol(timeouts)
+    message = Heartbeat()
+    results = {}
+
+    gc.collect()
+    start = time.time()
+    for n in xrange(count):
+        proto.send_message(message)
+        if n % 1000 == 0:
+            proto.transport.clear()
+    results['send'] = time.time() - start
+    results['delayed_calls'] = len(reactor.getDelayedCalls())
+
+    start = time.time()
+    reactor.iterate(0)
+    results['iterate'] = time.time() - start
+
+    start = time.time()
+    for request_id in proto.pending_responses.keys():
+        proto.response_received({}, request_id)
+    results['respond'] = time.time() - start
+
+    # Let the reactor drop cancelled calls before the next run
+    start = time.time()
+    reactor.iterate(0)
+    results['cleanup'] = time.time() - start
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=50000)
+    parser.add_argument('-r', '--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print '{0:<16} {1:>9} {2:>9} {3:>9} {4:>9} {5:>13}'.format(
+        '', 'send', 'iterate', 'respond', 'cleanup', 'delayed calls')
+    for name, timeouts in [('callLater', ReactorTimeouts()),
+                           ('timer wheel', None)]:
+        runs = [run(timeouts, args.count) for _ in range(args.repeat)]
+        best = dict((key, min(r[key] for r in runs)) for key in runs[0])
+        print ('{0:<16} {1[send]:>8.3f}s {1[iterate]:>8.4f}s '
+               '{1[respond]:>8.3f}s {1[cleanup]:>8.4f}s '
+               '{1[delayed_calls]:>13}').format(name, best)
+
+
+if __name__ == '__main__':
+    main()
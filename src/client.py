@@ -52,6 +52,9 @@ class CommandProcessor(Cmd):
     def do_list_users(self, line):
         self.protocol.request_user_list()
 
+    def do_subscribe(self, line):
+        self.wait_call(self.protocol.subscribe_presence)
+
     def do_initiate(self, line):
         self.wait_call(self.protocol.chat_initiate, line)
 
@@ -54,7 +54,13 @@ class CommandProcessor(Cmd):
         self.wait_call(self.protocol.send_chat, line)
 
     def do_send_file(self, line):
-        transfer = client.TransferFile.from_path(line)
+        # send_file <path> [streams]
+        path, streams = line, 1
+        parts = line.rsplit(None, 1)
+        if len(parts) == 2 and parts[1].isdigit():
+            path, streams = parts[0], max(1, int(parts[1]))
+
+        transfer = client.TransferFile.from_path(path, streams=streams)
         self.wait_call(self.protocol.send_file, transfer)
 
     def do_quit(self, line):
@@ -1,5 +1,5 @@
 from itertools import chain
-import time
+import calendar
 from datetime import datetime
 
 
@@ -7,10 +7,190 @@ class MessageError(RuntimeError):
     pass
 
 
+class Field(object):
+    """An argument of a message, stored in the attribute `name`.
+
+    Arguments are separated by single spaces, except a `tail` field, which
+    must come last and takes the rest of the line, spaces included.
+    Optional fields must come after all of the required ones.
+    """
+
+    __slots__ = ('name', 'type', 'tail', 'optional')
+
+    def __init__(self, name, type=str, tail=False, optional=False):
+        self.name = name
+        self.type = type
+        self.tail = tail
+        self.optional = optional
+
+
+def _generated_methods(cls):
+    """Source of the methods specialized for the fields of `cls`, and the
+    names it refers to"""
+
+    fields = cls.fields
+    names = [f.name for f in fields]
+    total = len(fields)
+    required = cls.required_args
+    namespace = {'MessageError': MessageError}
+
+    def convert(n, field):
+        if field.type is str:
+            return 'args[{0}]'.format(n)
+
+        namespace['_type_{0}'.format(n)] = field.type
+        return '_type_{0}(args[{0}])'.format(n)
+
+    def parser(name, wrap):
+        lines = ['def {0}(cls, s):'.format(name)]
+        if not cls.parse_args:
+            lines.append('    return {0}'.format(wrap('s')))
+            return lines
+
+        if not fields:
+            lines += ['    if s:',
+                      '        raise MessageError('
+                      '"Invalid number of arguments for message")',
+                      '    return {0}'.format(wrap(''))]
+            return lines
+
+        split = "s.split(' ', {0})".format(total - 1) if fields[-1].tail \
+            else "s.split(' ')"
+        check = 'len(args) != {0}'.format(total) if required == total else \
+            'not {0} <= len(args) <= {1}'.format(required, total)
+        lines += ['    args = {0} if s else []'.format(split),
+                  '    if {0}:'.format(check),
+                  '        raise MessageError('
+                  '"Invalid number of arguments for message")',
+                  '    try:']
+        for count in range(required, total):
+            lines.append('        if len(args) == {0}:'.format(count))
+            lines.append('            return {0}'.format(wrap(', '.join(
+                convert(n, f) for n, f in enumerate(fields[:count])))))
+        lines += ['        return {0}'.format(wrap(', '.join(
+                      convert(n, f) for n, f in enumerate(fields)))),
+                  '    except ValueError:',
+                  '        raise MessageError("Failed to parse argument")']
+        return lines
+
+    values = ''.join('self.{0}, '.format(name) for name in names)
+    other_values = ''.join('other.{0}, '.format(name) for name in names)
+
+    methods = {
+        '__init__': ['def __init__(self{0}):'.format(''.join(
+                         ', {0}=None'.format(f.name) if f.optional else
+                         ', ' + f.name for f in fields))] +
+                    (['    self.{0} = {0}'.format(name) for name in names] or
+                     ['    pass']),
+        'args_from_string': parser('args_from_string',
+                                   lambda args: '[{0}]'.format(args)),
+        'from_string': parser('from_string',
+                              lambda args: 'cls({0})'.format(args)),
+        '__eq__': ['def __eq__(self, other):',
+                   '    return type(other) is type(self) and '
+                   '({0}) == ({1})'.format(values, other_values)],
+        '__ne__': ['def __ne__(self, other):',
+                   '    return not self == other'],
+        '__hash__': ['def __hash__(self):',
+                     '    return hash((type(self), {0}))'.format(values)],
+        '__repr__': ['def __repr__(self):',
+                     '    return {0!r} % ({1})'.format(
+                         '{0}({1})'.format(cls.__name__, ', '.join(
+                             '{0}=%r'.format(name) for name in names)),
+                         values)]
+    }
+
+    if not any(f.optional for f in fields):
+        methods['args'] = ['def args(self):',
+                           '    return ({0})'.format(values)]
+
+        # Formatting the fields straight away skips building the tuple of
+        # arguments, unless a class computes them itself
+        line_format = repr(cls.command + ' %s' * total)
+        if 'args' not in cls.__dict__:
+            methods['__str__'] = ['def __str__(self):',
+                                  '    return {0} % ({1})'.format(
+                                      line_format, values)]
+        elif cls.parse_args:
+            methods['__str__'] = ['def __str__(self):',
+                                  '    return {0} % self.args()'.format(
+                                      line_format)]
+    else:
+        lines = ['def args(self):']
+        for count in range(total, required, -1):
+            lines.append('    if self.{0} is not None:'.format(
+                names[count - 1]))
+            lines.append('        return ({0})'.format(''.join(
+                'self.{0}, '.format(name) for name in names[:count])))
+        lines.append('    return ({0})'.format(''.join(
+            'self.{0}, '.format(name) for name in names[:required])))
+        methods['args'] = lines
+
+    return methods, namespace
+
+
+class MessageType(type):
+    """Builds message classes from their declared `fields`.
+
+    A class with a `fields` list gets `__slots__` for them, the matching
+    `arg_types`, `required_args` and `parse_args`, and generated `__init__`,
+    argument parsing and serialization, equality and `repr`. Methods a class
+    defines itself are kept.
+    """
+
+    def __new__(mcs, name, bases, attrs):
+        fields = attrs.get('fields')
+        if fields is not None:
+            attrs['fields'] = fields = tuple(fields)
+            if any(f.tail for f in fields[:-1]):
+                raise TypeError("Only the last field can be a tail")
+            if any(f.optional and not later.optional
+                   for f, later in zip(fields, fields[1:])):
+                raise TypeError("Optional fields must come last")
+
+            attrs.setdefault('__slots__', tuple(f.name for f in fields))
+            attrs.setdefault('arg_types', tuple(f.type for f in fields))
+            attrs.setdefault('required_args',
+                             sum(1 for f in fields if not f.optional))
+            attrs.setdefault('parse_args',
+                             not (len(fields) == 1 and fields[0].tail))
+
+        return super(MessageType, mcs).__new__(mcs, name, bases, attrs)
+
+    def __init__(cls, name, bases, attrs):
+        super(MessageType, cls).__init__(name, bases, attrs)
+        if attrs.get('fields') is None:
+            return
+
+        methods, namespace = _generated_methods(cls)
+        for method_name, lines in methods.iteritems():
+            if method_name in attrs:
+                continue
+
+            source = '\n'.join(lines) + '\n'
+            code = compile(source, '<{0}.{1}>'.format(name, method_name),
+                           'exec')
+            exec code in namespace
+            f = namespace.pop(method_name)
+            if method_name in ('args_from_string', 'from_string'):
+                f = classmethod(f)
+
+            setattr(cls, method_name, f)
+
+
 class Message(object):
+    __metaclass__ = MessageType
+    __slots__ = ()
+
+    # Declared arguments, a list of `Field`; None for classes that define
+    # the attributes below and their methods by hand
+    fields = None
     arg_types = ()
+    # Number of leading arguments that must be present, None for all of them
+    required_args = None
     parse_args = True
     command = 'NOP'
+    opcode = 0
 
     def __init__(self):
         pass
@@ -21,7 +201,11 @@ class Message(object):
             return [s]
 
         args = s.split(" ") if s else []
-        if len(args) != len(cls.arg_types):
+        required = cls.required_args
+        if required is None:
+            required = len(cls.arg_types)
+
+        if not required <= len(args) <= len(cls.arg_types):
             raise MessageError("Invalid number of arguments for message")
 
         try:
@@ -30,6 +214,10 @@ class Message(object):
         except ValueError:
             raise MessageError("Failed to parse argument")
 
+    @classmethod
+    def from_string(cls, s):
+        return cls(*cls.args_from_string(s))
+
     def args(self):
         return []
 
@@ -40,15 +228,23 @@ class Message(object):
 class MessageDispatcher(object):
     def __init__(self):
         self.types = {}
+        self.opcodes = {}
 
     def register(self, *types):
         for type_ in types:
-            if type_.command in self.types:
+            if type_.command in self.types or type_.opcode in self.opcodes:
                 raise MessageError("Message type is already registered")
 
         self.types.update((type_.command, type_) for type_ in types)
+        self.opcodes.update((type_.opcode, type_) for type_ in types)
         return self
 
+    def type_for_opcode(self, opcode):
+        try:
+            return self.opcodes[opcode]
+        except KeyError:
+            raise MessageError("Invalid opcode")
+
     def parse(self, s):
         parts = s.split(' ', 1)
         command = parts[0]
@@ -59,97 +255,91 @@ class MessageDispatcher(object):
         except KeyError:
             raise MessageError("Invalid command")
 
-        return type_(*type_.args_from_string(args))
+        return type_.from_string(args)
 
 
 class Connect(Message):
     command = "CONNECT"
-    arg_types = ()
+    opcode = 1
+    fields = [Field('features', tail=True)]
+
+    def __init__(self, features=()):
+        if isinstance(features, basestring):
+            features = features.split()
+
+        self.features = tuple(features)
+
+    def args(self):
+        return (' '.join(self.features), ) if self.features else ()
 
 
 class Quit(Message):
     command = "QUIT"
-    arg_types = ()
+    opcode = 2
+    fields = []
 
 
 class Login(Message):
     command = "LOGIN"
-    arg_types = (str, )
-
-    def __init__(self, user):
-        super(Login, self).__init__()
-        self.user = user
-
-    def args(self):
-        return self.user,
+    opcode = 3
+    fields = [Field('user')]
 
 
 class Logout(Message):
     command = "LOGOUT"
-    arg_types = ()
+    opcode = 4
+    fields = []
 
 
 class ListUsers(Message):
     command = "LIST_USERS"
-    arg_types = ()
+    opcode = 5
+    fields = [Field('offset', int, optional=True),
+              Field('limit', int, optional=True)]
 
+    def args(self):
+        if self.limit is not None:
+            return self.offset or 0, self.limit
+        elif self.offset is not None:
+            return self.offset,
 
-class RequestChat(Message):
-    command = "REQUEST_CHAT"
-    arg_types = (str, )
+        return ()
 
-    def __init__(self, user):
-        super(RequestChat, self).__init__()
-        self.user = user
 
-    def args(self):
-        return self.user,
+class RequestChat(Message):
+    command = "REQUEST_CHAT"
+    opcode = 6
+    fields = [Field('user')]
 
 
 class ChatRequested(Message):
     command = "CHAT_REQUESTED"
-    arg_types = (str, )
-
-    def __init__(self, user):
-        super(ChatRequested, self).__init__()
-        self.user = user
-
-    def args(self):
-        return self.user,
+    opcode = 7
+    fields = [Field('user')]
 
 
 class SendChat(Message):
     command = "SEND_CHAT"
-    arg_types = (str, )
-    parse_args = False
-
-    def __init__(self, message):
-        super(SendChat, self).__init__()
-        self. message = message
-
-    def args(self):
-        return self.message,
+    opcode = 8
+    fields = [Field('message', tail=True)]
 
 
 class EndChat(Message):
     command = "END_CHAT"
-    arg_types = (str,)
-
-    def __init__(self, user):
-        super(EndChat, self).__init__()
-        self.user = user
-
-    def args(self):
-        return self.user,
+    opcode = 9
+    fields = [Field('user')]
 
 
 class RequestFileTransfer(Message):
     command = "REQUEST_FILE_TRANSFER"
-    arg_types = (str, str, long, long, int)
-    parse_args = True
-
-    def __init__(self, name, mime_type, mtime, size, block_size):
-        super(RequestFileTransfer, self).__init__()
+    opcode = 10
+    fields = [Field('name'), Field('mime_type'), Field('mtime', long),
+              Field('size', long), Field('block_size', int),
+              Field('streams', int, optional=True),
+              Field('root_hash', optional=True)]
+
+    def __init__(self, name, mime_type, mtime, size, block_size,
+                 streams=None, root_hash=None):
         self.name = name
         self.mime_type = mime_type
 
@@ -160,10 +350,130 @@ class RequestFileTransfer(Message):
 
         self.size = size
         self.block_size = block_size
+        self.streams = streams
+        self.root_hash = root_hash
 
     def mtime_timestamp(self):
-        return long(time.mktime(self.mtime.timetuple()))
+        # mtime is in UTC, as parsed by utcfromtimestamp
+        return long(calendar.timegm(self.mtime.utctimetuple()))
 
     def args(self):
-        return (self.name, self.mime_type, self.mtime_timestamp(), self.size,
+        args = (self.name, self.mime_type, self.mtime_timestamp(), self.size,
                 self.block_size)
+        if self.root_hash is not None:
+            args += (self.streams or 1, self.root_hash)
+        elif self.streams is not None:
+            args += (self.streams, )
+
+        return args
+
+
+class BlockHashes(Message):
+    command = "BLOCK_HASHES"
+    opcode = 22
+    fields = [Field('level', int), Field('first', long), Field('count', int)]
+
+
+class ResendBlocks(Message):
+    command = "RESEND_BLOCKS"
+    opcode = 23
+    fields = [Field('blocks', tail=True)]
+
+    def __init__(self, blocks):
+        if isinstance(blocks, basestring):
+            try:
+                blocks = map(long, blocks.split())
+            except ValueError:
+                raise MessageError("Failed to parse argument")
+
+        self.blocks = tuple(blocks)
+
+    def args(self):
+        return ' '.join(map(str, self.blocks)),
+
+
+class EndTransfer(Message):
+    command = "END_TRANSFER"
+    opcode = 24
+    fields = [Field('result')]
+
+
+class BlockChecksums(Message):
+    command = "BLOCK_CHECKSUMS"
+    opcode = 25
+    fields = [Field('first', long), Field('count', int)]
+
+
+class StartDelta(Message):
+    command = "START_DELTA"
+    opcode = 26
+    fields = []
+
+
+class SubscribePresence(Message):
+    command = "SUBSCRIBE_PRESENCE"
+    opcode = 16
+    fields = []
+
+
+class UnsubscribePresence(Message):
+    command = "UNSUBSCRIBE_PRESENCE"
+    opcode = 17
+    fields = []
+
+
+class UserJoined(Message):
+    command = "USER_JOINED"
+    opcode = 18
+    fields = [Field('version', long), Field('user'), Field('connected_at')]
+
+
+class UserLeft(Message):
+    command = "USER_LEFT"
+    opcode = 19
+    fields = [Field('version', long), Field('user')]
+
+
+class Heartbeat(Message):
+    command = "HEARTBEAT"
+    opcode = 20
+    fields = []
+
+
+class Stats(Message):
+    command = "STATS"
+    opcode = 21
+    fields = []
+
+# Messages exchanged between server workers and their coordinator
+
+class ClaimUser(Message):
+    command = "CLAIM_USER"
+    opcode = 11
+    fields = [Field('user'), Field('host'), Field('port', int)]
+
+
+class ReleaseUser(Message):
+    command = "RELEASE_USER"
+    opcode = 12
+    fields = [Field('user')]
+
+
+class UserClaimed(Message):
+    command = "USER_CLAIMED"
+    opcode = 13
+    fields = [Field('user'), Field('host'), Field('port', int),
+              Field('connected_at')]
+
+
+class UserReleased(Message):
+    command = "USER_RELEASED"
+    opcode = 14
+    fields = [Field('user')]
+
+
+class RouteEvent(Message):
+    command = "ROUTE_EVENT"
+    opcode = 15
+    # The JSON payload may contain spaces, so it takes the rest of the line
+    fields = [Field('user'), Field('event'), Field('payload', tail=True)]
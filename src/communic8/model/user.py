@@ -1,10 +1,19 @@
+import json
+import time
 from datetime import datetime
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
+from operator import attrgetter
 
 
 User = namedtuple('User', 'name host port connected_at')
 
 
+def parse_timestamp(s):
+    # isoformat() leaves out the microseconds when they are zero
+    fmt = '%Y-%m-%dT%H:%M:%S.%f' if '.' in s else '%Y-%m-%dT%H:%M:%S'
+    return datetime.strptime(s, fmt)
+
+
 class UserDatabaseError(RuntimeError):
     pass
 
@@ -21,11 +30,61 @@ class UserNotLoggedIn(UserDatabaseError, KeyError):
     pass
 
 
+class UserListSnapshot(object):
+    """The user list at one generation of the database, encoded once.
+
+    Users are sorted by name, so pages taken from the same generation never
+    overlap or skip anyone.
+    """
+
+    # Clients choose the offset and limit, so only the pages a client paging
+    # through the list would ask for are kept, and not too many of them
+    max_cached_pages = 64
+
+    def __init__(self, generation, users):
+        self.generation = generation
+        self.entries = [
+            json.dumps({'name': user.name,
+                        'connected_at': user.connected_at.isoformat()})
+            for user in sorted(users, key=attrgetter('name'))]
+        self._pages = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def page(self, offset=0, limit=None):
+        """Encoded JSON list of up to `limit` users starting at `offset`"""
+
+        key = (offset, limit)
+        try:
+            return self._pages[key]
+        except KeyError:
+            pass
+
+        end = None if limit is None else offset + limit
+        encoded = '[' + ', '.join(self.entries[offset:end]) + ']'
+
+        if offset == 0 or (offset < len(self.entries) and limit and
+                           offset % limit == 0):
+            if len(self._pages) >= self.max_cached_pages:
+                self._pages.popitem(last=False)
+
+            self._pages[key] = encoded
+
+        return encoded
+
+
 class UserDatabase(object):
     def __init__(self):
         self._users = {}
         self._users_by_address = {}
+        # Seconds since the epoch of the last traffic from each user
         self._last_seen = {}
+        self._observers = []
+        self._snapshot = None
+
+        # Bumped on every change to the set of users
+        self.generation = 0
 
     def __getitem__(self, name):
         try:
@@ -40,21 +99,52 @@ class UserDatabase(object):
         except KeyError:
             raise UserNotLoggedIn()
 
+        del self._last_seen[name]
+        self.generation += 1
+
+        for observer in self._observers:
+            observer.user_removed(user)
+
+    def __len__(self):
+        return len(self._users)
+
     def users(self):
         return self._users.itervalues()
 
-    def add(self, name, host, port):
+    def snapshot(self):
+        """Encoded user list, rebuilt at most once per generation"""
+
+        if self._snapshot is None or \
+           self._snapshot.generation != self.generation:
+            self._snapshot = UserListSnapshot(self.generation,
+                                              self._users.itervalues())
+
+        return self._snapshot
+
+    def add_observer(self, observer):
+        """Notify `observer.user_added` and `observer.user_removed` of changes"""
+        self._observers.append(observer)
+
+    def remove_observer(self, observer):
+        self._observers.remove(observer)
+
+    def add(self, name, host, port, connected_at=None):
         address = (host, port)
 
         if name in self._users:
             raise UserNameAlreadyUsed()
         elif address in self._users_by_address:
-            raise UserNameAlreadyUsed()
+            raise AddressAlreadyUsed()
 
-        user = User(name, host, port, datetime.now())
+        user = User(name, host, port, connected_at or datetime.now())
         self._users[user.name] = user
         self._users_by_address[address] = user
-        self._last_seen[user] = datetime.now()
+        self._last_seen[user.name] = time.time()
+        self.generation += 1
+
+        for observer in self._observers:
+            observer.user_added(user)
+
         return user
 
     def remove(self, name):
@@ -67,13 +157,15 @@ class UserDatabase(object):
         return self._users_by_address.get((host, port), default)
 
     def get_user_last_seen(self, name):
-        user = self[name]
-        return self._last_seen[user]
+        try:
+            return self._last_seen[name]
+        except KeyError:
+            raise UserNotLoggedIn()
 
-    def update_user_last_seen(self, name, time=None):
-        user = self[name]
-        time = time or datetime.now()
+    def update_user_last_seen(self, name, seen_at=None):
+        if name not in self._last_seen:
+            raise UserNotLoggedIn()
 
-        self._last_seen[user] = time
+        self._last_seen[name] = seen_at or time.time()
 
 
@@ -5,52 +5,181 @@ from twisted.internet import defer, task, reactor
 from twisted.internet.protocol import connectionDone, DatagramProtocol, Factory, \
     ClientFactory
 from twisted.protocols.basic import LineReceiver
-from twisted.python import log
+from twisted.python.failure import Failure
 from fysom import FysomError, Canceled
 
-from communic8.model.messages import MessageError
+from communic8.model.messages import MessageError, MessageDispatcher, Connect
+from communic8.protocol.codec import CodecError, text_codec, binary_codec
+from communic8.protocol.instrumentation import protocol_metrics
+from communic8.util.logger import get_logger
+from communic8.util.timers import shared_wheel
+
+
+# A line per message and response sent or received, off unless debugging
+traffic_log = get_logger('traffic')
 
 
 class ProtocolError(RuntimeError):
     pass
 
 
+def handles(*types):
+    """Mark a protocol method as the handler for the given message types"""
+
+    def decorator(f):
+        f.handled_messages = types
+        return f
+
+    return decorator
+
+
+class MessageHandlers(object):
+    """Command to handler table of a protocol class, built from `handles`"""
+
+    def __init__(self, cls):
+        self.handlers = {}
+        types = []
+
+        for mro_cls in reversed(inspect.getmro(cls)):
+            for name, f in vars(mro_cls).items():
+                for type_ in getattr(f, 'handled_messages', ()):
+                    if type_.command not in self.handlers:
+                        types.append(type_)
+
+                    # Look the name up again so overrides are respected
+                    self.handlers[type_.command] = getattr(cls, name).__func__
+
+        self.dispatcher = MessageDispatcher().register(*types)
+
+    def dispatch(self, protocol, message):
+        try:
+            handler = self.handlers[message.command]
+        except KeyError:
+            raise MessageError("Unhandled message {0}".format(message.command))
+
+        return handler(protocol, message)
+
+
 class CommonProtocol(LineReceiver):
     ERROR_MESSAGES = {
         'INVALID_COMMAND': 'Invalid or unknown command',
         'INVALID_COMMAND_FOR_STATE': 'Invalid command {command} for state {state}'
     }
 
+    supported_features = ('pipeline', 'binary')
+    codec = text_codec
+    clock = reactor
+    log_category = 'protocol'
+    metrics = protocol_metrics
+
     def __init__(self):
         self.transport_connected = False
-        self.wait_response_deferred = None
+        self.features = frozenset()
+        self.frame_buffer = ''
+        self.pending_responses = {}
+        self.next_request_id = 1
+        self.current_request_id = None
+
+        # Response and other protocol timeouts only need to be accurate to
+        # about a second, which a wheel shared by all connections gives
+        # without a reactor delayed call per request
+        self.timeouts = shared_wheel(self.clock)
+
+        self.logger = get_logger(self.log_category)
+        self.traffic_log = traffic_log
+
+    @classmethod
+    def message_handlers(cls):
+        # Resolved once per class, subclasses get their own table
+        try:
+            return cls.__dict__['_message_handlers']
+        except KeyError:
+            cls._message_handlers = handlers = MessageHandlers(cls)
+            return handlers
 
     @property
     def message_dispatcher(self):
-        return None
+        return self.message_handlers().dispatcher
+
+    @property
+    def pipelined(self):
+        return 'pipeline' in self.features
+
+    def log_prefix(self):
+        return "{a.type}:{a.port} - ".format(a=self.transport.getPeer())
 
     def log(self, fmt, *args, **kwargs):
-        prefix = "{a.type}:{a.port} - ".format(a=self.transport.getPeer())
-        log.msg(prefix + fmt.format(*args, **kwargs))
+        self.logger.info(fmt, *args, **kwargs)
 
     def is_transport_udp(self):
         return self.transport.getHost().type == 'UDP'
 
+    def accept_features(self, requested):
+        return sorted(set(requested) & set(self.supported_features))
+
+    def enable_features(self, features):
+        self.features = frozenset(features) & frozenset(self.supported_features)
+        if self.features:
+            self.log("Enabled features: {0}", ', '.join(sorted(self.features)))
+
+        if 'binary' in self.features:
+            self.codec = binary_codec
+
+    def send_connect(self, callback=None, **kwargs):
+        def on_response(response):
+            if not self.check_response_error(response):
+                self.enable_features(response.get('features', ()))
+
+            return response
+
+        def on_legacy_response(response):
+            # Peers that predate feature negotiation reject CONNECT with
+            # arguments, so fall back to a plain one
+            if response.get('error') == 'INVALID_COMMAND':
+                self.log("Peer does not support feature negotiation")
+                return self.send_message(Connect(), on_response, **kwargs)
+
+            return on_response(response)
+
+        if self.supported_features:
+            d = self.send_message(Connect(self.supported_features),
+                                  on_legacy_response, **kwargs)
+        else:
+            d = self.send_message(Connect(), on_response, **kwargs)
+
+        if callback:
+            d.addCallback(callback)
+
+        return d
+
     def send_message(self, message, callback=None, timeout=10,
                      timeout_callback=None):
-        if self.wait_response_deferred is not None:
+        if self.pipelined:
+            request_id = self.next_request_id
+            self.next_request_id += 1
+        elif self.pending_responses:
             raise ProtocolError(
                 "Cannot send message while waiting for response")
+        else:
+            request_id = None
 
-        self.log("Sending message '{msg}'", msg=message)
-        #self.log("Sending message {cmd}", cmd=message.command)
+        self.traffic_log.debug("Sending message '{msg}'", msg=message)
 
-        self.transport.write(str(message) + '\r\n')
+        data = self.codec.encode_message(message, request_id)
+        self.write_encoded(data, message)
 
-        self.wait_response_deferred = d = defer.Deferred()
+        metrics = self.metrics
+        key = (self.log_category, message.command)
+        metrics.sent.inc(key)
+        metrics.bytes_out.inc(self.log_category, len(data))
+        sent_at = metrics.now()
+
+        self.pending_responses[request_id] = d = defer.Deferred()
 
         def on_finish(result):
-            self.wait_response_deferred = None
+            self.pending_responses.pop(request_id, None)
+            if not isinstance(result, Failure):
+                metrics.response_seconds.observe(key, metrics.now() - sent_at)
             return result
 
         d.addBoth(on_finish)
@@ -59,35 +188,61 @@ class CommonProtocol(LineReceiver):
             d.addCallback(callback)
 
         if timeout:
-            delayed_call = reactor.callLater(timeout, d.cancel)
+            timer = self.timeouts.call_later(timeout, d.cancel)
 
             def on_cancel(failure):
                 failure.trap(defer.CancelledError)
                 self.log("Timeout waiting for message response")
+                metrics.timeouts.inc(key)
                 return failure
 
             d.addErrback(on_cancel)
 
             def on_result(result):
-                if delayed_call.active():
-                    delayed_call.cancel()
+                timer.cancel()
                 return result
 
             d.addBoth(on_result)
 
         return d
 
-    def send_response(self, data):
-        if self.wait_response_deferred is not None:
+    def send_notification(self, message):
+        """Send a message that is not answered, even with requests pending"""
+
+        self.traffic_log.debug("Sending notification '{msg}'", msg=message)
+
+        data = self.codec.encode_message(message)
+        self.write_encoded(data, message)
+
+        self.metrics.sent.inc((self.log_category, message.command))
+        self.metrics.bytes_out.inc(self.log_category, len(data))
+
+    def send_response(self, data, request_id=None):
+        if not self.pipelined and self.pending_responses:
             raise ProtocolError(
                 "Cannot send response while waiting for another")
 
+        if request_id is None:
+            request_id = self.current_request_id
+
         data = dict(data)
         data.update(state=self.current)
 
-        js = json.dumps(data)
-        self.log("Sending response {data}", data=js)
-        self.transport.write(js + '\r\n')
+        self.traffic_log.debug("Sending response {data}", data=data)
+
+        encoded = self.codec.encode_response(data, request_id)
+        self.write_encoded(encoded)
+
+        metrics = self.metrics
+        metrics.responses.inc(self.log_category)
+        metrics.bytes_out.inc(self.log_category, len(encoded))
+        if 'error' in data:
+            metrics.errors.inc((self.log_category, data['error']))
+
+    def write_encoded(self, data, message=None):
+        """Write an encoded message, or a response if `message` is None"""
+
+        self.transport.write(data)
 
     @classmethod
     def error_type_message(cls, key):
@@ -101,6 +256,7 @@ class CommonProtocol(LineReceiver):
             return None
 
     def send_error_response(self, key, message=None, *args, **kwargs):
+        request_id = kwargs.pop('request_id', None)
         if not message:
             message = self.error_type_message(key)
             if message:
@@ -108,18 +264,37 @@ class CommonProtocol(LineReceiver):
             else:
                 message = key
 
-        self.log("Sending error response {key}".format(key=key))
+        self.log("Sending error response {key}", key=key)
 
-        return self.send_response({'error': key, 'message': message})
+        return self.send_response({'error': key, 'message': message},
+                                  request_id=request_id)
 
     def check_response_error(self, response):
         return 'error' in response
 
     def on_message_received(self, message):
-        pass
+        self.message_handlers().dispatch(self, message)
+
+    def on_change_state(self, event):
+        # Called by Fysom subclasses on every change of state
+        metrics = self.metrics
+        metrics.transitions.inc((self.log_category, event.event))
+
+        if event.src not in ('none', 'done'):
+            metrics.states.dec((self.log_category, event.src))
+        if event.dst != 'done':
+            metrics.states.inc((self.log_category, event.dst))
 
     # Twisted callbacks
 
+    def makeConnection(self, transport):
+        # The peer does not change, so its prefix is formatted once
+        self.transport = transport
+        prefix = self.log_prefix()
+        self.logger = get_logger(self.log_category).bind(prefix)
+        self.traffic_log = traffic_log.bind(prefix)
+        LineReceiver.makeConnection(self, transport)
+
     def connectionMade(self):
         LineReceiver.connectionMade(self)
         self.transport_connected = True
@@ -132,33 +307,115 @@ class CommonProtocol(LineReceiver):
 
         self.log("Transport disconnected")
 
-    def lineReceived(self, line):
-        self.log('received "{line}"', line=line)
-        if self.wait_response_deferred:
-            self.log("Received response")
+    def dataReceived(self, data):
+        self.metrics.bytes_in.inc(self.log_category, len(data))
 
-            response = json.loads(line)
-            self.wait_response_deferred.callback(response)
-            self.wait_response_deferred = None
-        else:
+        if not self.codec.framed:
+            return LineReceiver.dataReceived(self, data)
+
+        if not self.line_mode:
+            return self.rawDataReceived(data)
+
+        # Frames are held while paused, as LineReceiver holds lines
+        if self.paused:
+            self.frame_buffer += data
+            return
+
+        self.frames_received(self.frame_buffer + data)
+
+    def frames_received(self, data):
+        # Frames are split one at a time, as one can switch the connection
+        # to raw mode, in which case whatever follows it is not framed
+        offset = 0
+        while self.line_mode and not self.paused:
             try:
-                message = self.message_dispatcher.parse(line)
-            except MessageError:
-                self.send_error_response('INVALID_COMMAND')
+                frame = self.codec.next_frame(data, offset)
+            except CodecError as e:
+                self.log("Dropping connection: {e}", e=e)
+                self.frame_buffer = ''
+                self.transport.loseConnection()
                 return
 
-            self.log("Received message {cmd}", cmd=message.command)
+            if frame is None:
+                break
 
-            try:
-                self.on_message_received(message)
-            except Canceled:
-                # The pre-transition handlers is responsible for returning an
-                # error response if it cancels the transition
-                pass
-            except FysomError:
-                self.send_error_response('INVALID_COMMAND_FOR_STATE', None,
-                                         command=message.command,
-                                         state=self.current)
+            body, offset = frame
+            self.frame_received(body)
+
+        rest = data[offset:]
+        if self.line_mode:
+            self.frame_buffer = rest
+        else:
+            self.frame_buffer = ''
+            if rest:
+                self.rawDataReceived(rest)
+
+    def lineReceived(self, line):
+        self.frame_received(line)
+
+        # Switching to a framed codec leaves the remainder of the line buffer
+        # to be parsed with it
+        if self.codec.framed and self.line_mode:
+            rest = self.clearLineBuffer()
+            if rest:
+                self.frames_received(rest)
+
+    def frame_received(self, frame):
+        self.traffic_log.debug('received "{frame!r}"', frame=frame)
+
+        try:
+            is_response, request_id, body = self.codec.split_frame(frame)
+        except MessageError:
+            self.send_error_response('INVALID_COMMAND')
+            return
+
+        if is_response:
+            self.response_received(self.codec.decode_response(body),
+                                   request_id)
+        else:
+            self.message_frame_received(body, request_id)
+
+    def response_received(self, response, request_id=None):
+        if not self.pipelined:
+            request_id = None
+
+        try:
+            d = self.pending_responses[request_id]
+        except KeyError:
+            self.log("Discarding unexpected response")
+            return
+
+        self.traffic_log.debug("Received response")
+        d.callback(response)
+
+    def message_frame_received(self, body, request_id=None):
+        try:
+            message = self.codec.decode_message(body, self.message_dispatcher)
+        except MessageError:
+            self.send_error_response('INVALID_COMMAND', request_id=request_id)
+            return
+
+        self.traffic_log.debug("Received message {cmd}", cmd=message.command)
+
+        metrics = self.metrics
+        key = (self.log_category, message.command)
+        metrics.received.inc(key)
+        started_at = metrics.now()
+
+        self.current_request_id = request_id
+        try:
+            self.on_message_received(message)
+        except Canceled:
+            # The pre-transition handlers is responsible for returning an
+            # error response if it cancels the transition
+            pass
+        except FysomError:
+            self.send_error_response('INVALID_COMMAND_FOR_STATE', None,
+                                     command=message.command,
+                                     state=self.current)
+        finally:
+            self.current_request_id = None
+            metrics.handler_seconds.observe(key, metrics.now() - started_at)
 
 
 class CommonFactory(Factory):
@@ -1,20 +1,41 @@
 import os
+import calendar
 from collections import namedtuple
-import itertools
 import mimetypes
+import stat
+import tempfile
 
 from zope.interface import implements
-from twisted.internet import interfaces, defer
+from twisted.internet import interfaces, defer, threads
+from twisted.internet.error import CannotListenError
 from twisted.internet.protocol import connectionDone, Factory
-from twisted.web.client import FileBodyProducer
+from twisted.python.failure import Failure
 
 from communic8.model.messages import *
-from communic8.protocol import CommonProtocol
+from communic8.protocol import CommonProtocol, handles
+from communic8.protocol.codec import CodecError
+from communic8.protocol.mux import CHAT, CONTROL, FILE, Multiplexer, \
+    MuxError
+from communic8.transfer.compression import COMPRESSION, \
+    CompressingSender, DecompressingConsumer, is_compressible
+from communic8.transfer.dedup import ContentIndex, link_or_copy
+from communic8.transfer.delta import BasisChecksums, DeltaConsumer, \
+    DeltaError, DeltaSender, checksum_file, compute_delta, \
+    delta_block_size, literal_size
+from communic8.transfer.flow import Window
+from communic8.transfer.integrity import BlockHasher, IntegrityError, \
+    MerkleTree, block_count, block_range, find_corrupted
+from communic8.transfer.mapped import MappedFileConsumer, MappingError
+from communic8.transfer.pipeline import WriteBehind
+from communic8.transfer.resume import PartialTransfers, is_journal_name
+from communic8.transfer.sender import file_sender
+from communic8.transfer.striped import StripedConsumer, StripedSender
 from communic8.util import Fysom
 
 
 class TransferFile(namedtuple('TransferFile',
-                              'name mime_type mtime size block_size path')):
+                              'name mime_type mtime size block_size path '
+                              'streams root_hash')):
     @classmethod
     def from_message(cls, message):
         if not isinstance(message, RequestFileTransfer):
@@ -22,10 +43,12 @@ class TransferFile(namedtuple('TransferFile',
 
         return cls(name=message.name, mime_type=message.mime_type,
                    mtime=message.mtime, size=message.size,
-                   block_size=message.block_size, path=None)
+                   block_size=message.block_size, path=None,
+                   streams=message.streams or 1,
+                   root_hash=message.root_hash)
 
     @classmethod
-    def from_path(cls, path, block_size=512):
+    def from_path(cls, path, block_size=512, streams=1):
         open(path, 'rb').close()
 
         name = os.path.basename(path)
@@ -37,12 +60,19 @@ class TransferFile(namedtuple('TransferFile',
         size = stat.st_size
 
         return cls(name=name, mime_type=mime_type, mtime=mtime, size=size,
-                   block_size=block_size, path=path)
+                   block_size=block_size, path=path, streams=streams,
+                   root_hash=None)
+
+    def mtime_timestamp(self):
+        return long(calendar.timegm(self.mtime.utctimetuple()))
 
     def to_message(self):
         return RequestFileTransfer(name=self.name, mime_type=self.mime_type,
                                    mtime=self.mtime, size=self.size,
-                                   block_size=self.block_size)
+                                   block_size=self.block_size,
+                                   streams=self.streams
+                                   if self.streams > 1 else None,
+                                   root_hash=self.root_hash)
 
 
 class TransferError(RuntimeError):
@@ -50,26 +80,60 @@ class TransferError(RuntimeError):
 
 
 class FileConsumer(object):
+    """Writes a transfer to `file_object`, starting at `offset`.
+
+    Writes are done behind the reactor by a `WriteBehind`, so a slow disk
+    does not hold it up. What is waiting to be written is kept in a
+    `Window` of `window_size` bytes, which pauses the producer when the
+    disk falls behind.
+
+    If given, `checkpoint` is called with the number of bytes safely
+    written every `checkpoint_interval` bytes, and when the transfer stops
+    before completion, and `hasher` is updated with everything received.
+
+    Once the last byte is received, `ended` is set and `write` returns
+    whatever followed it. The Deferred fires once all of it is written.
+    """
+
     implements(interfaces.IConsumer)
 
-    def __init__(self, file_object, size):
+    checkpoint_interval = 16 * 1024 * 1024
+
+    window_size = 4 * 1024 * 1024
+
+    def __init__(self, file_object, size, offset=0, checkpoint=None,
+                 hasher=None):
         assert size > 0
+        assert 0 <= offset < size
 
         try:
             file_object.truncate(size)
+            file_object.seek(offset)
         except (IOError, OSError):
             file_object.close()
             raise
 
-        self.file_object = file_object
+        self.writer = WriteBehind(file_object)
         self.size = size
-        self.partial_size = 0
+        self.offset = offset
+        self.received = offset
+        self.partial_size = offset
         self.deferred = None
         self.producer = None
+        self.closed = False
+        self.ended = False
+        self.error = None
+        self.window = Window(self.window_size)
+
+        self.checkpoint = checkpoint
+        self.next_flush = offset + self.checkpoint_interval
+        self.next_checkpoint = self.next_flush
+        self.hasher = hasher
 
     def registerProducer(self, producer, streaming):
         assert streaming
         self.producer = producer
+        self.window.attach(producer)
         if not self.deferred:
             self.deferred = defer.Deferred()
 
@@ -77,106 +141,572 @@ class FileConsumer(object):
 
     def unregisterProducer(self):
         self.producer = None
+        self.window.release()
 
     def finish(self):
-        if not self.file_object:
+        if self.closed:
             return
 
+        # What was not written yet is dropped, a resumed transfer takes it
+        # from the checkpoint
+        self.closed = True
         self.unregisterProducer()
-        self.file_object.close()
+        self.writer.close()
 
         deferred = self.deferred
-        self.file_object = None
         self.deferred = None
 
+        if self.checkpoint and self.partial_size < self.size:
+            self.checkpoint(self.partial_size)
+
         if deferred:
-            if self.partial_size < self.size:
+            if self.error is not None:
+                deferred.errback(self.error)
+            elif self.partial_size < self.size:
                 deferred.errback(
                     TransferError("Transfer terminated before completion"))
             else:
                 deferred.callback(self.size)
 
     def write(self, bytes_):
+        if self.ended:
+            return bytes_
+
+        if self.closed:
+            return
+
         assert self.producer is not None
-        assert self.file_object is not None
 
-        new_partial_size = self.partial_size + len(bytes_)
-        if new_partial_size > self.size:
-            bytes_ = bytes_[:self.size - self.partial_size]
-            new_partial_size = self.size
+        length = self.size - self.received
+        rest = bytes_[length:]
+        bytes_ = bytes_[:length]
+        if not bytes_:
+            return
 
-        self.file_object.write(bytes_)
-        self.partial_size = new_partial_size
+        if self.hasher is not None:
+            self.hasher.update(self.received, bytes_)
+
+        self.received += len(bytes_)
+        flush = self.checkpoint is not None and \
+            self.received >= self.next_flush
+        if flush:
+            self.next_flush = self.received + self.checkpoint_interval
+
+        self.window.add(len(bytes_))
+        self.writer.write(bytes_, flush).addCallbacks(self._written,
+                                                      self._failed)
+
+        # The producer is let go of as it is, paused or not, as whatever
+        # follows the file is up to the protocol
+        if self.received == self.size:
+            self.ended = True
+            self.producer = None
+            self.window.attach(None)
+            return rest
+
+    def _written(self, length):
+        if self.closed:
+            return
+
+        self.partial_size += length
         if self.partial_size == self.size:
             self.finish()
+            return
+
+        if self.checkpoint and self.partial_size >= self.next_checkpoint:
+            self.checkpoint(self.partial_size)
+            self.next_checkpoint = self.next_flush
+
+        self.window.remove(length)
+
+    def _failed(self, f):
+        if not self.closed:
+            self.error = f.value
+            self.finish()
 
 
-class Protocol(CommonProtocol, Fysom):
-    message_dispatcher = MessageDispatcher().register(
-        Connect, Quit,
-        SendChat, RequestFileTransfer
-    )
+class BlockConsumer(object):
+    """Writes the blocks of a transfer re-sent after failing verification,
+    which arrive one after the other in the order they were requested.
+
+    Writes are done by a `WriteBehind`, with a `Window` of `window_size`
+    bytes, as a `FileConsumer` does. Once the last block is received,
+    `ended` is set and `write` returns whatever followed it. The Deferred
+    fires once all of them are written.
+    """
+
+    implements(interfaces.IConsumer)
+
+    window_size = 4 * 1024 * 1024
+
+    def __init__(self, file_object, size, blocks, hasher):
+        self.writer = WriteBehind(file_object)
+        self.ranges = [block_range(size, index) for index in blocks]
+        self.ranges.reverse()
+        self.hasher = hasher
+        self.position = 0
+        self.remaining = 0
+        self.seek = None
+        self.unwritten = 0
+        self.deferred = None
+        self.producer = None
+        self.closed = False
+        self.ended = False
+        self.error = None
+        self.window = Window(self.window_size)
+
+        self.next_block()
+
+    def next_block(self):
+        self.position, self.remaining = self.ranges.pop()
+        self.seek = self.position
+
+    def registerProducer(self, producer, streaming):
+        assert streaming
+        self.producer = producer
+        self.window.attach(producer)
+        if not self.deferred:
+            self.deferred = defer.Deferred()
+
+        return self.deferred
+
+    def unregisterProducer(self):
+        self.producer = None
+        self.window.release()
+
+    def finish(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.unregisterProducer()
+        self.writer.close()
+
+        deferred = self.deferred
+        self.deferred = None
+
+        if deferred:
+            if self.error is not None:
+                deferred.errback(self.error)
+            elif self.remaining or self.ranges or self.unwritten:
+                deferred.errback(
+                    TransferError("Transfer terminated before completion"))
+            else:
+                deferred.callback(None)
+
+    def write(self, bytes_):
+        if self.ended:
+            return bytes_
+
+        if self.closed:
+            return
+
+        assert self.producer is not None
+
+        while bytes_ and self.remaining:
+            chunk = bytes_[:self.remaining]
+            bytes_ = bytes_[len(chunk):]
+
+            self.hasher.update(self.position, chunk)
+            self.position += len(chunk)
+            self.remaining -= len(chunk)
+            last = not self.remaining and not self.ranges
+
+            self.unwritten += len(chunk)
+            self.window.add(len(chunk))
+            self.writer.write(chunk, last, self.seek).addCallbacks(
+                self._written, self._failed)
+            self.seek = None
 
+            if not self.remaining:
+                if last:
+                    self.ended = True
+                    self.producer = None
+                    self.window.attach(None)
+                    return bytes_
+
+                self.next_block()
+
+    def _written(self, length):
+        if self.closed:
+            return
+
+        self.unwritten -= length
+        if self.ended and not self.unwritten:
+            self.finish()
+            return
+
+        self.window.remove(length)
+
+    def _failed(self, f):
+        if not self.closed:
+            self.error = f.value
+            self.finish()
+
+
+class Protocol(CommonProtocol, Fysom):
     async_transitions = {'connect', 'send_file'}
 
+    ERROR_MESSAGES = {
+        'INVALID_BLOCKS': 'Invalid blocks requested'
+    }
+
+    # 'resume' lets a receiver answer a transfer request with the offset it
+    # already has, 'stripe' to take it over several data connections,
+    # 'verify' to check it against a tree of block hashes, 'compress' to
+    # have it compressed, 'dedup' to answer that it already has a file with
+    # the same root hash, 'delta' to only take what changed from its copy
+    # of a file with the same name and 'mux' to carry messages, chat and
+    # file data on channels of their own, so chat goes on during transfers
+    supported_features = CommonProtocol.supported_features + \
+        ('resume', 'stripe', 'verify', 'compress', 'dedup', 'delta', 'mux')
+
+    # zlib level for transfers the receiver wants compressed. Level 1 keeps
+    # up with links of tens of MB/s while getting most of the size down
+    compression_level = 1
+
+    # Most data connections a receiver accepts for a single transfer
+    max_streams = 8
+
+    # Files at least this large are received through a memory mapping, if
+    # their space can be reserved. None to always use plain writes
+    mapped_min_size = 16 * 1024 * 1024
+
+    # Times a receiver asks for corrupted blocks again before giving up,
+    # and most hashes or blocks asked for at once
+    max_repair_rounds = 3
+    max_hashes_per_request = 1024
+    max_blocks_per_request = 256
+
+    # Most delta checksums asked for at once, which keeps responses within
+    # the length of a line
+    max_checksums_per_request = 256
+
+    # Shares of the connection each channel gets while several have data
+    # waiting, and bytes of file data the sender may have in flight
+    mux_weights = {CONTROL: 4, CHAT: 4, FILE: 1}
+    mux_file_window = 4 * 1024 * 1024
+
+    # Chat that may be exchanged while a transfer is in progress or being
+    # set up, with channels
+    chat_events = frozenset(['send_chat', 'receive_chat'])
+
+    initial = 'not_connected'
+    events = [
+        # event / from / to
+        ('connect',
+            'not_connected', 'connected'),
+        ('disconnect',
+         '*', 'done'),
+        ('accept_connection',
+            'not_connected', 'connected'),
+        ('send_chat',
+            ['connected', 'sending_file', 'receiving_file'], '='),
+        ('receive_chat',
+            ['connected', 'sending_file', 'receiving_file'], '='),
+        ('send_file',
+            'connected', 'sending_file'),
+        ('receive_file',
+            'connected', 'receiving_file'),
+        ('send_file_success',
+            'sending_file', 'connected'),
+        ('send_file_failure',
+            'sending_file', 'connected'),
+        ('receive_file_success',
+            'receiving_file', 'connected'),
+        ('receive_file_failure',
+            'receiving_file', 'connected')
+    ]
+
     def __init__(self, client_server_proto, user_name, is_initiator=False,
                  file_receive_path=None):
         CommonProtocol.__init__(self)
-        Fysom.__init__(self, initial='not_connected', events=[
-            # event / from / to
-            ('connect',
-                'not_connected', 'connected'),
-            ('disconnect',
-             '*', 'done'),
-            ('accept_connection',
-                'not_connected', 'connected'),
-            ('send_chat',
-                'connected', 'connected'),
-            ('receive_chat',
-                'connected', 'connected'),
-            ('send_file',
-                'connected', 'sending_file'),
-            ('receive_file',
-                'connected', 'receiving_file'),
-            ('send_file_success',
-                'sending_file', 'connected'),
-            ('send_file_failure',
-                'sending_file', 'connected'),
-            ('receive_file_success',
-                'receiving_file', 'connected'),
-            ('receive_file_failure',
-                'receiving_file', 'connected')
-        ])
+        Fysom.__init__(self)
 
         self.client_server_proto = client_server_proto
         self.other_user_name = user_name
         self.transfer_file = None
         self.file_producer = None
         self.file_consumer = None
+        self.transfer_tree = None
+        self.block_hasher = None
+        self.basis_checksums = None
+        self.delta_target = None
         self.is_initiator = is_initiator
+        self.mux = None
+        self.current_channel = None
+
+        # Fired once the file being received is written, and whether what
+        # followed it is held until then
+        self.file_received = None
+        self.holding_input = False
 
         self.receive_path = file_receive_path
         if not self.receive_path:
             self.receive_path = os.path.abspath(os.getcwd())
 
-    def on_message_received(self, message):
-        for msg_cls, action in {
-            Connect:
-                lambda m: self.accept_connection(),
-            Quit:
-                lambda m: self.disconnect(),
-            RequestFileTransfer:
-                lambda m: self.receive_file(TransferFile.from_message(m)),
-            SendChat:
-                lambda m: self.receive_chat(m.message)
-        }.items():
-            if isinstance(message, msg_cls):
-                action(message)
+        self.partial_transfers = PartialTransfers.for_directory(
+            self.receive_path)
+        self.content_index = ContentIndex.for_directory(self.receive_path)
+
+    @property
+    def concurrent_events(self):
+        return self.chat_events if self.mux is not None else frozenset()
+
+    @property
+    def data_transport(self):
+        """Where file data is sent"""
+
+        if self.mux is not None:
+            return self.mux.channels[FILE]
+
+        return self.transport
+
+    @property
+    def data_producer(self):
+        """What a consumer of file data pauses when it falls behind"""
+
+        if self.mux is not None:
+            return self.mux.channels[FILE]
+
+        return self
+
+    def enable_features(self, features):
+        CommonProtocol.enable_features(self, features)
+        if 'mux' in self.features and self.pipelined and self.mux is None:
+            self.start_mux()
+
+    def start_mux(self):
+        """Switches the connection to channels. Whatever arrives after this
+        is framed by the multiplexer, so it is taken in raw mode from now on"""
+
+        self.mux = Multiplexer(self.transport, self.channel_data_received)
+        for number in (CONTROL, CHAT):
+            self.mux.open(number, self.mux_weights[number])
+        self.mux.open(FILE, self.mux_weights[FILE], self.mux_file_window)
+
+        CommonProtocol.setRawMode(self)
+
+    def setRawMode(self):
+        # With channels file data is told apart by the channel it arrives
+        # on, so the connection stays in raw mode
+        if self.mux is None:
+            CommonProtocol.setRawMode(self)
+
+    def setLineMode(self, extra=''):
+        if self.mux is None:
+            return CommonProtocol.setLineMode(self, extra)
+
+    def write_encoded(self, data, message=None):
+        if self.mux is None:
+            self.transport.write(data)
+        elif isinstance(message, SendChat) or \
+                (message is None and self.current_channel == CHAT):
+            self.mux.channels[CHAT].write(data)
+        else:
+            self.mux.channels[CONTROL].write(data)
+
+    def channel_data_received(self, channel, data):
+        if channel.number == FILE:
+            consumer = self.file_consumer
+            if self.current == 'receiving_file' and consumer is not None:
+                consumer.write(data)
+                if consumer.ended:
+                    channel.resumeProducing()
+                    self.file_data_ended()
+
+            return
+
+        # Chat goes on while messages are held
+        channel.buffer += data
+        if channel.number != CHAT and self.holding_input:
+            return
+
+        self.channel_messages_received(channel)
+
+    def channel_messages_received(self, channel):
+        buf = channel.buffer
+        if self.codec.framed:
+            frames, channel.buffer = self.codec.split_frames(buf)
+        else:
+            frames = buf.split(self.delimiter)
+            channel.buffer = frames.pop()
+            if len(channel.buffer) > self.MAX_LENGTH:
+                self.lineLengthExceeded(channel.buffer)
                 return
 
+        # Responses go back on the channel of what they answer
+        self.current_channel = channel.number
+        try:
+            for frame in frames:
+                self.frame_received(frame)
+        finally:
+            self.current_channel = None
+
+    @handles(Connect)
+    def handle_connect(self, message):
+        self.accept_connection(message.features)
+
+    @handles(Quit)
+    def handle_quit(self, message):
+        self.disconnect()
+
+    @handles(RequestFileTransfer)
+    def handle_request_file_transfer(self, message):
+        self.receive_file(TransferFile.from_message(message))
+
+    @handles(SendChat)
+    def handle_send_chat(self, message):
+        self.receive_chat(message.message)
+
+    def check_verifying(self, message):
+        if self.current == 'sending_file' and self.transfer_tree is not None:
+            return True
+
+        self.send_error_response('INVALID_COMMAND_FOR_STATE', None,
+                                 command=message.command, state=self.current)
+        return False
+
+    @handles(BlockHashes)
+    def handle_block_hashes(self, message):
+        if not self.check_verifying(message):
+            return
+
+        try:
+            if message.count > self.max_hashes_per_request:
+                raise IntegrityError("Too many hashes requested")
+
+            hashes = self.transfer_tree.hashes(message.level, message.first,
+                                               message.count)
+        except IntegrityError as e:
+            self.send_error_response('INVALID_BLOCKS', str(e))
+            return
+
+        self.send_response({'hashes': hashes})
+
+    @handles(ResendBlocks)
+    def handle_resend_blocks(self, message):
+        if not self.check_verifying(message):
+            return
+
+        count = block_count(self.transfer_file.size)
+        blocks = list(message.blocks)
+        if not 0 < len(blocks) <= self.max_blocks_per_request or \
+                not all(0 <= index < count for index in blocks):
+            self.send_error_response('INVALID_BLOCKS')
+            return
+
+        self.log("Resending {count} corrupted blocks", count=len(blocks))
+        self.send_response({'result': 'ok'})
+        self.send_blocks(blocks)
+
+    @handles(EndTransfer)
+    def handle_end_transfer(self, message):
+        if not self.check_verifying(message):
+            return
+
+        self.send_response({})
+        if message.result == 'verified':
+            self.log("File verified by the receiver")
+            self.send_file_success()
+        else:
+            self.log("File failed verification by the receiver")
+            self.send_file_failure()
+
+    def check_receiving_delta(self, message):
+        if self.current == 'receiving_file' and \
+                self.basis_checksums is not None:
+            return True
+
+        self.send_error_response('INVALID_COMMAND_FOR_STATE', None,
+                                 command=message.command, state=self.current)
+        return False
+
+    @handles(BlockChecksums)
+    def handle_block_checksums(self, message):
+        if not self.check_receiving_delta(message):
+            return
+
+        first, count = message.first, message.count
+        if first < 0 or not 0 < count <= self.max_checksums_per_request:
+            self.send_error_response('INVALID_BLOCKS')
+            return
+
+        request_id = self.current_request_id
+
+        def on_checksums(checksums):
+            if isinstance(checksums, DeltaError):
+                self.send_error_response('INVALID_BLOCKS', str(checksums),
+                                         request_id=request_id)
+            else:
+                self.send_response({'checksums':
+                                    checksums[first:first + count]},
+                                   request_id)
+
+            return checksums
+
+        self.basis_checksums.addCallback(on_checksums)
+
+    @handles(StartDelta)
+    def handle_start_delta(self, message):
+        if not self.check_receiving_delta(message):
+            return
+
+        self.send_response({'result': 'ok'})
+        self.setRawMode()
+
     def rawDataReceived(self, data):
-        assert self.file_consumer is not None
-        self.file_consumer.write(data)
+        if self.mux is None:
+            consumer = self.file_consumer
+            assert consumer is not None
+            rest = consumer.write(data)
+            if consumer.ended:
+                self.file_data_ended(rest)
+
+            return
+
+        try:
+            self.mux.dataReceived(data)
+        except (MuxError, CodecError) as e:
+            self.log("Dropping connection: {e}", e=e)
+            self.transport.loseConnection()
+
+    def file_data_ended(self, rest=''):
+        """Called once the consumer has taken the whole file. Without
+        channels, leaves raw mode, parsing `rest`, which followed the file,
+        as messages.
+
+        The consumer may still be writing the file, in which case messages
+        are held, by pausing the connection or the control channel, until
+        the receiver is done with it. Otherwise a request for another
+        transfer, say, would find it still receiving this one.
+        """
+
+        if not self.file_received.called:
+            self.holding_input = True
+            if self.mux is None:
+                self.pauseProducing()
+
+        if self.mux is None:
+            CommonProtocol.setLineMode(self, rest)
+
+    def release_input(self):
+        if not self.holding_input:
+            return
+
+        self.holding_input = False
+        if self.mux is None:
+            self.resumeProducing()
+            return
+
+        try:
+            self.channel_messages_received(self.mux.channels[CONTROL])
+        except CodecError as e:
+            self.log("Dropping connection: {e}", e=e)
+            self.transport.loseConnection()
+
+    def on_enter_connected(self, _):
+        self.release_input()
 
     def on_before_connect(self, _):
         def on_response(response):
@@ -188,13 +718,20 @@ class Protocol(CommonProtocol, Fysom):
                 self.log("Connected")
                 self.transition()
 
-        self.send_message(Connect(), on_response)
+        self.send_connect(on_response)
 
-    def on_accept_connection(self, _):
+    def on_accept_connection(self, event):
         self.log("Accepting incoming connection")
-        self.send_response({})
+
+        features = self.accept_features(event.args[0])
+        self.send_response({'features': features})
+        self.enable_features(features)
 
     def on_before_send_chat(self, event):
+        # Without channels, file data takes the connection over
+        if self.current != 'connected' and self.mux is None:
+            return False
+
         message = event.args[0]
 
         def on_response(response):
@@ -205,75 +742,347 @@ class Protocol(CommonProtocol, Fysom):
 
         self.send_message(SendChat(message), on_response)
 
+    def on_before_receive_chat(self, event):
+        if self.current != 'connected' and self.mux is None:
+            self.send_error_response('INVALID_COMMAND_FOR_STATE', None,
+                                     command=SendChat.command,
+                                     state=self.current)
+            return False
+
     def on_receive_chat(self, event):
         self.log("Received chat message: '{message}'", message = event.args[0])
 
         self.send_response({})
 
-    def open_transfer_file_read(self, transfer):
+    def open_transfer_file_read(self, transfer, offset=0, compression=None):
         try:
             fp = open(transfer.path, 'rb')
-            self.file_producer = FileBodyProducer(fp,
-                readSize=transfer.block_size)
-            self.transfer_file = transfer
         except IOError:
             return False
 
+        if compression:
+            self.file_producer = CompressingSender(
+                fp, offset, transfer.size - offset, self.compression_level)
+        else:
+            self.file_producer = file_sender(fp, offset,
+                                             transfer.size - offset,
+                                             self.data_transport)
+        self.transfer_file = transfer
+        return True
+
+    def open_transfer_striped_read(self, transfer, response):
+        try:
+            port = int(response['port'])
+            streams = int(response['streams'])
+            range_size = int(response['range_size'])
+            token = str(response['token'])
+        except (KeyError, TypeError, ValueError):
+            self.log("Invalid striped transfer response")
+            return False
+
+        if not 1 <= streams <= transfer.streams or range_size <= 0:
+            self.log("Invalid striped transfer parameters")
+            return False
+
+        self.file_producer = StripedSender(
+            transfer.path, transfer.size, self.transport.getPeer().host,
+            port, token, streams, range_size)
+        self.transfer_file = transfer
         return True
 
     def on_before_send_file(self, event):
         transfer = event.args[0]
+        if 'verify' not in self.features:
+            self.request_file_transfer(transfer)
+            return
 
+        def on_tree(tree):
+            if not self.transport.connected:
+                return
+
+            self.log("Hashed {path}, root {root}", path=transfer.path,
+                     root=tree.root)
+            self.request_file_transfer(
+                transfer._replace(root_hash=tree.root), tree)
+
+        def on_failure(failure):
+            failure.trap(Exception)
+            self.log("Failed to hash file: {e}", e=failure)
+            self.cancel_transition()
+
+        # Hashing reads the whole file, so it is kept off the reactor
+        threads.deferToThread(MerkleTree.from_file, transfer.path) \
+            .addCallbacks(on_tree, on_failure)
+
+    def request_file_transfer(self, transfer, tree=None):
         def on_response(response):
+            opened = False
             if self.check_response_error(response):
                 self.log("Received error after file transfer request")
+            elif response.get('result') == 'duplicate' and \
+                    'dedup' in self.features:
+                self.log("Receiver already has the file, nothing to send")
+                self.transfer_file = transfer
+                self.file_producer = None
+                opened = True
             elif response.get('result') != 'confirmed':
                 self.log("File transfer request denied")
+            elif 'delta' in self.features and 'delta' in response:
+                self.log("File transfer request accepted, sending changes to "
+                         "the receiver's copy")
+                self.send_delta(transfer, tree, response['delta'])
+                return
+            elif 'stripe' in self.features and 'token' in response:
+                self.log("File transfer request accepted, starting over "
+                         "{streams} connections", streams=response['streams'])
+                opened = self.open_transfer_striped_read(transfer, response)
+            else:
+                offset = response.get('offset', 0) \
+                    if 'resume' in self.features else 0
+                compression = response.get('compression') \
+                    if 'compress' in self.features else None
+                if not 0 <= offset < transfer.size:
+                    self.log("Invalid offset {offset} to resume from",
+                             offset=offset)
+                elif compression not in (None, COMPRESSION):
+                    self.log("Unsupported compression {compression}",
+                             compression=compression)
+                else:
+                    if offset:
+                        self.log("File transfer request accepted, resuming "
+                                 "at {offset}", offset=offset)
+                    else:
+                        self.log("File transfer request accepted, starting")
+
+                    opened = self.open_transfer_file_read(transfer, offset,
+                                                          compression)
+
+            if opened:
+                self.transfer_tree = tree
+                self.transition()
             else:
-                self.log("File transfer request accepted, starting")
-                if self.open_transfer_file_read(transfer):
-                    self.transition()
-                    return
+                self.cancel_transition()
 
-            self.cancel_transition()
+        message = transfer.to_message()
+        if 'stripe' not in self.features:
+            message.streams = None
 
-        self.send_message(transfer.to_message(), on_response).addErrback(
+        self.send_message(message, on_response).addErrback(
             lambda _: self.cancel_transition())
 
+    def send_delta(self, transfer, tree, params):
+        def on_sender(sender):
+            if not self.transport.connected:
+                sender.stopProducing()
+                return
+
+            self.file_producer = sender
+            self.transfer_file = transfer
+            self.transfer_tree = tree
+            self.transition()
+
+        def on_failure(failure):
+            failure.trap(Exception)
+            self.log("Failed to prepare delta: {e}", e=failure.value)
+            self.cancel_transition()
+
+            # The receiver is waiting for the delta, so there is no way back
+            self.transport.loseConnection()
+
+        self.prepare_delta(transfer, params).addCallbacks(on_sender,
+                                                          on_failure)
+
+    @defer.inlineCallbacks
+    def prepare_delta(self, transfer, params):
+        """Works out the delta of `transfer` against the receiver's copy,
+        described by `params`, and has the receiver start taking it. Fires
+        with the sender for it"""
+
+        try:
+            block_size = int(params['block_size'])
+            size = long(params['size'])
+        except (KeyError, TypeError, ValueError):
+            raise DeltaError("Invalid delta parameters")
+
+        if block_size <= 0 or size <= 0:
+            raise DeltaError("Invalid delta parameters")
+
+        checksums = yield self.fetch_block_checksums(
+            (size + block_size - 1) // block_size)
+        basis = BasisChecksums(checksums, size, block_size)
+        ops = yield compute_delta(transfer.path, transfer.size, basis)
+        literal = literal_size(ops)
+        if literal == transfer.size:
+            self.log("Little of the receiver's copy is of use, sending the "
+                     "whole file")
+        else:
+            self.log("Sending {literal} of {size} bytes, the rest is in the "
+                     "receiver's copy", literal=literal, size=transfer.size)
+
+        sender = DeltaSender(open(transfer.path, 'rb'), transfer.size, ops,
+                             basis)
+
+        def on_response(response):
+            if self.check_response_error(response):
+                raise DeltaError(response.get('message'))
+
+        try:
+            yield self.send_message(StartDelta(), on_response)
+        except Exception:
+            sender.file_object.close()
+            raise
+
+        defer.returnValue(sender)
+
+    @defer.inlineCallbacks
+    def fetch_block_checksums(self, count):
+        def on_response(response):
+            if self.check_response_error(response):
+                raise DeltaError(response.get('message'))
+
+            return response.get('checksums') or []
+
+        checksums = []
+        while len(checksums) < count:
+            batch = yield self.send_message(
+                BlockChecksums(len(checksums),
+                               min(self.max_checksums_per_request,
+                                   count - len(checksums))),
+                on_response)
+            if not batch:
+                raise DeltaError("No checksums for block {0}".format(
+                    len(checksums)))
+
+            checksums.extend(batch)
+
+        defer.returnValue(checksums)
+
     def on_enter_sending_file(self, _):
         assert self.transfer_file is not None
-        assert self.file_producer is not None
-
-        self.setRawMode()
-        d = self.file_producer.startProducing(self.transport)
 
-        def on_success(_):
-            self.log("File send successfully")
+        if self.file_producer is None:
             self.send_file_success()
+            return
+
+        # A receiver verifying the transfer answers it with messages
+        if self.transfer_tree is None:
+            self.setRawMode()
+
+        transfer = self.transfer_file
+        sender = self.file_producer
+        d = sender.start(self.data_transport)
+
+        def on_success(sent):
+            if self.transfer_file is not transfer:
+                return
+
+            self.log("File sent successfully, {sent} bytes in {elapsed:.3f}s "
+                     "({rate:.1f} MB/s, {engine})", sent=sent,
+                     elapsed=sender.elapsed(),
+                     rate=sender.throughput() / (1024 * 1024),
+                     engine=sender.__class__.__name__)
+            if isinstance(sender, CompressingSender):
+                self.log("Compressed to {ratio:.1%} of its size",
+                         ratio=sender.ratio())
+            elif isinstance(sender, DeltaSender):
+                self.log("Sent {ratio:.1%} of its size as a delta",
+                         ratio=sender.ratio())
+
+            if self.transfer_tree is not None:
+                return
+
+            # On channels, file data may still wait for credit, and
+            # whatever goes on the control channel next must not overtake
+            # it
+            if self.mux is not None:
+                self.mux.channels[FILE].drained().addCallback(on_drained)
+            else:
+                self.send_file_success()
+
+        def on_drained(_):
+            if self.transfer_file is transfer:
+                self.send_file_success()
 
         def on_failure(failure):
             failure.trap(Exception)
+            if self.transfer_file is not transfer:
+                return
+
             self.log("File send failed: {e}", e=failure)
             self.send_file_failure()
 
         d.addCallbacks(on_success, on_failure)
 
+    def send_blocks(self, blocks):
+        transfer = self.transfer_file
+
+        def send_next(_=None):
+            if not blocks or self.transfer_file is not transfer:
+                return
+
+            offset, length = block_range(transfer.size, blocks.pop(0))
+            try:
+                fp = open(transfer.path, 'rb')
+            except IOError as e:
+                on_failure(Failure(e))
+                return
+
+            self.file_producer = file_sender(fp, offset, length,
+                                             self.data_transport)
+            self.file_producer.start(self.data_transport).addCallbacks(
+                send_next, on_failure)
+
+        def on_failure(failure):
+            failure.trap(Exception)
+            if self.transfer_file is not transfer:
+                return
+
+            # The receiver is expecting the blocks, so there is no way back
+            self.log("Resending blocks failed: {e}", e=failure)
+            self.send_file_failure()
+            self.transport.loseConnection()
+
+        send_next()
+
     def on_leave_sending_file(self, _):
         self.transfer_file = None
-        self.file_producer.stopProducing()
-        self.file_producer = None
+        self.transfer_tree = None
+        if self.file_producer is not None:
+            self.file_producer.stopProducing()
+            self.file_producer = None
 
         self.setLineMode()
 
-    def open_transfer_file_write(self, transfer):
+    def open_transfer_file_write(self, transfer, offset=0):
         try:
-            fp = open(transfer.path, 'wb')
+            fp = open(transfer.path, 'r+b' if offset else 'w+b')
         except (OSError, IOError) as e:
             self.log("Failed to open file for writing: {e}", e=e)
             return False
 
+        def checkpoint(partial_size):
+            try:
+                self.partial_transfers.save(transfer, transfer.path,
+                                            partial_size)
+            except (IOError, OSError) as e:
+                self.log("Failed to record transfer progress: {e}", e=e)
+
         try:
-            self.file_consumer = FileConsumer(fp, transfer.size)
+            self.file_consumer = None
+            if self.mapped_min_size is not None and \
+                    transfer.size >= self.mapped_min_size:
+                try:
+                    self.file_consumer = MappedFileConsumer(
+                        fp, transfer.size, offset, checkpoint,
+                        self.block_hasher)
+                except MappingError:
+                    fp = open(transfer.path, 'r+b')
+
+            if self.file_consumer is None:
+                self.file_consumer = FileConsumer(fp, transfer.size, offset,
+                                                  checkpoint,
+                                                  self.block_hasher)
+
             self.transfer_file = transfer
         except (IOError, OSError) as e:
             self.log("Failed allocating {size} byte file for transfer: {e}",
@@ -283,39 +1092,255 @@ class Protocol(CommonProtocol, Fysom):
 
         return True
 
+    def open_transfer_striped_write(self, transfer):
+        try:
+            self.file_consumer = StripedConsumer(
+                transfer.path, transfer.size,
+                interface=self.transport.getHost().host,
+                hasher=self.block_hasher)
+        except (IOError, OSError, CannotListenError) as e:
+            self.log("Failed to set up striped transfer: {e}", e=e)
+            return False
+
+        self.transfer_file = transfer
+        return True
+
+    def find_delta_basis(self, transfer):
+        """Path of the copy of a file with the same name as `transfer` to
+        take a delta against, or None. Only a file directly in the receive
+        directory is taken, as the copy is both read and replaced"""
+
+        if 'delta' not in self.features or not transfer.size:
+            return None
+
+        name = os.path.basename(transfer.name)
+        if name != transfer.name or name in ('', '.', '..') or \
+                is_journal_name(name):
+            return None
+
+        path = os.path.join(self.receive_path, name)
+        directory = os.path.realpath(self.receive_path)
+        if os.path.dirname(os.path.realpath(path)) != directory:
+            return None
+
+        if not os.path.isfile(path) or not os.path.getsize(path):
+            return None
+
+        return path
+
+    def open_transfer_delta_write(self, transfer, basis_path):
+        basis_size = os.path.getsize(basis_path)
+        block_size = delta_block_size(basis_size)
+        directory, name = os.path.split(basis_path)
+
+        basis = fp = None
+        try:
+            basis = open(basis_path, 'rb')
+            fd, temp_path = tempfile.mkstemp(prefix='.{0}.'.format(name),
+                                             suffix='.delta', dir=directory)
+            fp = os.fdopen(fd, 'wb')
+            mode = stat.S_IMODE(os.fstat(basis.fileno()).st_mode)
+            os.chmod(temp_path, mode)
+        except (IOError, OSError) as e:
+            self.log("Failed to open files for delta transfer: {e}", e=e)
+            for f in (basis, fp):
+                if f is not None:
+                    f.close()
+
+            return False
+
+        def on_failure(failure):
+            failure.trap(Exception)
+            self.log("Failed to checksum {path}: {e}", path=basis_path,
+                     e=failure.value)
+            return DeltaError(failure.getErrorMessage())
+
+        # Checksumming reads the whole copy, so it runs in the thread pool
+        # while the sender waits for the first of them
+        self.basis_checksums = checksum_file(basis_path, basis_size,
+                                             block_size)
+        self.basis_checksums.addErrback(on_failure)
+
+        self.file_consumer = DeltaConsumer(fp, basis, basis_size,
+                                           transfer.size, block_size,
+                                           self.block_hasher)
+        self.transfer_file = transfer._replace(path=temp_path)
+        self.delta_target = basis_path
+        return {'block_size': block_size, 'size': basis_size}
+
+    def place_received_file(self, transfer):
+        """Moves a file rebuilt from a delta over the copy it was rebuilt
+        from. Returns the path the file ends up at, or None if it could not
+        be moved"""
+
+        target, self.delta_target = self.delta_target, None
+        if target is None:
+            return transfer.path
+
+        try:
+            os.rename(transfer.path, target)
+        except OSError as e:
+            self.log("Failed to replace {path}: {e}", path=target, e=e)
+            try:
+                os.remove(transfer.path)
+            except OSError:
+                pass
+
+            return None
+
+        return target
+
+    def receive_duplicate(self, transfer):
+        """Answers a request for a file the index already has with a local
+        copy of it. Returns whether it did"""
+
+        if 'dedup' not in self.features or 'verify' not in self.features or \
+                not transfer.root_hash:
+            return False
+
+        source = self.content_index.find(transfer.root_hash, transfer.size)
+        if source is None:
+            return False
+
+        if os.path.basename(source) == transfer.name:
+            self.log("Already have {path}, nothing to receive", path=source)
+            self.send_response({'result': 'duplicate'})
+            return True
+
+        path = self.content_index.unique_path(transfer.name)
+        request_id = self.current_request_id
+
+        def on_copied(_):
+            self.log("Already have the file as {source}, linked to {path}",
+                     source=source, path=path)
+            self.send_response({'result': 'duplicate'}, request_id)
+
+        def on_failure(failure):
+            failure.trap(Exception)
+            self.log("Failed to copy {source} to {path}: {e}", source=source,
+                     path=path, e=failure.value)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+            self.send_response({'result': 'rejected'}, request_id)
+
+        def release(result):
+            self.content_index.release(path)
+            return result
+
+        d = threads.deferToThread(link_or_copy, source, path)
+        d.addBoth(release)
+        d.addCallbacks(on_copied, on_failure)
+        return True
+
     def on_before_receive_file(self, event):
         transfer = event.args[0]
-        path = os.path.join(self.receive_path, transfer.name)
 
-        def generate_unique_path(initial_path):
-            filename, ext = os.path.splitext(initial_path)
-            for n in itertools.count():
-                yield "{0}-{1}{2}".format(filename, n, ext)
+        if self.receive_duplicate(transfer):
+            return False
 
-        if os.path.exists(path):
-            for path in generate_unique_path(path):
-                if not os.path.exists(path):
-                    break
+        striped = 'stripe' in self.features and transfer.streams > 1 and \
+            transfer.size > StripedConsumer.range_size
+
+        # Striped transfers arrive out of order, so there is no single
+        # offset to resume them from
+        partial = None
+        if 'resume' in self.features and not striped:
+            partial = self.partial_transfers.find(transfer)
+
+        delta_basis = None
+        if partial:
+            path, offset = partial
+        else:
+            offset = 0
+            delta_basis = self.find_delta_basis(transfer)
+            if delta_basis is not None:
+                path = delta_basis
+            else:
+                path = self.content_index.unique_path(transfer.name)
 
         transfer = transfer._replace(path=path)
 
-        if not self.open_transfer_file_write(transfer):
-            self.write_response({'result': 'rejected'})
+        self.block_hasher = None
+        if 'verify' in self.features and transfer.root_hash:
+            self.block_hasher = BlockHasher(transfer.size)
+
+        if delta_basis is not None:
+            delta = self.open_transfer_delta_write(transfer, delta_basis)
+            if not delta:
+                self.send_response({'result': 'rejected'})
+                return False
+
+            self.log("Receiving changes to {path}", path=path)
+            self.send_response({'result': 'confirmed', 'delta': delta})
+            return
+
+        if striped:
+            streams = min(transfer.streams, self.max_streams)
+            opened = self.open_transfer_striped_write(transfer)
+
+            # The file, once created, keeps its name taken
+            self.content_index.release(path)
+            if not opened:
+                self.send_response({'result': 'rejected'})
+                return False
+
+            consumer = self.file_consumer
+            self.log("Receiving file as {path} over {streams} connections",
+                     path=path, streams=streams)
+            self.send_response({'result': 'confirmed', 'streams': streams,
+                                'port': consumer.port,
+                                'token': consumer.token,
+                                'range_size': consumer.range_size})
+            return
+
+        opened = self.open_transfer_file_write(transfer, offset)
+        self.content_index.release(path)
+        if not opened:
+            self.send_response({'result': 'rejected'})
             return False
 
-        self.log("Receiving file as {path}", path=path)
-        self.send_response({'result': 'confirmed'})
+        response = {'result': 'confirmed'}
+        if 'compress' in self.features and \
+                is_compressible(transfer.mime_type):
+            self.file_consumer = DecompressingConsumer(self.file_consumer)
+            response['compression'] = COMPRESSION
+        if offset:
+            self.log("Resuming file {path} at {offset}", path=path,
+                     offset=offset)
+            response['offset'] = offset
+        else:
+            self.log("Receiving file as {path}", path=path)
+
+        self.send_response(response)
 
     def on_enter_receiving_file(self, _):
         assert self.transfer_file is not None
         assert self.file_consumer is not None
 
-        self.setRawMode()
-        d = self.file_consumer.registerProducer(self, streaming=True)
+        # A delta follows START_DELTA, once the sender has the checksums
+        if self.delta_target is None:
+            self.setRawMode()
+
+        # The consumer pauses the connection, through LineReceiver's
+        # pauseProducing, or only the file channel while it is behind on
+        # writing to disk
+        transfer = self.transfer_file
+        d = self.file_received = self.file_consumer.registerProducer(
+            self.data_producer, streaming=True)
 
         def on_success(_):
-            self.log("File received successfully")
-            self.receive_file_success()
+            self.partial_transfers.remove(transfer)
+            if self.block_hasher is not None:
+                self.log("File received, verifying")
+                self.verify_received_file(transfer)
+            elif self.place_received_file(transfer) is None:
+                self.receive_file_failure()
+            else:
+                self.log("File received successfully")
+                self.receive_file_success()
 
         def on_failure(failure):
             failure.trap(Exception)
@@ -324,11 +1349,153 @@ class Protocol(CommonProtocol, Fysom):
 
         d.addCallbacks(on_success, on_failure)
 
+    def verify_received_file(self, transfer, repairs=0):
+        self.setLineMode()
+        self.release_input()
+        hasher = self.block_hasher
+
+        def on_tree(tree):
+            if tree.root == transfer.root_hash:
+                return None
+
+            self.log("File does not match its hash, looking for corrupted "
+                     "blocks")
+            return find_corrupted(tree, self.fetch_block_hashes)
+
+        def on_corrupted(blocks):
+            if self.transfer_file is not transfer:
+                return
+
+            if blocks is None:
+                self.log("File received and verified")
+                self.end_transfer(True)
+            elif not blocks:
+                self.log("File does not match its hash, but no corrupted "
+                         "blocks were found")
+                self.end_transfer(False)
+            elif repairs >= self.max_repair_rounds:
+                self.log("File still has {count} corrupted blocks after "
+                         "{repairs} repairs", count=len(blocks),
+                         repairs=repairs)
+                self.end_transfer(False)
+            else:
+                self.log("Requesting {count} corrupted blocks again",
+                         count=len(blocks))
+                self.request_blocks(transfer, blocks, repairs)
+
+        def on_failure(failure):
+            failure.trap(Exception)
+            if self.transfer_file is not transfer:
+                return
+
+            self.log("File verification failed: {e}", e=failure)
+            self.end_transfer(False)
+
+        # Blocks that were not hashed as they arrived are read back
+        d = threads.deferToThread(hasher.hash_missing, transfer.path)
+        d.addCallback(lambda _: hasher.tree())
+        d.addCallback(on_tree)
+        d.addCallbacks(on_corrupted, on_failure)
+
+    def fetch_block_hashes(self, level, first, count):
+        def on_response(response):
+            if self.check_response_error(response):
+                raise IntegrityError(response.get('message'))
+
+            return response.get('hashes', [])
+
+        return self.send_message(BlockHashes(level, first, count),
+                                 on_response)
+
+    def request_blocks(self, transfer, blocks, repairs):
+        batch = blocks[:self.max_blocks_per_request]
+        rest = blocks[len(batch):]
+
+        def on_response(response):
+            if self.check_response_error(response):
+                raise IntegrityError(response.get('message'))
+
+            fp = open(transfer.path, 'r+b')
+            self.file_consumer = BlockConsumer(fp, transfer.size, batch,
+                                               self.block_hasher)
+            self.setRawMode()
+            self.file_received = self.file_consumer.registerProducer(
+                self.data_producer, streaming=True)
+            self.file_received.addCallbacks(on_repaired, on_failure)
+
+        def on_repaired(_):
+            if self.transfer_file is not transfer:
+                return
+
+            self.setLineMode()
+            self.release_input()
+            if rest:
+                self.request_blocks(transfer, rest, repairs)
+            else:
+                self.verify_received_file(transfer, repairs + 1)
+
+        def on_failure(failure):
+            failure.trap(Exception)
+            if self.transfer_file is not transfer:
+                return
+
+            self.log("Failed to repair file: {e}", e=failure)
+            self.end_transfer(False)
+
+        self.send_message(ResendBlocks(batch), on_response).addErrback(
+            on_failure)
+
+    def end_transfer(self, verified):
+        self.setLineMode()
+        self.release_input()
+        transfer = self.transfer_file
+        path = self.place_received_file(transfer) if verified else None
+        if path is not None:
+            try:
+                self.content_index.add(transfer.root_hash, path)
+            except (IOError, OSError) as e:
+                self.log("Failed to index received file: {e}", e=e)
+        else:
+            verified = False
+            try:
+                os.remove(transfer.path)
+            except OSError:
+                pass
+
+        def on_response(response):
+            if self.transfer_file is not transfer:
+                return
+
+            if verified and not self.check_response_error(response):
+                self.receive_file_success()
+            else:
+                self.receive_file_failure()
+
+        def on_failure(failure):
+            failure.trap(Exception)
+            if self.transfer_file is transfer:
+                self.receive_file_failure()
+
+        result = 'verified' if verified else 'failed'
+        self.send_message(EndTransfer(result), on_response).addErrback(
+            on_failure)
+
     def on_leave_receiving_file(self, _):
+        transfer = self.transfer_file
         self.transfer_file = None
+        self.block_hasher = None
+        self.basis_checksums = None
         self.file_consumer.finish()
         self.file_consumer = None
 
+        # A delta that was not completed leaves the copy as it was
+        if self.delta_target is not None:
+            self.delta_target = None
+            try:
+                os.remove(transfer.path)
+            except OSError:
+                pass
+
         self.setLineMode()
 
     def connectionMade(self):
@@ -1,12 +1,12 @@
 import time
 
-from twisted.internet import reactor
+from twisted.internet import reactor, task
 from twisted.internet import protocol
 from twisted.internet.protocol import connectionDone
 
 from communic8.model.user import User
 from communic8.model.messages import *
-from communic8.protocol import CommonProtocol
+from communic8.protocol import CommonProtocol, ProtocolError, handles
 from communic8.util import Fysom
 from communic8.protocol import simpleserv
 from communic8.protocol import simpleclient
@@ -14,44 +14,58 @@ from twisted.internet.protocol import DatagramProtocol
 
 class Protocol(CommonProtocol, Fysom, DatagramProtocol):
     async_transitions = {'connect', 'login', 'logout', 'request_user_list'}
-    message_dispatcher = MessageDispatcher().register(ChatRequested)
+
+    user_list_page_size = 100
+
+    # Must stay well below the server's idle timeout
+    heartbeat_interval = 30
+
+    # Seconds to wait for the other user to accept a chat request, longer
+    # than the server waits for them, and for them to connect once we accept
+    chat_request_timeout = 40
+    chat_wait_time = 30
+
+    initial = 'not_connected'
+    events = [
+        # event / from / to
+        ('connect',
+            'not_connected', 'waiting_login'),
+        ('disconnect',
+            '*', 'done'),
+        ('login',
+            'waiting_login', 'logged_in'),
+        ('logout',
+            '*', 'waiting_login'),
+        ('request_user_list',
+            'logged_in', 'logged_in'),
+        ('subscribe_presence',
+            'logged_in', 'logged_in'),
+        ('chat_initiate',
+            'logged_in', 'waiting_server_confirmation'),
+        ('chat_confirmed',
+            'waiting_server_confirmation', 'starting_connection'),
+        ('chat_rejected',
+            'waiting_server_confirmation', 'logged_in'),
+        ('chat_connect',
+            'starting_connection', 'chatting'),
+        ('chat_requested',
+            'logged_in', 'waiting_user_confirmation'),
+        ('chat_confirm',
+            'waiting_user_confirmation', 'waiting_connection'),
+        ('chat_reject',
+            ['waiting_user_confirmation', 'waiting_connection'],
+            'logged_in'),
+        ('chat_wait_timeout',
+            'waiting_connection', 'logged_in'),
+        ('chat_connected',
+            'waiting_connection', 'chatting'),
+        ('chat_ended',
+            'chatting', 'logged_in'),
+    ]
 
     def __init__(self):
         CommonProtocol.__init__(self)
-        Fysom.__init__(self, initial='not_connected', events=[
-            # event / from / to
-            ('connect',
-                'not_connected', 'waiting_login'),
-            ('disconnect',
-                '*', 'done'),
-            ('login',
-                'waiting_login', 'logged_in'),
-            ('logout',
-                '*', 'waiting_login'),
-            ('request_user_list',
-                'logged_in', 'logged_in'),
-            ('chat_initiate',
-                'logged_in', 'waiting_server_confirmation'),
-            ('chat_confirmed',
-                'waiting_server_confirmation', 'starting_connection'),
-            ('chat_rejected',
-                'waiting_server_confirmation', 'logged_in'),
-            ('chat_connect',
-                'starting_connection', 'chatting'),
-            ('chat_requested',
-                'logged_in', 'waiting_user_confirmation'),
-            ('chat_confirm',
-                'waiting_user_confirmation', 'waiting_connection'),
-            ('chat_reject',
-                ['waiting_user_confirmation', 'waiting_connection'],
-                'logged_in'),
-            ('chat_wait_timeout',
-                'waiting_connection', 'logged_in'),
-            ('chat_connected',
-                'waiting_connection', 'chatting'),
-            ('chat_ended',
-                'chatting', 'logged_in'),
-        ])
+        Fysom.__init__(self)
 
         self.user = None
         self.factory = None
@@ -59,21 +73,27 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
         self.chat_channel = None
         self.chat_port = None
         self.f = None
-
-    @property
-    def message_dispatcher(self):
-        return self.factory.message_dispatcher
-
-    def on_message_received(self, message):
-        for msg_cls, action in {
-            ChatRequested:
-                lambda m: self.chat_requested(m.user)
-        }.items():
-            if isinstance(message, msg_cls):
-                action(message)
-                return
-
-        #raise MessageError("Unhandled message {0}".format(message.command))
+        self.chat_request_id = None
+        self.presence = None
+        self.presence_version = None
+        self.heartbeat = None
+        self.chat_wait_timer = None
+
+    @handles(ChatRequested)
+    def handle_chat_requested(self, message):
+        self.chat_requested(message.user)
+
+    @handles(UserJoined)
+    def handle_user_joined(self, message):
+        if self.check_presence_version(message.version):
+            self.presence[message.user] = message.connected_at
+            self.log("User {0} joined", message.user)
+
+    @handles(UserLeft)
+    def handle_user_left(self, message):
+        if self.check_presence_version(message.version):
+            self.presence.pop(message.user, None)
+            self.log("User {0} left", message.user)
 
     def on_before_connect(self, _):
         def on_response(response):
@@ -84,7 +104,7 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
                 self.log("Connect OK")
                 self.transition()
 
-        self.send_message(Connect(), on_response).addErrback(
+        self.send_connect(on_response).addErrback(
             lambda _: self.cancel_transition())
 
     def on_before_login(self, event):
@@ -104,6 +124,23 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
     def on_after_login(self, event):
         self.log('Logged in as {0}', event.args[0])
 
+        self.heartbeat = task.LoopingCall(self.send_heartbeat)
+        self.heartbeat.start(self.heartbeat_interval, now=False)
+
+    def send_heartbeat(self):
+        # Any request keeps the session alive as well
+        if not self.pipelined and self.pending_responses:
+            return
+
+        self.send_message(Heartbeat()).addErrback(
+            lambda _: self.log("Heartbeat not answered"))
+
+    def _stop_heartbeat(self):
+        if self.heartbeat is not None and self.heartbeat.running:
+            self.heartbeat.stop()
+
+        self.heartbeat = None
+
     def _send_logout(self, callback=None):
         def on_response(response):
             if self.check_response_error(response):
@@ -129,7 +166,10 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
             lambda _: self.cancel_transition())
 
     def _logout(self):
+        self._stop_heartbeat()
         self.user = None
+        self.presence = None
+        self.presence_version = None
 
     def on_after_chat_initiate(self, event):
         user_name = event.args[0]
@@ -150,7 +190,8 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
                 self.log("Initiation rejected")
                 self.chat_rejected()
 
-        self.send_message(RequestChat(user_name), on_response).addErrback(
+        self.send_message(RequestChat(user_name), on_response,
+                          timeout=self.chat_request_timeout).addErrback(
             self.chat_rejected
         )
 
@@ -164,22 +205,81 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
         reactor.connectTCP(host, port, self.f)
 
     def on_after_request_user_list(self, _):
+        users = []
+        generation = []
+
+        def request_page(offset):
+            return self.send_message(
+                ListUsers(offset, self.user_list_page_size), on_response)
+
         def on_response(response):
             if self.check_response_error(response):
                 self.log("Couldn't get user list")
                 self.cancel_transition()
-            else:
-                self.log("Received user list")
-                for item in response.get('users', []):
-                    print ('Name: {item.name}, '
-                           'Connected at: {item.connected_at}').format(item)
+                return
 
-        self.send_message(ListUsers(), on_response).addErrback(
-            lambda _: self.cancel_transition())
+            # Offsets are only meaningful within one generation of the list
+            if generation and generation[0] != response['generation']:
+                self.log("User list changed, requesting it again")
+                del users[:]
+                generation[0] = response['generation']
+                return request_page(0)
+
+            generation[:] = [response['generation']]
+            users.extend(response.get('users', []))
+
+            next_offset = response.get('next_offset')
+            if next_offset is not None:
+                return request_page(next_offset)
+
+            self.log("Received user list")
+            for item in users:
+                print 'Name: {name}, Connected at: {connected_at}'.format(
+                    **item)
+
+        request_page(0).addErrback(lambda _: self.cancel_transition())
+
+    def _send_presence_subscription(self):
+        def on_response(response):
+            if self.check_response_error(response):
+                self.log("Couldn't subscribe to presence updates")
+                return
+
+            self.presence = dict((user['name'], user['connected_at'])
+                                 for user in response.get('users', []))
+            self.presence_version = response['version']
+            self.log("Subscribed to presence updates at version {0}",
+                     self.presence_version)
+
+        return self.send_message(SubscribePresence(), on_response)
+
+    def on_after_subscribe_presence(self, _):
+        self._send_presence_subscription()
+
+    def check_presence_version(self, version):
+        if self.presence_version is None:
+            return False
+
+        if version != self.presence_version + 1:
+            self.log("Missed presence updates, resubscribing")
+            self.presence_version = None
+            self.resync_presence()
+            return False
+
+        self.presence_version = version
+        return True
+
+    def resync_presence(self):
+        try:
+            self._send_presence_subscription()
+        except ProtocolError:
+            # Waiting for another response, try again shortly
+            reactor.callLater(1, self.resync_presence)
 
     def on_after_chat_requested(self, event):
         user_name = event.args[0]
         self.requesting_user = user_name
+        self.chat_request_id = self.current_request_id
         self.log("Received chat request from {0}, waiting for confirmation",
                  user_name)
 
@@ -204,9 +304,19 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
         except Exception:
             self.log("Failed to open chat channel")
 
+        self.chat_wait_timer = self.timeouts.call_later(
+            self.chat_wait_time, self.chat_wait_timeout)
+
     def on_leave_waiting_connection(self, _):
+        if self.chat_wait_timer is not None:
+            self.chat_wait_timer.cancel()
+            self.chat_wait_timer = None
+
         self.chat_channel_close()
 
+    def on_chat_wait_timeout(self, _):
+        self.log("Timed out waiting for the chat connection")
+
     def on_leave_chatting(self, _):
         self.chat_channel_close()
 
@@ -219,14 +329,18 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
                  self.requesting_user, self.chat_port)
         self.requesting_user = None
 
-        self.send_response({'result': 'confirmed', 'port': self.chat_port})
+        self.send_response({'result': 'confirmed', 'port': self.chat_port},
+                           request_id=self.chat_request_id)
+        self.chat_request_id = None
         self.start_chat(self.chat_port)
 
     def on_after_chat_reject(self, _):
         self.log("Rejecting chat request for {0}", self.requesting_user)
         self.requesting_user = None
 
-        self.send_response({'result': 'rejected'})
+        self.send_response({'result': 'rejected'},
+                           request_id=self.chat_request_id)
+        self.chat_request_id = None
 
     def on_enter_done(self, _):
         if not self.transport_connected:
@@ -245,6 +359,7 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
         self.connect()
 
     def connectionLost(self, reason=connectionDone):
+        self._stop_heartbeat()
         self.cancel_transition()
         self.disconnect()
 
@@ -254,10 +369,7 @@ class Factory (protocol.ClientFactory):
 
 
     def __init__(self):
-        self.message_dispatcher = MessageDispatcher().register(
-         ChatRequested
-        )
-
+        self.message_dispatcher = self.protocol.message_handlers().dispatcher
         self.instances = []
 
     def buildProtocol(self, addr):
@@ -269,10 +381,7 @@ class FactoryUDP(DatagramProtocol):
     protocol = DatagramProtocol
 
     def __init__(self):
-        self.message_dispatcher = MessageDispatcher().register(
-         ChatRequested,
-        )
-
+        self.message_dispatcher = Protocol.message_handlers().dispatcher
         self.instances = []
 
     def startProtocol(self):
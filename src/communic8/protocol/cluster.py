@@ -0,0 +1,376 @@
+"""Running the server as several worker processes.
+
+Workers accept client connections on the same port, either through
+SO_REUSEPORT or a listening socket inherited from the coordinator. The
+coordinator owns the user directory: workers claim and release user names
+through it over a local Unix socket, and it broadcasts every change so each
+worker keeps a replica for listing users. Chat events between users logged
+in on different workers are routed through the coordinator as well.
+"""
+
+import json
+import socket
+
+from twisted.internet import defer, error, protocol, reactor
+from twisted.internet.protocol import connectionDone
+
+from communic8.model.messages import *
+from communic8.model.user import UserDatabase, UserDatabaseError, \
+    UserNameAlreadyUsed, AddressAlreadyUsed, parse_timestamp
+from communic8.protocol import CommonProtocol, handles
+from communic8.util import Fysom
+from communic8.util.logger import get_logger
+
+
+cluster_log = get_logger('cluster')
+
+
+# Events a worker accepts on behalf of one of its users
+ROUTED_EVENTS = frozenset(['chat_ask_confirmation', 'chat_confirmed',
+                           'chat_rejected', 'chat_finished'])
+
+
+def encode_user(user):
+    return {'name': user.name, 'host': user.host, 'port': user.port,
+            'connected_at': user.connected_at.isoformat()}
+
+
+def listen_shared(port, factory, interface='', backlog=50, fd=None):
+    """Listen on a TCP port that other processes listen on as well.
+
+    Adopts the inherited listening socket `fd` when given, otherwise binds a
+    new socket with SO_REUSEPORT so the kernel balances connections.
+    """
+
+    if fd is None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((interface, port))
+        sock.listen(backlog)
+        sock.setblocking(False)
+
+        try:
+            return reactor.adoptStreamPort(sock.fileno(), socket.AF_INET,
+                                           factory)
+        finally:
+            sock.close()
+
+    return reactor.adoptStreamPort(fd, socket.AF_INET, factory)
+
+
+def listen_shared_udp(port, protocol, interface=''):
+    """Listen on an UDP port that other processes listen on as well"""
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((interface, port))
+    sock.setblocking(False)
+
+    try:
+        return reactor.adoptDatagramPort(sock.fileno(), socket.AF_INET,
+                                         protocol)
+    finally:
+        sock.close()
+
+
+def shared_listening_socket(port, interface='', backlog=50):
+    """Listening socket for workers to inherit, when SO_REUSEPORT is missing"""
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((interface, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+class ClusterProtocol(CommonProtocol, Fysom):
+    supported_features = ('pipeline', )
+    log_category = 'cluster'
+    log_name = 'cluster'
+
+    initial = 'not_connected'
+    events = [
+        # event / from / to
+        ('connect',
+            'not_connected', 'connected'),
+        ('disconnect',
+            '*', 'done')
+    ]
+
+    def __init__(self):
+        CommonProtocol.__init__(self)
+        Fysom.__init__(self)
+
+        self.factory = None
+
+    def log_prefix(self):
+        return self.log_name + " - "
+
+
+class CoordinatorProtocol(ClusterProtocol):
+    """Coordinator side of the connection to a worker"""
+
+    log_name = 'coordinator'
+
+    ERROR_MESSAGES = {
+        'LOGIN_FAILED_USER_NAME_TAKEN': "An user with name '{name}' is already logged in",
+        'LOGIN_FAILED_ADDRESS_IN_USE': "An user with address {host}:{port} is already logged in",
+        'LOGIN_FAILED': "Login failed for unknown reasons",
+        'USER_NOT_LOGGED_IN': "User '{user_name}' is not logged in"
+    }
+
+    @handles(Connect)
+    def handle_connect(self, message):
+        self.connect(message.features)
+
+    @handles(ListUsers)
+    def handle_list_users(self, message):
+        self.send_response({
+            'users': [encode_user(user)
+                      for user in self.factory.user_database.users()]
+        })
+
+    @handles(ClaimUser)
+    def handle_claim_user(self, message):
+        try:
+            user = self.factory.claim_user(self, message.user, message.host,
+                                           message.port)
+        except UserNameAlreadyUsed:
+            self.send_error_response('LOGIN_FAILED_USER_NAME_TAKEN',
+                                     name=message.user)
+        except AddressAlreadyUsed:
+            self.send_error_response('LOGIN_FAILED_ADDRESS_IN_USE',
+                                     host=message.host, port=message.port)
+        except UserDatabaseError:
+            self.send_error_response('LOGIN_FAILED')
+        else:
+            self.send_response({'user': encode_user(user)})
+
+    @handles(ReleaseUser)
+    def handle_release_user(self, message):
+        self.factory.release_user(self, message.user)
+        self.send_response({})
+
+    @handles(RouteEvent)
+    def handle_route_event(self, message):
+        owner = self.factory.user_owners.get(message.user)
+        if owner is None:
+            self.send_error_response('USER_NOT_LOGGED_IN',
+                                     user_name=message.user)
+            return
+
+        owner.send_message(message).addErrback(
+            lambda failure: self.logger.error(
+                "Could not route event to user '{0}': {1}", message.user,
+                failure.getErrorMessage()))
+        self.send_response({})
+
+    def on_connect(self, event):
+        features = self.accept_features(event.args[0])
+        self.send_response({'features': features})
+        self.enable_features(features)
+
+    def connectionMade(self):
+        self.transport_connected = True
+        self.factory.workers.add(self)
+
+    def connectionLost(self, reason=connectionDone):
+        self.transport_connected = False
+        self.factory.worker_lost(self)
+        self.disconnect()
+
+
+class CoordinatorFactory(protocol.ServerFactory):
+    protocol = CoordinatorProtocol
+
+    def __init__(self):
+        self.user_database = UserDatabase()
+        self.user_owners = {}
+        self.workers = set()
+
+    def buildProtocol(self, address):
+        proto = self.protocol()
+        proto.factory = self
+        return proto
+
+    def broadcast(self, message, exclude=None):
+        for worker in self.workers:
+            if worker is not exclude and worker.pipelined:
+                worker.send_message(message).addErrback(
+                    lambda failure: cluster_log.error(
+                        "Could not send {0} to a worker: {1}",
+                        message.command, failure.getErrorMessage()))
+
+    def claim_user(self, worker, name, host, port):
+        user = self.user_database.add(name, host, port)
+        self.user_owners[name] = worker
+        self.broadcast(UserClaimed(user.name, user.host, user.port,
+                                   user.connected_at.isoformat()),
+                       exclude=worker)
+        return user
+
+    def release_user(self, worker, name):
+        if self.user_owners.get(name) is not worker:
+            return
+
+        del self.user_owners[name]
+        self.user_database.remove(name)
+        self.broadcast(UserReleased(name), exclude=worker)
+
+    def worker_lost(self, worker):
+        self.workers.discard(worker)
+        for name, owner in self.user_owners.items():
+            if owner is worker:
+                self.release_user(worker, name)
+
+
+class WorkerProtocol(ClusterProtocol):
+    """Worker side of the connection to the coordinator"""
+
+    log_name = 'worker'
+
+    async_transitions = {'connect'}
+
+    def on_before_connect(self, _):
+        def on_response(response):
+            if self.check_response_error(response) or not self.pipelined:
+                self.log("Coordinator handshake failed")
+                self.cancel_transition()
+                self.transport.loseConnection()
+                return
+
+            return self.send_message(ListUsers(), on_users)
+
+        def on_users(response):
+            self.factory.server_factory.replace_users(
+                response.get('users', ()))
+            self.transition()
+
+        self.send_connect(on_response).addErrback(
+            lambda _: self.cancel_transition())
+
+    def on_enter_connected(self, _):
+        self.factory.link_ready(self)
+
+    @handles(UserClaimed)
+    def handle_user_claimed(self, message):
+        self.factory.server_factory.user_claimed(
+            message.user, message.host, message.port,
+            parse_timestamp(message.connected_at))
+        self.send_response({})
+
+    @handles(UserReleased)
+    def handle_user_released(self, message):
+        self.factory.server_factory.user_released(message.user)
+        self.send_response({})
+
+    @handles(RouteEvent)
+    def handle_route_event(self, message):
+        self.send_response({})
+        self.factory.server_factory.deliver_event(
+            message.user, message.event, json.loads(message.payload))
+
+    def claim_user(self, name, host, port):
+        def on_response(response):
+            if self.check_response_error(response):
+                error = response['error']
+                if error == 'LOGIN_FAILED_USER_NAME_TAKEN':
+                    raise UserNameAlreadyUsed()
+                elif error == 'LOGIN_FAILED_ADDRESS_IN_USE':
+                    raise AddressAlreadyUsed()
+
+                raise UserDatabaseError(response.get('message'))
+
+            user = response['user']
+            return (user['name'], user['host'], user['port'],
+                    parse_timestamp(user['connected_at']))
+
+        return self.send_message(ClaimUser(name, host, port), on_response)
+
+    def release_user(self, name):
+        return self.send_message(ReleaseUser(name))
+
+    def route_event(self, name, event, *args):
+        return self.send_message(RouteEvent(name, event, json.dumps(args)))
+
+    def connectionMade(self):
+        self.transport_connected = True
+        self.connect()
+
+    def connectionLost(self, reason=connectionDone):
+        self.transport_connected = False
+        self.cancel_transition()
+        self.disconnect()
+        self.factory.link_lost(self, reason)
+
+
+class WorkerFactory(protocol.ClientFactory):
+    protocol = WorkerProtocol
+
+    def __init__(self, server_factory):
+        self.server_factory = server_factory
+        self.ready = defer.Deferred()
+
+    def buildProtocol(self, address):
+        proto = self.protocol()
+        proto.factory = self
+        return proto
+
+    def link_ready(self, link):
+        self.server_factory.cluster = link
+        if self.ready is not None:
+            d, self.ready = self.ready, None
+            d.callback(link)
+
+    def link_lost(self, link, reason):
+        cluster_log.warning("Lost connection to the coordinator: {0}",
+                            reason.getErrorMessage())
+        if self.server_factory.cluster is link:
+            self.server_factory.cluster = None
+
+        # Users from other workers cannot be reached anymore, so there is
+        # no point in continuing on our own. The link is also lost when the
+        # coordinator shuts the workers down, and then the stop requested by
+        # the signal handler may come first
+        def stop():
+            try:
+                reactor.stop()
+            except error.ReactorNotRunning:
+                pass
+
+        reactor.callLater(0, stop)
+
+    def clientConnectionFailed(self, connector, reason):
+        if self.ready is not None:
+            d, self.ready = self.ready, None
+            d.errback(reason)
+
+
+class RemoteUserProxy(object):
+    """Stand-in for the protocol of an user logged in on another worker.
+
+    Event calls are forwarded through the coordinator. The user's state is
+    not known here, so it is reported as available and the owning worker
+    rejects the chat if it is not.
+    """
+
+    current = 'logged_in'
+
+    def __init__(self, link, user_name):
+        self.link = link
+        self.user_name = user_name
+
+    def __getattr__(self, event):
+        if event not in ROUTED_EVENTS:
+            raise AttributeError(event)
+
+        def route(*args):
+            self.link.route_event(self.user_name, event, *args).addErrback(
+                lambda failure: cluster_log.error(
+                    "Could not route {0} to user '{1}': {2}", event,
+                    self.user_name, failure.getErrorMessage()))
+
+        return route
@@ -0,0 +1,260 @@
+import json
+import struct
+
+from communic8.model.messages import MessageError
+
+
+class CodecError(RuntimeError):
+    pass
+
+
+class RawJSON(str):
+    """Already encoded JSON, spliced verbatim into a response"""
+
+
+def encode_object(data, encoder):
+    """Encode the `data` dict, copying its `RawJSON` values as they are"""
+
+    raw = [(key, value) for key, value in data.iteritems()
+           if isinstance(value, RawJSON)]
+    if not raw:
+        return encoder.encode(data)
+
+    body = encoder.encode(dict((key, value)
+                               for key, value in data.iteritems()
+                               if not isinstance(value, RawJSON)))
+    key_separator, item_separator = encoder.key_separator, \
+        encoder.item_separator
+    members = item_separator.join(encoder.encode(key) + key_separator + value
+                                  for key, value in raw)
+
+    if body == '{}':
+        return '{' + members + '}'
+
+    return body[:-1] + item_separator + members + '}'
+
+
+_text_json_encoder = json.JSONEncoder()
+
+
+class TextCodec(object):
+    """Space-separated commands and JSON responses, one per CRLF line"""
+
+    name = 'text'
+    framed = False
+
+    def encode_message(self, message, request_id=None):
+        if request_id is None:
+            return str(message) + '\r\n'
+
+        return '#{0} {1}\r\n'.format(request_id, message)
+
+    def encode_response(self, data, request_id=None):
+        if request_id is not None:
+            data = dict(data, id=request_id)
+
+        return encode_object(data, _text_json_encoder) + '\r\n'
+
+    def split_frame(self, frame):
+        # Responses are always JSON objects, commands never start with a brace
+        if frame.startswith('{'):
+            data = json.loads(frame)
+            return True, data.pop('id', None), data
+
+        request_id = None
+        if frame.startswith('#'):
+            try:
+                request_id, frame = frame[1:].split(' ', 1)
+                request_id = int(request_id)
+            except ValueError:
+                raise MessageError("Invalid request id")
+
+        return False, request_id, frame
+
+    def decode_message(self, body, dispatcher):
+        return dispatcher.parse(body)
+
+    def decode_response(self, body):
+        return body
+
+
+_LENGTH = struct.Struct('!I')
+_HEADER = struct.Struct('!BI')
+_FRAME_HEADER = struct.Struct('!IBI')
+_MESSAGE_HEADER = struct.Struct('!BB')
+
+_KIND_MESSAGE = 0
+_KIND_RESPONSE = 1
+
+_NUMBER_FORMATS = {
+    int: 'i',
+    long: 'q'
+}
+
+_json_encoder = json.JSONEncoder(separators=(',', ':'))
+
+
+class _FieldLayout(object):
+    """Wire layout of a message type, computed once per type"""
+
+    def __init__(self, type_):
+        self.type_ = type_
+        self.parse_args = type_.parse_args
+
+        # Free-text messages carry a single, possibly long, string
+        if not type_.parse_args:
+            formats = ('I', )
+        else:
+            formats = tuple(_NUMBER_FORMATS.get(arg_type, 'H')
+                            for arg_type in type_.arg_types)
+
+        self.fields = tuple(
+            (struct.Struct('!' + fmt), fmt in 'HI', arg_type)
+            for fmt, arg_type in zip(formats, type_.arg_types))
+
+    def encode(self, message, request_id):
+        args = message.args()
+        if not self.parse_args:
+            args = (' '.join(map(str, args)), ) if args else ()
+
+        parts = [_MESSAGE_HEADER.pack(self.type_.opcode, len(args))]
+        try:
+            for (field, is_string, _), value in zip(self.fields, args):
+                if is_string:
+                    value = str(value)
+                    parts.append(field.pack(len(value)))
+                    parts.append(value)
+                else:
+                    parts.append(field.pack(value))
+        except struct.error:
+            raise CodecError("Message field out of range")
+
+        body = ''.join(parts)
+        return _FRAME_HEADER.pack(len(body) + _HEADER.size, _KIND_MESSAGE,
+                                  request_id or 0) + body
+
+    def decode(self, body, argc):
+        args = []
+        offset = _MESSAGE_HEADER.size
+        end = len(body)
+        try:
+            for field, is_string, arg_type in self.fields[:argc]:
+                value, = field.unpack_from(body, offset)
+                offset += field.size
+                if is_string:
+                    if offset + value > end:
+                        raise MessageError("Truncated message")
+
+                    offset += value
+                    value = body[offset - value:offset]
+                else:
+                    value = arg_type(value)
+
+                args.append(value)
+        except struct.error:
+            raise MessageError("Truncated message")
+
+        if not self.parse_args and not args:
+            args = ['']
+
+        try:
+            return self.type_(*args)
+        except TypeError:
+            raise MessageError("Invalid number of arguments for message")
+
+
+class BinaryCodec(object):
+    """Length-prefixed frames with numeric opcodes and typed fields.
+
+    Every frame is a 32-bit length followed by a kind byte and a 32-bit
+    request id (0 when absent). Messages continue with their opcode, the
+    argument count and one field per entry of `Message.arg_types`: numbers in
+    network order and strings prefixed by their length. Response bodies are
+    compact JSON.
+    """
+
+    name = 'binary'
+    framed = True
+    max_frame_length = 16 * 1024 * 1024
+
+    def __init__(self):
+        self._layouts = {}
+
+    def layout_for(self, type_):
+        try:
+            return self._layouts[type_]
+        except KeyError:
+            layout = self._layouts[type_] = _FieldLayout(type_)
+            return layout
+
+    def encode_message(self, message, request_id=None):
+        return self.layout_for(type(message)).encode(message, request_id)
+
+    def encode_response(self, data, request_id=None):
+        body = encode_object(data, _json_encoder)
+        return _FRAME_HEADER.pack(len(body) + _HEADER.size, _KIND_RESPONSE,
+                                  request_id or 0) + body
+
+    def next_frame(self, buf, offset=0):
+        """The frame starting at `offset` in `buf` and the offset after it,
+        or None if it is not complete yet"""
+
+        if len(buf) - offset < _LENGTH.size:
+            return None
+
+        length, = _LENGTH.unpack_from(buf, offset)
+        if length > self.max_frame_length:
+            raise CodecError("Frame too long")
+
+        start = offset + _LENGTH.size
+        if len(buf) - start < length:
+            return None
+
+        return buf[start:start + length], start + length
+
+    def split_frames(self, buf):
+        """Split complete frames out of `buf`, returning them and the rest"""
+
+        frames = []
+        offset = 0
+        while True:
+            frame = self.next_frame(buf, offset)
+            if frame is None:
+                break
+
+            body, offset = frame
+            frames.append(body)
+
+        return frames, buf[offset:]
+
+    def split_frame(self, frame):
+        try:
+            kind, request_id = _HEADER.unpack_from(frame)
+        except struct.error:
+            raise MessageError("Truncated frame")
+
+        return kind == _KIND_RESPONSE, request_id or None, frame[_HEADER.size:]
+
+    def decode_message(self, body, dispatcher):
+        try:
+            opcode, argc = _MESSAGE_HEADER.unpack_from(body)
+        except struct.error:
+            raise MessageError("Truncated message")
+
+        layout = self.layout_for(dispatcher.type_for_opcode(opcode))
+        if argc > len(layout.fields):
+            raise MessageError("Invalid number of arguments for message")
+
+        return layout.decode(body, argc)
+
+    def decode_response(self, body):
+        return json.loads(body)
+
+
+text_codec = TextCodec()
+binary_codec = BinaryCodec()
+
+CODECS = {
+    text_codec.name: text_codec,
+    binary_codec.name: binary_codec
+}
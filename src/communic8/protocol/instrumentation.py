@@ -0,0 +1,54 @@
+import time
+
+from communic8.util.metrics import registry
+
+
+class ProtocolMetrics(object):
+    """The metrics recorded by every `CommonProtocol`.
+
+    Message metrics are labeled by the protocol's log category, so the
+    server's client connections and the links between its processes can
+    be told apart.
+    """
+
+    def __init__(self, registry):
+        self.received = registry.counter(
+            'messages_received_total', "Messages received, by command",
+            ('protocol', 'command'))
+        self.sent = registry.counter(
+            'messages_sent_total', "Messages sent, by command",
+            ('protocol', 'command'))
+        self.responses = registry.counter(
+            'responses_sent_total', "Responses sent",
+            ('protocol', ))
+        self.errors = registry.counter(
+            'errors_sent_total', "Error responses sent, by error key",
+            ('protocol', 'error'))
+        self.timeouts = registry.counter(
+            'response_timeouts_total',
+            "Sent messages whose response never arrived, by command",
+            ('protocol', 'command'))
+        self.handler_seconds = registry.histogram(
+            'handler_seconds',
+            "Time spent handling a received message, by command",
+            ('protocol', 'command'))
+        self.response_seconds = registry.histogram(
+            'response_seconds',
+            "Time until the response to a sent message, by command",
+            ('protocol', 'command'))
+        self.bytes_in = registry.counter(
+            'bytes_received_total', "Bytes received", ('protocol', ))
+        self.bytes_out = registry.counter(
+            'bytes_sent_total', "Bytes sent", ('protocol', ))
+        self.transitions = registry.counter(
+            'state_changes_total', "State machine transitions, by event",
+            ('protocol', 'event'))
+        self.states = registry.gauge(
+            'connections', "Open connections, by state",
+            ('protocol', 'state'))
+
+    # Wall clock, good enough for latencies of a single process
+    now = staticmethod(time.time)
+
+
+protocol_metrics = ProtocolMetrics(registry)
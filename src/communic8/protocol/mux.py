@@ -0,0 +1,305 @@
+"""Logical channels over a single P2P connection.
+
+Once multiplexing is negotiated, everything on the connection travels in
+frames of a channel number, a kind and a length. Messages and responses go
+on the control channel, chat on a channel of its own, and file data on a
+file channel, so a transfer no longer takes the whole connection over.
+
+Frames are only handed to the transport while it is not asking for a
+pause, so little is buffered ahead of the socket. The channel to send from
+next is picked by deficit round robin, each channel taking up to its
+weight in quanta per round. A channel that had nothing to send joins the
+round at the front: a chat message only waits for the frame in progress,
+not for a round of bulk data.
+
+File channels are flow controlled by credit. The receiver grants the
+sender `window` bytes up front, and grants more as it hands data on.
+Whoever takes the data can pause the channel, which holds back grants
+instead of pausing the whole connection, so chat keeps flowing while a
+slow disk catches up.
+"""
+
+import struct
+from collections import deque
+
+from zope.interface import implements
+from twisted.internet import defer, interfaces
+
+
+CONTROL = 0
+CHAT = 1
+FILE = 2
+
+_FRAME = struct.Struct('!BBI')
+_DATA = 0
+_CREDIT = 1
+
+
+class MuxError(RuntimeError):
+    pass
+
+
+class Channel(object):
+    """One channel of a `Multiplexer`.
+
+    Stands in for the transport of whatever writes to the channel, pausing
+    a streaming producer while more than `buffer_size` bytes are queued.
+    For whoever reads from it, it is the producer: pausing it holds back
+    credit, where the channel has a `window`.
+    """
+
+    implements(interfaces.IConsumer, interfaces.IPushProducer)
+
+    buffer_size = 256 * 1024
+
+    def __init__(self, mux, number, weight, window=None):
+        self.mux = mux
+        self.number = number
+        self.weight = weight
+        self.window = window
+
+        self.queue = deque()
+        self.head = 0
+        self.queued = 0
+        self.deficit = 0
+        self.producer = None
+        self.producer_paused = False
+        self.draining = []
+
+        # Bytes the peer still takes from us, and that we still take from
+        # it. None on channels without flow control
+        self.credit = None if window is None else 0
+        self.allowed = window
+        self.ungranted = 0
+        self.paused = False
+
+        # Received data not parsed yet, for channels carrying messages
+        self.buffer = ''
+
+    # Sending side
+
+    def write(self, data):
+        if not data:
+            return
+
+        self.queue.append(data)
+        self.queued += len(data)
+        self.mux.schedule(self)
+
+        if self.queued > self.buffer_size and self.producer is not None \
+                and not self.producer_paused:
+            self.producer_paused = True
+            self.producer.pauseProducing()
+
+    def writeSequence(self, data):
+        self.write(''.join(data))
+
+    def registerProducer(self, producer, streaming):
+        if not streaming:
+            raise MuxError("Channels only take streaming producers")
+
+        self.producer = producer
+        self.producer_paused = False
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def drained(self):
+        """Deferred fired once everything written so far is handed to the
+        connection, ahead of whatever other channels send after that"""
+
+        d = defer.Deferred()
+        if self.queued:
+            self.draining.append(d)
+        else:
+            d.callback(None)
+
+        return d
+
+    def sendable(self):
+        return bool(self.queue) and (self.credit is None or self.credit > 0)
+
+    def take(self, limit):
+        """Up to `limit` bytes from the queue, within the credit"""
+
+        if self.credit is not None:
+            limit = min(limit, self.credit)
+
+        head = self.queue[0]
+        data = head[self.head:self.head + limit] \
+            if self.head or len(head) > limit else head
+        self.head += len(data)
+        if self.head == len(head):
+            self.queue.popleft()
+            self.head = 0
+
+        self.queued -= len(data)
+        if self.credit is not None:
+            self.credit -= len(data)
+
+        return data
+
+    def sent(self):
+        if self.producer_paused and self.queued <= self.buffer_size // 2:
+            self.producer_paused = False
+            if self.producer is not None:
+                self.producer.resumeProducing()
+
+        if not self.queued and self.draining:
+            draining, self.draining = self.draining, []
+            for d in draining:
+                d.callback(None)
+
+    def credited(self, amount):
+        if self.credit is None:
+            raise MuxError("Credit for channel {0}, which has no flow "
+                           "control".format(self.number))
+
+        self.credit += amount
+        self.mux.schedule(self)
+
+    # Receiving side
+
+    def received(self, length):
+        if self.allowed is None:
+            return
+
+        self.allowed -= length
+        if self.allowed < 0:
+            raise MuxError("Channel {0} sent beyond its credit".format(
+                self.number))
+
+        self.ungranted += length
+        if self.ungranted >= self.window // 4:
+            self.grant()
+
+    def grant(self):
+        if self.paused or not self.ungranted:
+            return
+
+        amount, self.ungranted = self.ungranted, 0
+        self.allowed += amount
+        self.mux.send_credit(self.number, amount)
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.grant()
+
+    def stopProducing(self):
+        pass
+
+
+class Multiplexer(object):
+    """Frames the traffic of channels onto `transport`, and hands the data
+    received on each to `data_received`, with the channel"""
+
+    implements(interfaces.IPushProducer)
+
+    # Largest data frame sent, and bytes a channel of weight 1 sends per
+    # round
+    frame_size = 16 * 1024
+    quantum = 16 * 1024
+
+    max_frame_length = 16 * 1024 * 1024
+
+    def __init__(self, transport, data_received):
+        self.transport = transport
+        self.data_received = data_received
+        self.channels = {}
+        self.active = deque()
+        self.paused = False
+        self.pumping = False
+        self.buffer = ''
+
+        transport.registerProducer(self, True)
+
+    def open(self, number, weight=1, window=None):
+        """Opens channel `number`. A `window` puts it under flow control,
+        and grants that much credit to the peer"""
+
+        channel = self.channels[number] = Channel(self, number, weight,
+                                                  window)
+        if window is not None:
+            self.send_credit(number, window)
+
+        return channel
+
+    def send_credit(self, number, amount):
+        self.transport.write(_FRAME.pack(number, _CREDIT, amount))
+
+    def schedule(self, channel):
+        if channel.sendable() and channel not in self.active:
+            self.active.appendleft(channel)
+
+        self._pump()
+
+    def _pump(self):
+        if self.pumping:
+            return
+
+        self.pumping = True
+        try:
+            while self.active and not self.paused:
+                channel = self.active[0]
+                if channel.deficit <= 0:
+                    channel.deficit += channel.weight * self.quantum
+
+                while channel.deficit > 0 and channel.sendable() and \
+                        not self.paused:
+                    data = channel.take(min(self.frame_size, channel.deficit))
+                    channel.deficit -= len(data)
+                    self.transport.writeSequence(
+                        [_FRAME.pack(channel.number, _DATA, len(data)), data])
+                    channel.sent()
+
+                if not channel.sendable():
+                    channel.deficit = 0
+                    self.active.remove(channel)
+                elif channel.deficit <= 0:
+                    self.active.rotate(-1)
+        finally:
+            self.pumping = False
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._pump()
+
+    def stopProducing(self):
+        self.paused = True
+        self.active.clear()
+
+    def dataReceived(self, data):
+        """Splits frames out of what arrives on the connection. Raises
+        `MuxError` if it is not valid"""
+
+        buf = self.buffer + data if self.buffer else data
+        offset = 0
+        try:
+            while len(buf) - offset >= _FRAME.size:
+                number, kind, length = _FRAME.unpack_from(buf, offset)
+                channel = self.channels.get(number)
+                if channel is None:
+                    raise MuxError("Unknown channel {0}".format(number))
+
+                if kind == _CREDIT:
+                    offset += _FRAME.size
+                    channel.credited(length)
+                    continue
+                elif kind != _DATA or length > self.max_frame_length:
+                    raise MuxError("Invalid frame")
+
+                start = offset + _FRAME.size
+                if len(buf) - start < length:
+                    break
+
+                offset = start + length
+                channel.received(length)
+                self.data_received(channel, buf[start:offset])
+        finally:
+            self.buffer = buf[offset:]
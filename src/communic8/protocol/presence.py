@@ -0,0 +1,97 @@
+from twisted.internet import reactor
+
+from communic8.model.messages import UserJoined, UserLeft
+from communic8.protocol.codec import RawJSON
+
+
+class PresenceHub(object):
+    """Pushes user directory changes to subscribed protocols.
+
+    Changes are collected during a reactor iteration and flushed together,
+    encoded once per codec, so a burst of logins costs each subscriber a
+    single write. Every delta carries the directory version it produces; a
+    subscriber that sees a gap in versions should subscribe again to get a
+    fresh snapshot.
+    """
+
+    def __init__(self, user_database, clock=reactor):
+        self.clock = clock
+        self.version = 0
+        self.subscribers = set()
+        self.pending = []
+        self.flush_call = None
+
+        self.user_database = user_database
+        user_database.add_observer(self)
+
+    def close(self):
+        self.user_database.remove_observer(self)
+        if self.flush_call and self.flush_call.active():
+            self.flush_call.cancel()
+
+    def subscribe(self, protocol):
+        # Deltas still pending are already part of the snapshot
+        self.flush()
+        self.subscribers.add(protocol)
+
+        users = RawJSON(self.user_database.snapshot().page())
+        return self.version, users
+
+    def unsubscribe(self, protocol):
+        self.subscribers.discard(protocol)
+
+    def _changed(self, change, user):
+        if not self.subscribers and not self.pending:
+            self.version += 1
+            return
+
+        # A login undone within the same iteration is never published
+        if change == 'left':
+            for n in range(len(self.pending) - 1, -1, -1):
+                pending_change, pending_user = self.pending[n]
+                if pending_user.name == user.name:
+                    if pending_change == 'joined':
+                        del self.pending[n]
+                        return
+                    break
+
+        self.pending.append((change, user))
+        if self.subscribers and self.flush_call is None:
+            self.flush_call = self.clock.callLater(0, self.flush)
+
+    def user_added(self, user):
+        self._changed('joined', user)
+
+    def user_removed(self, user):
+        self._changed('left', user)
+
+    def flush(self):
+        self.flush_call = None
+        if not self.pending:
+            return
+
+        messages = []
+        for change, user in self.pending:
+            self.version += 1
+            if change == 'joined':
+                messages.append(UserJoined(self.version, user.name,
+                                           user.connected_at.isoformat()))
+            else:
+                messages.append(UserLeft(self.version, user.name))
+
+        self.pending = []
+
+        encoded = {}
+        for protocol in list(self.subscribers):
+            if not protocol.transport_connected:
+                self.subscribers.discard(protocol)
+                continue
+
+            codec = protocol.codec
+            try:
+                data = encoded[codec]
+            except KeyError:
+                data = encoded[codec] = ''.join(
+                    codec.encode_message(message) for message in messages)
+
+            protocol.transport.write(data)
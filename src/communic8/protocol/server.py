@@ -1,115 +1,193 @@
-from twisted.internet import protocol, task, reactor
-from twisted.python import log
+from twisted.internet import defer, protocol, task, reactor
+from fysom import FysomError
 
 from communic8.model.user import User, UserDatabase, UserNameAlreadyUsed, \
-    AddressAlreadyUsed, UserDatabaseError
+    AddressAlreadyUsed, UserDatabaseError, parse_timestamp
 from communic8.model.messages import *
-from communic8.protocol import CommonProtocol
+from communic8.protocol import CommonProtocol, handles
+from communic8.protocol.codec import RawJSON
+from communic8.protocol.cluster import RemoteUserProxy, ROUTED_EVENTS
+from communic8.protocol.presence import PresenceHub
+from communic8.protocol.sessions import IdleReaper
 from communic8.util import Fysom
+from communic8.util.logger import get_logger
+from communic8.util.metrics import registry
+from communic8.util.timers import shared_wheel
 from twisted.internet.protocol import DatagramProtocol
 
 
+server_log = get_logger('server')
+
+
 class Protocol(CommonProtocol, Fysom, DatagramProtocol):
     ERROR_MESSAGES = {
         'LOGIN_FAILED_USER_NAME_TAKEN': "An user with name '{name}' is already logged in",
-        'LOGIN_FAILED_ADDRESS_IN_USE': "An user with address {host}:{port!d} is already logged in",
-        'LOGIN_FAILED': "Login failed for unknown reasons"
+        'LOGIN_FAILED_ADDRESS_IN_USE': "An user with address {host}:{port} is already logged in",
+        'LOGIN_FAILED': "Login failed for unknown reasons",
+        'INVALID_USER_LIST_PAGE': "Invalid user list page at offset {offset} with limit {limit}",
+        'NOT_ALLOWED': "Command {command} is not allowed from {host}"
     }
 
+    # Seconds an user has to accept or reject a chat request
+    chat_confirmation_timeout = 30
+
+    # Largest page of users sent in reply to a paged LIST_USERS, keeping
+    # text replies well under LineReceiver.MAX_LENGTH
+    max_user_list_page = 100
+
+    # Claiming the user name may have to wait for the coordinator
+    async_transitions = {'login'}
+
+    initial = 'waiting_connection'
+    events = [
+        # event / from / to
+        ('connect',
+            'waiting_connection', 'waiting_login'),
+        ('disconnect',
+            '*', 'done'),
+        ('logout',
+            '*', 'waiting_login'),
+        ('login',
+            'waiting_login', 'logged_in'),
+        ('send_user_list',
+            'logged_in', 'logged_in'),
+        ('chat_initiate',
+            'logged_in', 'waiting_other_confirmation'),
+        ('chat_ask_confirmation',
+            'logged_in', 'waiting_client_confirmation'),
+        ('chat_confirmed',
+            'waiting_other_confirmation', 'chatting'),
+        ('chat_rejected',
+            'waiting_other_confirmation', 'logged_in'),
+        ('chat_confirm',
+            'waiting_client_confirmation', 'chatting'),
+        ('chat_reject',
+            'waiting_client_confirmation', 'logged_in'),
+        ('subscribe_presence',
+            ['logged_in', 'waiting_other_confirmation',
+             'waiting_client_confirmation', 'chatting'], '='),
+        ('unsubscribe_presence',
+            ['logged_in', 'waiting_other_confirmation',
+             'waiting_client_confirmation', 'chatting'], '='),
+        ('ending_chat',
+            'chatting', 'logged_in'),
+        ('chat_finished',
+            'chatting', 'logged_in')
+    ]
+
     def __init__(self):
         CommonProtocol.__init__(self)
-        Fysom.__init__(self, initial='waiting_connection', events=[
-            # event / from / to
-            ('connect',
-                'waiting_connection', 'waiting_login'),
-            ('disconnect',
-                '*', 'done'),
-            ('logout',
-                '*', 'waiting_login'),
-            ('login',
-                'waiting_login', 'logged_in'),
-            ('send_user_list',
-                'logged_in', 'logged_in'),
-            ('chat_initiate',
-                'logged_in', 'waiting_other_confirmation'),
-            ('chat_ask_confirmation',
-                'logged_in', 'waiting_client_confirmation'),
-            ('chat_confirmed',
-                'waiting_other_confirmation', 'chatting'),
-            ('chat_rejected',
-                'waiting_other_confirmation', 'logged_in'),
-            ('chat_confirm',
-                'waiting_client_confirmation', 'chatting'),
-            ('chat_reject',
-                'waiting_client_confirmation', 'logged_in'),
-            ('chat_finished',
-                'chatting', 'logged_in')
-        ])
+        Fysom.__init__(self)
 
         self.factory = None
         self.user = None
         self.requesting_user = None
+        self.chat_request_id = None
 
     @property
     def user_database(self):
         return self.factory.user_database
 
-    @property
-    def message_dispatcher(self):
-        return self.factory.message_dispatcher
-
     def on_datagram_received(self, datagram, adress):
         print(datagram)
 
     def getMsg(self, datagram):
         print (datagram)
 
-    def on_message_received(self, message):
-        for msg_cls, action in {
-            Connect:
-                lambda m: self.connect(),
-            Login:
-                lambda m: self.login(m.user),
-            Quit:
-                lambda m: self.disconnect(),
-            Logout:
-                lambda m: self.logout(),
-            ListUsers:
-                lambda m: self.send_user_list(),
-            RequestChat:
-                lambda m: self.chat_initiate(m.user),
-            EndChat:
-                lambda m: self.ending_chat(m.user)
-        }.items():
-            if isinstance(message, msg_cls):
-                action(message)
-                return
+    @handles(Connect)
+    def handle_connect(self, message):
+        self.connect(message.features)
 
-        raise MessageError("Unhandled message {0}".format(message.command))
+    @handles(Login)
+    def handle_login(self, message):
+        self.login(message.user)
 
-    def on_connect(self, event):
+    @handles(Quit)
+    def handle_quit(self, message):
+        self.disconnect()
+
+    @handles(Logout)
+    def handle_logout(self, message):
+        self.logout()
+
+    @handles(Heartbeat)
+    def handle_heartbeat(self, message):
         self.send_response({})
 
-    def on_before_login(self, event):
+    @handles(Stats)
+    def handle_stats(self, message):
+        host = self.transport.getPeer().host
+        if host not in self.factory.admin_hosts:
+            self.send_error_response('NOT_ALLOWED', command=message.command,
+                                     host=host)
+            return
+
+        self.send_response({'stats': self.factory.metrics.snapshot()})
+
+    @handles(ListUsers)
+    def handle_list_users(self, message):
+        self.send_user_list(message.offset, message.limit)
+
+    @handles(SubscribePresence)
+    def handle_subscribe_presence(self, message):
+        self.subscribe_presence()
+
+    @handles(UnsubscribePresence)
+    def handle_unsubscribe_presence(self, message):
+        self.unsubscribe_presence()
+
+    @handles(RequestChat)
+    def handle_request_chat(self, message):
+        self.chat_initiate(message.user)
+
+    @handles(EndChat)
+    def handle_end_chat(self, message):
+        self.ending_chat(message.user)
+
+    def on_connect(self, event):
+        features = self.accept_features(event.args[0])
+        self.send_response({'features': features})
+        self.enable_features(features)
+
+    def on_leave_waiting_login(self, event):
+        if event.event != 'login':
+            return
+
         user_name = event.args[0]
         address = self.transport.getPeer()
         host, port = address.host, address.port
+        request_id = self.current_request_id
 
-        try:
-            self.user = self.user_database.add(user_name, host, port)
-        except UserNameAlreadyUsed:
-            self.send_error_response('LOGIN_FAILED_USER_NAME_TAKEN',
-                                     name=user_name)
-        except AddressAlreadyUsed:
-            self.send_error_response('LOGIN_FAILED_ADDRESS_IN_USE', host=host,
-                                     port=port)
-        except UserDatabaseError:
-            self.send_error_response('LOGIN_FAILED')
-        else:
+        def on_claimed(user):
+            if not hasattr(self, 'transition'):
+                # Disconnected while waiting
+                self.factory.release_user(user.name)
+                return
+
+            self.user = user
             self.factory.set_protocol_user(self, user_name)
-            return True
+            self.current_request_id = request_id
+            try:
+                self.transition()
+            finally:
+                self.current_request_id = None
+
+        def on_failure(failure):
+            if failure.check(UserNameAlreadyUsed):
+                self.send_error_response('LOGIN_FAILED_USER_NAME_TAKEN',
+                                         name=user_name, request_id=request_id)
+            elif failure.check(AddressAlreadyUsed):
+                self.send_error_response('LOGIN_FAILED_ADDRESS_IN_USE',
+                                         host=host, port=port,
+                                         request_id=request_id)
+            else:
+                self.log("Login failed: {e}", e=failure.getErrorMessage())
+                self.send_error_response('LOGIN_FAILED', request_id=request_id)
 
-        return False
+            self.cancel_transition()
+
+        self.factory.claim_user(user_name, host, port).addCallbacks(
+            on_claimed, on_failure)
 
     def on_after_login(self, event):
         self.log("Login successful as '{user}'", user=self.user.name)
@@ -127,8 +205,10 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
         return True
 
     def _logout(self):
+        self.factory.presence.unsubscribe(self)
+
         if self.user:
-            self.user_database.remove(self.user.name)
+            self.factory.release_user(self.user.name)
             self.factory.remove_protocol_user(self.user.name)
 
         self.user = None
@@ -144,12 +224,44 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
             self.transport.loseConnection()
 
     def on_send_user_list(self, event):
-        users = []
-        for user in self.user_database.users():
-            users.append({'name': user.name,
-                          'connected_at': user.connected_at.isoformat()})
-
-        self.send_response({'result:': 'ok', 'users:': users})
+        offset, limit = event.args
+        snapshot = self.user_database.snapshot()
+
+        # Without paging arguments the whole list is sent, as before
+        if offset is None and limit is None:
+            self.send_response({'result': 'ok',
+                                'users': RawJSON(snapshot.page()),
+                                'total': len(snapshot),
+                                'generation': snapshot.generation})
+            return
+
+        offset = offset or 0
+        if limit is None:
+            limit = self.max_user_list_page
+
+        if offset < 0 or limit <= 0:
+            self.send_error_response('INVALID_USER_LIST_PAGE', offset=offset,
+                                     limit=limit)
+            return
+
+        limit = min(limit, self.max_user_list_page)
+        next_offset = offset + limit
+        if next_offset >= len(snapshot):
+            next_offset = None
+
+        self.send_response({'result': 'ok',
+                            'users': RawJSON(snapshot.page(offset, limit)),
+                            'total': len(snapshot),
+                            'generation': snapshot.generation,
+                            'next_offset': next_offset})
+
+    def on_subscribe_presence(self, event):
+        version, users = self.factory.presence.subscribe(self)
+        self.send_response({'version': version, 'users': users})
+
+    def on_unsubscribe_presence(self, event):
+        self.factory.presence.unsubscribe(self)
+        self.send_response({})
 
     def on_before_chat_initiate(self, event):
         user_name = event.args[0]
@@ -177,6 +289,7 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
         user_proto = self.factory.get_user_protocol(user_name)
         assert user_proto is not None
 
+        self.chat_request_id = self.current_request_id
         reactor.callLater(0, user_proto.chat_ask_confirmation, self.user.name)
 
     def on_chat_ask_confirmation(self, event):
@@ -192,8 +305,16 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
                 self.log("Chat rejected by client")
                 self.chat_reject()
 
+        def on_failure(failure):
+            failure.trap(defer.CancelledError)
+            if self.current == 'waiting_client_confirmation':
+                self.log("Chat confirmation timed out")
+                self.chat_reject()
+
         self.requesting_user = user_name
-        self.send_message(ChatRequested(user_name), on_response)
+        self.send_message(ChatRequested(user_name), on_response,
+                          timeout=self.chat_confirmation_timeout).addErrback(
+            on_failure)
 
     def on_chat_confirm(self, event):
         port = event.args[0]
@@ -226,7 +347,9 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
 
         self.log("Received chat confirmation from {from_name} to {to_name}",
                  from_name=self.user.name, to_name=user_name)
-        self.send_response({'result:': 'confirmed', 'host': host, 'port': port})
+        self.send_response({'result:': 'confirmed', 'host': host, 'port': port},
+                           request_id=self.chat_request_id)
+        self.chat_request_id = None
 
     def on_chat_rejected(self, event):
         user_name = event.args[0]
@@ -235,7 +358,9 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
 
         self.log("Received chat rejection from {from_name} to {to_name}",
                  from_name=self.user.name, to_name=user_name)
-        self.send_response({'result:': 'rejected'})
+        self.send_response({'result:': 'rejected'},
+                           request_id=self.chat_request_id)
+        self.chat_request_id = None
 
     def on_ending_chat(self, event):
         user_name = event.args[0]
@@ -245,8 +370,18 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
         self.log("Ending chat from {from_name} to {to_name}",
                  from_name=self.user.name, to_name=user_name)
 
+        self.send_response({})
         reactor.callLater (0, user_proto.chat_finished, self.user.name)
 
+    def disconnect_idle(self):
+        self.log("Disconnecting idle user '{user}'", user=self.user.name)
+        self.cancel_transition()
+        self.disconnect()
+
+        # A dead peer would never acknowledge what is left to write
+        if self.transport_connected:
+            self.transport.abortConnection()
+
     def connectionMade(self):
         self.transport_connected = True
 
@@ -255,33 +390,156 @@ class Protocol(CommonProtocol, Fysom, DatagramProtocol):
         self.cancel_transition()
         self.disconnect()
 
+    def dataReceived(self, data):
+        if self.user is not None:
+            self.factory.user_seen(self.user.name)
+
+        CommonProtocol.dataReceived(self, data)
+
 
 class Factory(protocol.ServerFactory):
     protocol = Protocol
 
-    def __init__(self):
+    # Seconds without any traffic before a logged in user is disconnected,
+    # 0 to keep idle users around until TCP notices they are gone
+    idle_timeout = 90
+
+    # Peers allowed to use administrative commands such as STATS
+    admin_hosts = ('127.0.0.1', '::1')
+
+    def __init__(self, clock=reactor, idle_timeout=None, metrics=registry):
+        self.clock = clock
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+
         self.user_database = UserDatabase()
-        self.message_dispatcher = MessageDispatcher().register(
-            Connect, Quit,
-            Login, Logout,
-            ListUsers,
-            RequestChat, ChatRequested,
-            EndChat,
-        )
+        self.message_dispatcher = self.protocol.message_handlers().dispatcher
         self.user_protocols = {}
+        self.presence = PresenceHub(self.user_database, clock)
+
+        self.reaper = None
+        if self.idle_timeout:
+            self.reaper = IdleReaper(self.user_database, self.idle_timeout,
+                                     self.reap_idle_user, shared_wheel(clock))
+
+        # Link to the coordinator when running as one of several workers
+        self.cluster = None
+
+        self.metrics = metrics
+        self.register_metrics(metrics)
+
+    def register_metrics(self, metrics):
+        metrics.callback('sessions', "Users logged in to this process",
+                         lambda: len(self.user_protocols))
+        metrics.callback('directory_users',
+                         "Users in the directory, including other workers",
+                         lambda: len(self.user_database))
+        metrics.callback('pending_chat_requests',
+                         "Chat requests waiting for the other user",
+                         self.pending_chat_requests)
+        metrics.callback('presence_subscribers',
+                         "Connections subscribed to presence updates",
+                         lambda: len(self.presence.subscribers))
+
+        if self.reaper:
+            metrics.callback('idle_checks_total',
+                             "Idle session timers that expired",
+                             lambda: self.reaper.checked, 'counter')
+            metrics.callback('idle_sessions_reaped_total',
+                             "Sessions disconnected for being idle",
+                             lambda: self.reaper.reaped, 'counter')
+
+    def pending_chat_requests(self):
+        return sum(1 for user_proto in self.user_protocols.itervalues()
+                   if user_proto.current == 'waiting_client_confirmation')
 
     def set_protocol_user(self, user_protocol, user_name):
         self.user_protocols[user_name] = user_protocol
+        if self.reaper:
+            self.reaper.watch(user_name)
 
     def remove_protocol_user(self, user_name):
         del self.user_protocols[user_name]
+        if self.reaper:
+            self.reaper.forget(user_name)
+
+    def user_seen(self, user_name):
+        self.user_database.update_user_last_seen(user_name,
+                                                 self.clock.seconds())
+
+    def reap_idle_user(self, user_name):
+        user_proto = self.user_protocols.get(user_name)
+        if user_proto is not None:
+            user_proto.disconnect_idle()
 
     def get_user_protocol(self, user_name, default=None):
-        return self.user_protocols.get(user_name, default)
+        user_proto = self.user_protocols.get(user_name)
+        if user_proto is not None:
+            return user_proto
+
+        if self.cluster and self.user_database.get(user_name):
+            return RemoteUserProxy(self.cluster, user_name)
+
+        return default
+
+    def claim_user(self, name, host, port):
+        if not self.cluster:
+            return defer.maybeDeferred(self.user_database.add, name, host,
+                                       port)
+
+        def on_claimed(user):
+            self.user_claimed(*user)
+            return self.user_database[name]
+
+        return self.cluster.claim_user(name, host, port).addCallback(
+            on_claimed)
+
+    def release_user(self, name):
+        self.user_released(name)
+        if self.cluster:
+            self.cluster.release_user(name)
+
+    # Directory replica updates from the coordinator
+
+    def user_claimed(self, name, host, port, connected_at):
+        # Drop entries made stale by a release we have not heard of yet
+        for stale in (self.user_database.get(name),
+                      self.user_database.get_by_address(host, port)):
+            if stale is not None and self.user_database.get(stale.name):
+                self.user_database.remove(stale.name)
+
+        self.user_database.add(name, host, port, connected_at)
+
+    def user_released(self, name):
+        if self.user_database.get(name) is not None:
+            self.user_database.remove(name)
+
+    def replace_users(self, users):
+        for user in list(self.user_database.users()):
+            self.user_database.remove(user.name)
+
+        for user in users:
+            self.user_claimed(user['name'], user['host'], user['port'],
+                              parse_timestamp(user['connected_at']))
+
+    def deliver_event(self, user_name, event, args):
+        user_proto = self.user_protocols.get(user_name)
+        if event in ROUTED_EVENTS and user_proto is not None:
+            try:
+                getattr(user_proto, event)(*args)
+                return
+            except FysomError:
+                pass
+
+        server_log.info("Could not deliver {0} to {1}", event, user_name)
+        if event == 'chat_ask_confirmation':
+            requesting_proto = self.get_user_protocol(args[0])
+            if requesting_proto is not None:
+                requesting_proto.chat_rejected(user_name)
 
     def buildProtocol(self, address):
         if self.user_database.get_by_address(address.host, address.port):
-            log.msg("Refused secondary connection from {0}".format(address))
+            server_log.info("Refused secondary connection from {0}", address)
             return None
 
         return protocol.ServerFactory.buildProtocol(self, address)
@@ -289,13 +547,7 @@ class Factory(protocol.ServerFactory):
 class FactoryUDP(DatagramProtocol):
     def __init__(self):
         self.user_database = UserDatabase()
-        self.message_dispatcher = MessageDispatcher().register(
-            Connect, Quit,
-            Login, Logout,
-            ListUsers,
-            RequestChat, ChatRequested,
-            EndChat,
-        )
+        self.message_dispatcher = Protocol.message_handlers().dispatcher
         self.user_protocols = {}
 
     def set_protocol_user(self, user_protocol, user_name):
@@ -0,0 +1,58 @@
+from communic8.model.user import UserNotLoggedIn
+from communic8.util.timers import shared_wheel
+
+
+class IdleReaper(object):
+    """Drops sessions that sent nothing for `timeout` seconds.
+
+    Traffic only updates the last seen time in the user database. Each
+    watched user has one timer on the wheel, due when it would become idle;
+    if the user was seen in the meantime the timer is moved to the new
+    deadline instead of reaping, so a tick does work for the expired timers
+    alone.
+    """
+
+    def __init__(self, user_database, timeout, on_idle, wheel=None):
+        self.user_database = user_database
+        self.timeout = timeout
+        self.on_idle = on_idle
+        self.wheel = wheel or shared_wheel()
+        self.timers = {}
+
+        self.checked = 0
+        self.rescheduled = 0
+        self.reaped = 0
+
+    def watch(self, name):
+        self.forget(name)
+        now = self.wheel.clock.seconds()
+        self.user_database.update_user_last_seen(name, now)
+        self.timers[name] = self.wheel.call_at(now + self.timeout,
+                                               self._check, name)
+
+    def forget(self, name):
+        timer = self.timers.pop(name, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _check(self, name):
+        self.checked += 1
+        try:
+            last_seen = self.user_database.get_user_last_seen(name)
+        except UserNotLoggedIn:
+            del self.timers[name]
+            return
+
+        deadline = last_seen + self.timeout
+        if deadline > self.wheel.clock.seconds():
+            self.rescheduled += 1
+            self.timers[name] = self.wheel.call_at(deadline, self._check, name)
+            return
+
+        del self.timers[name]
+        self.reaped += 1
+        self.on_idle(name)
+
+    def stats(self):
+        return {'watched': len(self.timers), 'checked': self.checked,
+                'rescheduled': self.rescheduled, 'reaped': self.reaped}
@@ -0,0 +1,372 @@
+"""zlib compression of transfers, block by block.
+
+A compressed transfer is a sequence of frames, each holding a block of the
+file: a flag, the length of the payload and the length of the block, then
+the payload. Blocks are compressed independently, in the reactor's thread
+pool, and the ones that do not shrink are sent as they are. Files whose
+MIME type says they are already compressed are not compressed at all.
+"""
+
+import struct
+import zlib
+from collections import deque
+
+from zope.interface import implements
+from twisted.internet import interfaces, threads
+from twisted.python import failure
+
+from communic8.transfer.pipeline import ReadAhead
+from communic8.transfer.sender import FileSender, SendError
+
+
+COMPRESSION = 'zlib'
+
+_FRAME_HEADER = struct.Struct('!BII')
+_RAW = 0
+_ZLIB = 1
+
+MAX_BLOCK_SIZE = 4 * 1024 * 1024
+
+_COMPRESSED_PREFIXES = ('image/', 'audio/', 'video/')
+_COMPRESSED_TYPES = frozenset([
+    'application/zip',
+    'application/gzip',
+    'application/x-gzip',
+    'application/x-bzip2',
+    'application/x-xz',
+    'application/x-lzma',
+    'application/x-7z-compressed',
+    'application/x-rar-compressed',
+    'application/x-compress',
+    'application/x-zstd',
+    'application/java-archive',
+    'application/epub+zip',
+    'application/pdf',
+    'application/vnd.android.package-archive',
+    'font/woff',
+    'font/woff2',
+])
+# Formats that are images, but stored uncompressed
+_UNCOMPRESSED_TYPES = frozenset([
+    'image/bmp',
+    'image/x-ms-bmp',
+    'image/svg+xml',
+    'image/x-portable-pixmap',
+    'image/tiff',
+])
+
+
+class CompressionError(RuntimeError):
+    pass
+
+
+def is_compressible(mime_type):
+    """Whether a file of `mime_type` is worth compressing"""
+
+    if not mime_type or mime_type in _UNCOMPRESSED_TYPES:
+        return True
+
+    if mime_type in _COMPRESSED_TYPES or \
+            mime_type.startswith(_COMPRESSED_PREFIXES) or \
+            mime_type.startswith('application/vnd.openxmlformats') or \
+            mime_type.startswith('application/vnd.oasis.opendocument'):
+        return False
+
+    return True
+
+
+def raw_frame(data):
+    return _FRAME_HEADER.pack(_RAW, len(data), len(data)) + data
+
+
+def compress_frame(data, level):
+    """The frame for a block, compressed if that makes it smaller. Runs in
+    the thread pool"""
+
+    compressed = zlib.compress(data, level)
+    if len(compressed) < len(data):
+        return _FRAME_HEADER.pack(_ZLIB, len(compressed), len(data)) + \
+            compressed
+
+    return raw_frame(data)
+
+
+def decompress_block(payload, length):
+    """Runs in the thread pool"""
+
+    decompressor = zlib.decompressobj()
+    try:
+        data = decompressor.decompress(payload, length)
+    except zlib.error as e:
+        raise CompressionError(str(e))
+
+    if len(data) != length or decompressor.unconsumed_tail:
+        raise CompressionError("Block does not match its length")
+
+    return data
+
+
+class CompressingSender(FileSender):
+    """Sends a compressed file as a streaming producer.
+
+    Blocks of `block_size` bytes are read ahead in the disk pool, with up
+    to `max_pending` of them being compressed at once, and written in order
+    as they are ready. After `probe_after` blocks in a row that
+    did not shrink, only one in `probe_interval` is still compressed, until
+    one does.
+    """
+
+    implements(interfaces.IPushProducer)
+
+    block_size = 256 * 1024
+    max_pending = 4
+    probe_after = 8
+    probe_interval = 16
+
+    def __init__(self, file_object, offset, length, level=1):
+        super(CompressingSender, self).__init__(file_object, offset, length)
+        self.level = level
+        self.read = 0
+        self.blocks = 0
+        self.incompressible = 0
+        self.wire_bytes = 0
+        self.paused = False
+        self.pending = deque()
+        self.reader = None
+        self.reading = False
+
+    def _start(self):
+        self.reader = ReadAhead(self.file_object, self.offset, self.length,
+                                self.block_size, self.max_pending)
+        self.transport.registerProducer(self, True)
+        self._fill()
+
+    def _close(self):
+        if self.reader is not None:
+            self.reader.close()
+        else:
+            self.file_object.close()
+
+    def _fill(self):
+        self._flush()
+        if self.file_object is None:
+            return
+
+        if not self.pending and self.read == self.length:
+            self._finish()
+        elif not (self.paused or self.reading or
+                  len(self.pending) >= self.max_pending or
+                  self.read == self.length):
+            self.reading = True
+            self.reader.read().addCallbacks(self._read_block,
+                                            self._read_failed)
+
+    def _read_block(self, data):
+        self.reading = False
+        if self.file_object is None:
+            return
+
+        if not data:
+            self._finish(SendError("File ended before {0} bytes"
+                                   .format(self.length)))
+            return
+
+        self.read += len(data)
+        self.blocks += 1
+        entry = [len(data), None]
+        self.pending.append(entry)
+
+        if self.incompressible >= self.probe_after and \
+                self.blocks % self.probe_interval:
+            entry[1] = raw_frame(data)
+        else:
+            d = threads.deferToThread(compress_frame, data, self.level)
+            d.addCallbacks(self._compressed, self._failed,
+                           callbackArgs=(entry, ))
+
+        self._fill()
+
+    def _read_failed(self, f):
+        self.reading = False
+        self._failed(f)
+
+    def _compressed(self, frame, entry):
+        entry[1] = frame
+        if ord(frame[0]) == _RAW:
+            self.incompressible += 1
+        else:
+            self.incompressible = 0
+
+        self._fill()
+
+    def _flush(self):
+        while self.pending and self.pending[0][1] is not None and \
+                self.file_object is not None:
+            length, frame = self.pending.popleft()
+            self.transport.write(frame)
+            self.sent += length
+            self.wire_bytes += len(frame)
+
+    def _failed(self, f):
+        if self.file_object is not None:
+            self._finish(SendError(f.getErrorMessage()))
+
+    def ratio(self):
+        """Bytes sent per byte of the file"""
+
+        return float(self.wire_bytes) / self.sent if self.sent else 1.0
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._fill()
+
+
+class DecompressingConsumer(object):
+    """Decompresses a transfer into `consumer`, such as a `FileConsumer`.
+
+    Blocks are decompressed in the thread pool and written in order. When
+    more than `max_pending` are waiting, the producer is paused until half
+    of them are done. It is also kept paused for as long as `consumer`,
+    to which this stands in for the producer, asks for it.
+
+    The transfer ends with the frame that completes `consumer`'s file.
+    Once it has arrived `ended` is set, the producer is let go of as it is,
+    and `write` returns whatever followed the frame.
+    """
+
+    implements(interfaces.IConsumer, interfaces.IPushProducer)
+
+    max_pending = 8
+
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self.buffer = ''
+        self.pending = deque()
+        self.producer = None
+        self.paused = False
+        self.backlogged = False
+        self.consumer_paused = False
+        self.error = None
+        self.remaining = consumer.size - consumer.offset
+        self.ended = False
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+        return self.consumer.registerProducer(self, streaming)
+
+    def unregisterProducer(self):
+        self.consumer.unregisterProducer()
+        self._release()
+
+    def finish(self):
+        self.pending.clear()
+        self.consumer.finish()
+        self._release()
+
+    def _release(self):
+        producer, self.producer = self.producer, None
+        if self.paused:
+            self.paused = False
+            if producer is not None:
+                producer.resumeProducing()
+
+    def _update(self):
+        paused = self.backlogged or self.consumer_paused
+        if paused != self.paused and self.producer is not None:
+            self.paused = paused
+            if paused:
+                self.producer.pauseProducing()
+            else:
+                self.producer.resumeProducing()
+
+    def pauseProducing(self):
+        self.consumer_paused = True
+        self._update()
+
+    def resumeProducing(self):
+        self.consumer_paused = False
+        self._update()
+
+    def stopProducing(self):
+        if self.producer is not None:
+            self.producer.stopProducing()
+
+    def write(self, data):
+        if self.ended:
+            return data
+
+        if self.error is not None:
+            return
+
+        buf = self.buffer + data
+        offset = 0
+        try:
+            while len(buf) - offset >= _FRAME_HEADER.size:
+                flag, size, length = _FRAME_HEADER.unpack_from(buf, offset)
+                if length > MAX_BLOCK_SIZE or size > length + 1024 or \
+                        flag not in (_RAW, _ZLIB) or \
+                        (flag == _RAW and size != length):
+                    raise CompressionError("Invalid compressed frame")
+
+                start = offset + _FRAME_HEADER.size
+                if len(buf) - start < size:
+                    break
+
+                self.remaining -= length
+                if self.remaining < 0:
+                    raise CompressionError("Compressed frames go past the "
+                                           "end of the file")
+
+                payload = buf[start:start + size]
+                offset = start + size
+
+                entry = [None]
+                self.pending.append(entry)
+                if flag == _RAW:
+                    entry[0] = payload
+                else:
+                    d = threads.deferToThread(decompress_block, payload,
+                                              length)
+                    d.addCallbacks(self._decompressed, self._failed,
+                                   callbackArgs=(entry, ))
+
+                if not self.remaining:
+                    self.ended = True
+                    break
+        except CompressionError as e:
+            self._failed(failure.Failure(e))
+            return
+        finally:
+            self.buffer = buf[offset:]
+
+        rest = ''
+        if self.ended:
+            rest, self.buffer = self.buffer, ''
+            self.producer = None
+
+        self._flush()
+        if len(self.pending) > self.max_pending and not self.backlogged:
+            self.backlogged = True
+            self._update()
+
+        return rest
+
+    def _decompressed(self, data, entry):
+        entry[0] = data
+        self._flush()
+
+    def _flush(self):
+        while self.pending and self.pending[0][0] is not None:
+            self.consumer.write(self.pending.popleft()[0])
+
+        if self.backlogged and len(self.pending) <= self.max_pending // 2:
+            self.backlogged = False
+            self._update()
+
+    def _failed(self, f):
+        if self.error is None:
+            self.error = f.value
+            self.finish()
@@ -0,0 +1,126 @@
+"""An index of the files in a receive directory by content.
+
+Every file received and verified is recorded under the root hash of its
+Merkle tree, which a sender offering a file includes in its request. When
+the hash of an offered file is already in the index, the receiver makes a
+local copy, a hard link where possible, instead of taking the bytes over
+the network.
+
+Entries are checked against the size and modification time of their file
+when found, so files changed or removed since are dropped from the index
+rather than served.
+"""
+
+import os
+import re
+import shutil
+
+from communic8.transfer.resume import DirectoryJournal
+
+
+_SUFFIX_RE = re.compile(r'^(.*)-(\d+)$')
+
+
+def link_or_copy(source, destination):
+    """Hard links `destination` to `source`, copying it where links are not
+    supported. A copy blocks, so this is meant to run in a thread"""
+
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+class ContentIndex(DirectoryJournal):
+    """Files of one directory by root hash.
+
+    Also hands out the names of new files. The names in the directory are
+    listed once, and the next free numbered suffix of every name is kept,
+    so finding a name for yet another copy of a file does not try every
+    suffix that is already taken. A name handed out is reserved, as its
+    file may not exist yet, until it is released.
+    """
+
+    journal_name = '.communic8-index.json'
+
+    def __init__(self, directory):
+        super(ContentIndex, self).__init__(directory)
+        self.reserved = set()
+        self.suffixes = {}
+
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            names = []
+
+        for name in names:
+            self._count(name)
+
+    def find(self, root_hash, size):
+        """Path of a file with `root_hash` and `size`, or None"""
+
+        entry = self.entries.get(root_hash)
+        if entry is None:
+            return None
+
+        path = os.path.join(self.directory, entry['path'])
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None
+
+        if stat is None or stat.st_size != size or \
+                stat.st_size != entry['size'] or \
+                stat.st_mtime != entry['mtime']:
+            self.remove(root_hash)
+            return None
+
+        return path
+
+    def add(self, root_hash, path):
+        stat = os.stat(path)
+        entry = {'path': os.path.relpath(path, self.directory),
+                 'size': stat.st_size, 'mtime': stat.st_mtime}
+        if self.entries.get(root_hash) == entry:
+            return
+
+        self.entries[root_hash] = entry
+        self._store()
+
+    def remove(self, root_hash):
+        if self.entries.pop(root_hash, None) is not None:
+            self._store()
+
+    def unique_path(self, name):
+        """A path in the directory for a new file called `name`, or a
+        numbered variant of it if that is taken"""
+
+        filename, ext = os.path.splitext(name)
+        candidate = name
+        n = self.suffixes.get((filename, ext), 0)
+
+        # The directory is checked as well, as files come and go behind
+        # the index's back
+        while candidate in self.reserved or \
+                os.path.lexists(os.path.join(self.directory, candidate)):
+            candidate = '{0}-{1}{2}'.format(filename, n, ext)
+            n += 1
+
+        self.reserved.add(candidate)
+        self._count(candidate)
+        return os.path.join(self.directory, candidate)
+
+    def release(self, path):
+        """Releases the name of `path`, handed out by `unique_path`, once
+        its file was created or given up"""
+
+        self.reserved.discard(os.path.basename(path))
+
+    def _count(self, name):
+        filename, ext = os.path.splitext(name)
+        match = _SUFFIX_RE.match(filename)
+        if match:
+            key = (match.group(1), ext)
+            n = int(match.group(2)) + 1
+            if n > self.suffixes.get(key, 0):
+                self.suffixes[key] = n
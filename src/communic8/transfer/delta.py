@@ -0,0 +1,612 @@
+"""Rsync-style delta transfers against a receiver's older copy of a file.
+
+The receiver splits its copy, the basis, into blocks and sends a weak and
+a strong checksum of each. The weak one is Adler-32, which can be rolled
+along the file a byte at a time. The sender looks for every block of the
+basis at any offset of its file and sends a sequence of operations, each
+either copying a run of blocks from the basis or carrying literal bytes.
+The receiver rebuilds the file from those into a new one, so the basis is
+untouched until the transfer is complete. It reads the basis and writes
+the new file in the disk pool, as copying blocks can take a while, and the
+sender reads the literals there too.
+
+Checksums of both files are computed in ranges by the reactor's thread
+pool. Looking for blocks goes about a byte at a time where the files
+differ, so it is slow there. The search gives up once most of what it went
+through differs, or it runs out of time, and the file is then sent whole
+as a single literal.
+"""
+
+import hashlib
+import itertools
+import math
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+
+from zope.interface import implements
+from twisted.internet import defer, interfaces, threads
+from twisted.python import failure
+
+from communic8.transfer.flow import Window
+from communic8.transfer.pipeline import ReadAhead, WriteBehind, defer_to_disk
+from communic8.transfer.sender import FileSender, SendError
+
+
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+
+# Bytes of a file checksummed, or searched for blocks, by each task given
+# to the thread pool
+TASK_SIZE = 8 * 1024 * 1024
+
+_OP = struct.Struct('!BQI')
+_LITERAL = 0
+_COPY = 1
+
+_ADLER_MOD = 65521
+
+# Longest run of literal bytes or of blocks a single operation holds
+_MAX_RUN = 1 << 31
+
+# A search gives up when over MAX_LITERAL_FRACTION of what it went through
+# is literal, once it went through SEARCH_SAMPLE bytes, or when it takes
+# longer than MIN_SEARCH_TIME seconds and a second per SEARCH_RATE bytes of
+# the file. Progress is checked every _CHECK_INTERVAL bytes without a match
+MAX_LITERAL_FRACTION = 0.5
+SEARCH_SAMPLE = 1024 * 1024
+MIN_SEARCH_TIME = 2.0
+SEARCH_RATE = 16 * 1024 * 1024
+_CHECK_INTERVAL = 64 * 1024
+
+
+class DeltaError(RuntimeError):
+    pass
+
+
+def delta_block_size(size):
+    """Block size for a basis of `size` bytes: about its square root, as
+    rsync does, so the checksums grow slowly with the file"""
+
+    block_size = int(math.sqrt(size)) // 1024 * 1024
+    return max(MIN_BLOCK_SIZE, min(MAX_BLOCK_SIZE, block_size))
+
+
+def weak_checksum(data):
+    return zlib.adler32(data) & 0xffffffff
+
+
+def strong_checksum(data):
+    return hashlib.md5(data).digest()[:8]
+
+
+def _checksum_blocks(path, block_size, first, count):
+    checksums = []
+    with open(path, 'rb') as f:
+        f.seek(first * block_size)
+        for _ in xrange(count):
+            data = f.read(block_size)
+            checksums.append('{0:08x}{1}'.format(
+                weak_checksum(data), strong_checksum(data).encode('hex')))
+
+    return checksums
+
+
+def checksum_file(path, size, block_size):
+    """Deferred firing with the checksums of every block of the file at
+    `path`, as hex strings"""
+
+    count = (size + block_size - 1) // block_size
+    per_task = max(1, TASK_SIZE // block_size)
+    tasks = [threads.deferToThread(_checksum_blocks, path, block_size, first,
+                                   min(per_task, count - first))
+             for first in xrange(0, count, per_task)]
+
+    d = defer.gatherResults(tasks, consumeErrors=True)
+    d.addCallback(lambda parts: list(itertools.chain.from_iterable(parts)))
+    return d
+
+
+class BasisChecksums(object):
+    """The receiver's checksums, indexed by weak checksum. A last block
+    shorter than the others is kept apart, as it can only match at the end
+    of the file"""
+
+    def __init__(self, checksums, size, block_size):
+        self.size = size
+        self.block_size = block_size
+        self.blocks = {}
+        self.tail = None
+
+        if len(checksums) != (size + block_size - 1) // block_size:
+            raise DeltaError("Expected checksums of {0} byte blocks of a "
+                             "{1} byte file".format(block_size, size))
+
+        for index, checksum in enumerate(checksums):
+            try:
+                weak = int(checksum[:8], 16)
+                strong = checksum[8:].decode('hex')
+            except (TypeError, ValueError):
+                raise DeltaError("Invalid checksum {0!r}".format(checksum))
+
+            length = min(block_size, size - index * block_size)
+            if length < block_size:
+                self.tail = (index, length, weak, strong)
+            else:
+                self.blocks.setdefault(weak, []).append((index, strong))
+
+    def find(self, weak, data):
+        candidates = self.blocks.get(weak)
+        if candidates:
+            strong = strong_checksum(data)
+            for index, candidate in candidates:
+                if candidate == strong:
+                    return index
+
+        return None
+
+
+class _SearchBudget(object):
+    """What searching a `size` byte file may take, shared by the tasks
+    searching it"""
+
+    def __init__(self, size):
+        self.searched = 0
+        self.literal = 0
+        self.deadline = time.time() + MIN_SEARCH_TIME + \
+            float(size) / SEARCH_RATE
+        self.exhausted = False
+        self.lock = threading.Lock()
+
+    def spend(self, searched, literal):
+        """Accounts for `searched` more bytes, `literal` of them without a
+        match. Returns whether searching is still worth it"""
+
+        with self.lock:
+            self.searched += searched
+            self.literal += literal
+            if self.searched >= SEARCH_SAMPLE and \
+                    self.literal > self.searched * MAX_LITERAL_FRACTION:
+                self.exhausted = True
+            elif time.time() > self.deadline:
+                self.exhausted = True
+
+            return not self.exhausted
+
+
+def _search(path, start, end, size, basis, budget):
+    """Operations for bytes `start` to `end` of the `size` byte file at
+    `path`. Literals are given as offsets into it, to be read when
+    sending. Returns None if `budget` runs out"""
+
+    if budget.exhausted:
+        return None
+
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    block_size = basis.block_size
+    values = bytearray(data)
+    length = len(data)
+    ops = []
+
+    def add(op, a, b):
+        if ops and ops[-1][0] == op and ops[-1][1] + ops[-1][2] == a:
+            ops[-1] = (op, ops[-1][1], ops[-1][2] + b)
+        else:
+            ops.append((op, a, b))
+
+    literal_start = 0
+    literal = 0
+    reported = reported_literal = 0
+    i = 0
+    last = length - block_size
+    candidates = basis.blocks.get
+    while i <= last:
+        weak = weak_checksum(buffer(data, i, block_size))
+        a, b = weak & 0xffff, weak >> 16
+
+        # Roll the checksum along until some block might match
+        stop = min(last, i + _CHECK_INTERVAL)
+        while not candidates(weak) and i < stop:
+            out, in_ = values[i], values[i + block_size]
+            a = (a - out + in_) % _ADLER_MOD
+            b = (b - block_size * out + a - 1) % _ADLER_MOD
+            weak = (b << 16) | a
+            i += 1
+
+        if i < last and not candidates(weak):
+            run = literal + i - literal_start
+            if not budget.spend(i - reported, run - reported_literal):
+                return None
+
+            reported, reported_literal = i, run
+            continue
+
+        index = basis.find(weak, buffer(data, i, block_size))
+        if index is None:
+            i += 1
+            continue
+
+        if literal_start < i:
+            add(_LITERAL, start + literal_start, i - literal_start)
+            literal += i - literal_start
+
+        add(_COPY, index, 1)
+        i += block_size
+        literal_start = i
+
+    # The last block of the basis can only match the end of the file, and
+    # only if this part of it is long enough to hold the block
+    if basis.tail is not None and end == size and length >= basis.tail[1]:
+        index, tail_length, tail_weak, tail_strong = basis.tail
+        tail = buffer(data, length - tail_length)
+        if length - tail_length >= literal_start and \
+                weak_checksum(tail) == tail_weak and \
+                strong_checksum(tail) == tail_strong:
+            if literal_start < length - tail_length:
+                add(_LITERAL, start + literal_start,
+                    length - tail_length - literal_start)
+
+            add(_COPY, index, 1)
+            literal_start = length
+
+    if literal_start < length:
+        add(_LITERAL, start + literal_start, length - literal_start)
+        literal += length - literal_start
+
+    budget.spend(length - reported, literal - reported_literal)
+    return ops
+
+
+def compute_delta(path, size, basis):
+    """Deferred firing with the operations that rebuild the `size` byte
+    file at `path` from the basis described by `basis`, or that send it
+    whole if looking for the basis in it is not worth it"""
+
+    budget = _SearchBudget(size)
+    tasks = [threads.deferToThread(_search, path, start,
+                                   min(start + TASK_SIZE, size), size, basis,
+                                   budget)
+             for start in xrange(0, size, TASK_SIZE)]
+
+    def merge(parts):
+        if None in parts:
+            run = _MAX_RUN - 1
+            return [(_LITERAL, offset, min(run, size - offset))
+                    for offset in xrange(0, size, run)]
+
+        ops = []
+        for op in itertools.chain.from_iterable(parts):
+            if ops and ops[-1][0] == op[0] and \
+                    ops[-1][1] + ops[-1][2] == op[1] and \
+                    ops[-1][2] + op[2] < _MAX_RUN:
+                ops[-1] = (op[0], ops[-1][1], ops[-1][2] + op[2])
+            else:
+                ops.append(op)
+
+        return ops
+
+    d = defer.gatherResults(tasks, consumeErrors=True)
+    d.addCallback(merge)
+    return d
+
+
+def literal_size(ops):
+    return sum(op[2] for op in ops if op[0] == _LITERAL)
+
+
+class DeltaSender(FileSender):
+    """Sends the operations of a delta against `basis`. The bytes of each
+    literal are read ahead in the disk pool, by a `ReadAhead` of its own"""
+
+    implements(interfaces.IPushProducer)
+
+    chunk_size = 256 * 1024
+
+    # Chunks of a literal read ahead of the transport
+    read_ahead = 4
+
+    def __init__(self, file_object, size, ops, basis):
+        super(DeltaSender, self).__init__(file_object, 0, size)
+        self.block_size = basis.block_size
+        self.basis_size = basis.size
+        self.ops = list(reversed(ops))
+        self.literal = 0
+        self.wire_bytes = 0
+        self.paused = False
+        self.reader = None
+        self.reading = False
+
+    def _start(self):
+        self.transport.registerProducer(self, True)
+        self._produce()
+
+    def _close(self):
+        if self.reader is not None:
+            self.reader.close()
+        else:
+            self.file_object.close()
+
+    def _produce(self):
+        while not (self.paused or self.reading or self.file_object is None):
+            if self.literal:
+                self.reading = True
+                self.reader.read().addCallbacks(self._send_literal,
+                                                self._read_failed)
+            elif self.ops:
+                op, a, b = self.ops.pop()
+                self.transport.write(_OP.pack(op, a, b))
+                self.wire_bytes += _OP.size
+                if op == _LITERAL:
+                    # Its whole range is read by the time the literal is
+                    # sent, so the reader is done with the file then
+                    self.reader = ReadAhead(self.file_object, a, b,
+                                            self.chunk_size, self.read_ahead)
+                    self.literal = b
+                else:
+                    self.sent += min(b * self.block_size,
+                                     self.basis_size - a * self.block_size)
+            else:
+                self._finish()
+
+    def _send_literal(self, data):
+        self.reading = False
+        if self.file_object is None:
+            return
+
+        if not data:
+            self._finish(SendError("File ended before {0} bytes"
+                                   .format(self.length)))
+            return
+
+        self.literal -= len(data)
+        if not self.literal:
+            self.reader = None
+
+        self.sent += len(data)
+        self.wire_bytes += len(data)
+        self.transport.write(data)
+        self._produce()
+
+    def _read_failed(self, f):
+        self.reading = False
+        if self.file_object is not None:
+            self._finish(SendError(f.getErrorMessage()))
+
+    def ratio(self):
+        """Bytes sent per byte of the file"""
+
+        return float(self.wire_bytes) / self.sent if self.sent else 1.0
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._produce()
+
+
+def _read_basis(file_object, offset, length):
+    file_object.seek(offset)
+    return file_object.read(length)
+
+
+class DeltaConsumer(object):
+    """Rebuilds a `size` byte file into `file_object` from the operations of
+    a delta, copying blocks from `basis`, the file object of the receiver's
+    copy.
+
+    Operations are parsed as they arrive and carried out in order behind
+    the reactor: writes go to a `WriteBehind`, and blocks are read from the
+    basis by the disk pool, `copy_chunk_size` bytes at a time. What is
+    still to be written, blocks to copy included, is kept in a `Window`, so
+    the producer is paused while a long copy is in progress.
+
+    Once the operations make up the whole file, `ended` is set and `write`
+    returns whatever followed them. The Deferred fires once all of the file
+    is written.
+    """
+
+    implements(interfaces.IConsumer)
+
+    copy_chunk_size = 1024 * 1024
+
+    window_size = 4 * 1024 * 1024
+
+    def __init__(self, file_object, basis, basis_size, size, block_size,
+                 hasher=None):
+        self.writer = WriteBehind(file_object)
+        self.basis = basis
+        self.basis_size = basis_size
+        self.size = size
+        self.block_size = block_size
+        self.hasher = hasher
+
+        self.buffer = ''
+        self.literal = 0
+        self.parsed = 0
+        self.position = 0
+        self.written = 0
+
+        # Literal data and ranges of the basis to copy, in order, and bytes
+        # handed to the writer that it did not write yet
+        self.pending = deque()
+        self.queued = 0
+        self.reading = False
+
+        self.closed = False
+        self.ended = False
+        self.error = None
+        self.deferred = None
+        self.producer = None
+        self.window = Window(self.window_size)
+
+    def registerProducer(self, producer, streaming):
+        assert streaming
+        self.producer = producer
+        self.window.attach(producer)
+        if not self.deferred:
+            self.deferred = defer.Deferred()
+
+        return self.deferred
+
+    def unregisterProducer(self):
+        self.producer = None
+        self.window.release()
+
+    def finish(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.unregisterProducer()
+        self.writer.close()
+        if not self.reading:
+            self.basis.close()
+
+        deferred = self.deferred
+        self.deferred = None
+
+        if deferred:
+            if self.error is not None:
+                deferred.errback(self.error)
+            elif self.written < self.size:
+                deferred.errback(
+                    DeltaError("Transfer terminated before completion"))
+            else:
+                deferred.callback(self.size)
+
+    def write(self, bytes_):
+        if self.closed:
+            return
+
+        if self.ended:
+            return bytes_
+
+        try:
+            rest = self._parse(self.buffer + bytes_)
+        except DeltaError as e:
+            self.error = e
+            self.finish()
+            return
+
+        self._pump()
+        return rest
+
+    def _parse(self, data):
+        offset = 0
+        while offset < len(data):
+            if self.literal:
+                chunk = data[offset:offset + self.literal]
+                offset += len(chunk)
+                self.literal -= len(chunk)
+                self._queue((_LITERAL, chunk), len(chunk))
+            elif len(data) - offset < _OP.size:
+                break
+            else:
+                op, a, b = _OP.unpack_from(data, offset)
+                offset += _OP.size
+                if op == _LITERAL:
+                    if a != self.parsed or b == 0 or a + b > self.size:
+                        raise DeltaError("Invalid literal of {0} bytes at "
+                                         "{1}".format(b, a))
+
+                    self.literal = b
+                    self.parsed += b
+                elif op == _COPY:
+                    start = a * self.block_size
+                    if b == 0 or start >= self.basis_size:
+                        raise DeltaError("Invalid blocks {0}+{1}".format(a, b))
+
+                    length = min(b * self.block_size, self.basis_size - start)
+                    if self.parsed + length > self.size:
+                        raise DeltaError("Delta is larger than the file")
+
+                    self.parsed += length
+                    self._queue((_COPY, start, length), length)
+                else:
+                    raise DeltaError("Invalid delta operation {0}".format(op))
+
+            # Nothing past the operations that make up the file is theirs
+            if self.parsed == self.size and not self.literal:
+                self.ended = True
+                self.producer = None
+                self.window.attach(None)
+                self.buffer = ''
+                return data[offset:]
+
+        self.buffer = data[offset:]
+        return ''
+
+    def _queue(self, op, length):
+        self.pending.append(op)
+        self.window.add(length)
+
+    def _pump(self):
+        while self.pending and not self.reading and not self.closed:
+            op = self.pending[0]
+            if op[0] == _LITERAL:
+                self.pending.popleft()
+                self._output(op[1])
+                continue
+
+            # The basis is read no faster than the file is written
+            if self.queued > self.copy_chunk_size:
+                return
+
+            _, start, remaining = op
+            length = min(self.copy_chunk_size, remaining)
+            if length < remaining:
+                self.pending[0] = (_COPY, start + length, remaining - length)
+            else:
+                self.pending.popleft()
+
+            self.reading = True
+            d = defer_to_disk(_read_basis, self.basis, start, length)
+            d.addBoth(self._read, length)
+
+    def _read(self, result, length):
+        self.reading = False
+        if self.closed:
+            self.basis.close()
+            return
+
+        if isinstance(result, failure.Failure):
+            self._failed(result)
+        elif len(result) != length:
+            self.error = DeltaError("Basis file changed during transfer")
+            self.finish()
+        else:
+            self._output(result)
+            self._pump()
+
+    def _output(self, data):
+        if self.hasher is not None:
+            self.hasher.update(self.position, data)
+
+        self.position += len(data)
+        self.queued += len(data)
+        self.writer.write(data, self.position == self.size).addCallbacks(
+            self._written, self._failed)
+
+    def _written(self, length):
+        if self.closed:
+            return
+
+        self.written += length
+        self.queued -= length
+        if self.written == self.size:
+            self.finish()
+            return
+
+        self.window.remove(length)
+        self._pump()
+
+    def _failed(self, f):
+        if not self.closed:
+            self.error = f.value
+            self.finish()
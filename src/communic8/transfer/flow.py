@@ -0,0 +1,55 @@
+"""Flow control between a connection and a slower consumer.
+
+A consumer that hands its data to the disk asynchronously takes it from
+the connection faster than it can get rid of it when the disk is slow. It
+keeps what it is holding in a `Window`, which pauses the producer, and so
+reading from the socket, once too much has piled up. TCP then stops the
+sender until the consumer catches up.
+"""
+
+
+class Window(object):
+    """Bytes taken from a streaming producer but not yet disposed of.
+
+    The producer is paused once more than `size` bytes are held, and
+    resumed when they fall to half of that, so what is held stays close to
+    `size` however much slower the consumer is.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.held = 0
+        self.peak = 0
+        self.pauses = 0
+        self.producer = None
+        self.paused = False
+
+    def attach(self, producer):
+        self.producer = producer
+
+    def release(self):
+        """Forgets the producer, resuming it first if it was paused"""
+
+        producer, self.producer = self.producer, None
+        if self.paused:
+            self.paused = False
+            if producer is not None:
+                producer.resumeProducing()
+
+    def add(self, length):
+        self.held += length
+        if self.held > self.peak:
+            self.peak = self.held
+
+        if self.held > self.size and not self.paused and \
+                self.producer is not None:
+            self.paused = True
+            self.pauses += 1
+            self.producer.pauseProducing()
+
+    def remove(self, length):
+        self.held -= length
+        if self.paused and self.held <= self.size // 2:
+            self.paused = False
+            if self.producer is not None:
+                self.producer.resumeProducing()
@@ -0,0 +1,195 @@
+"""Block hashes and Merkle trees for verifying transfers.
+
+Files are hashed in blocks of `BLOCK_SIZE` bytes with SHA-256. The hashes
+of the blocks are the leaves of a tree in which every node hashes the pair
+below it, an odd one out being carried up as is. Leaves and nodes are
+hashed with different prefixes, so neither can pass for the other.
+
+A transfer request carries the root of the sender's tree. The receiver
+hashes blocks as they are written, and if its root differs walks down the
+tree, fetching the sender's hashes below each node that differs, until it
+reaches the blocks that were corrupted.
+"""
+
+import hashlib
+
+from twisted.internet import defer
+
+
+BLOCK_SIZE = 1024 * 1024
+
+_LEAF_PREFIX = '\x00'
+_NODE_PREFIX = '\x01'
+
+
+class IntegrityError(RuntimeError):
+    pass
+
+
+def block_count(size):
+    return max(1, (size + BLOCK_SIZE - 1) // BLOCK_SIZE)
+
+
+def block_range(size, index):
+    offset = index * BLOCK_SIZE
+    return offset, min(BLOCK_SIZE, size - offset)
+
+
+def leaf_hash(data):
+    return hashlib.sha256(_LEAF_PREFIX + data).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(_NODE_PREFIX + left + right).digest()
+
+
+class MerkleTree(object):
+    """Every level of the tree over `leaves`, from the leaves to the root"""
+
+    def __init__(self, leaves):
+        level = list(leaves)
+        if not level:
+            raise IntegrityError("A tree needs at least one leaf")
+
+        self.levels = [level]
+        while len(level) > 1:
+            level = [node_hash(*level[n:n + 2]) if n + 1 < len(level)
+                     else level[n] for n in xrange(0, len(level), 2)]
+            self.levels.append(level)
+
+    @classmethod
+    def from_file(cls, path):
+        """Hashes every block of the file at `path`. Blocks, so it is meant
+        to run in a thread"""
+
+        leaves = []
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(BLOCK_SIZE)
+                if not data and leaves:
+                    break
+
+                leaves.append(leaf_hash(data))
+                if len(data) < BLOCK_SIZE:
+                    break
+
+        return cls(leaves)
+
+    @property
+    def root(self):
+        return self.levels[-1][0].encode('hex')
+
+    @property
+    def height(self):
+        return len(self.levels)
+
+    def hashes(self, level, first, count):
+        """Hex hashes of `count` nodes of `level`, starting at `first`"""
+
+        try:
+            nodes = self.levels[level]
+        except IndexError:
+            raise IntegrityError("Invalid tree level {0}".format(level))
+
+        if not 0 <= first < len(nodes) or count < 1:
+            raise IntegrityError("Invalid tree nodes {0}+{1}".format(
+                first, count))
+
+        return [node.encode('hex') for node in nodes[first:first + count]]
+
+    def children(self, level, index):
+        """Indexes of the nodes on the level below `level` that `index`
+        covers, as a (first, count) pair"""
+
+        first = index * 2
+        return first, min(2, len(self.levels[level - 1]) - first)
+
+
+class BlockHasher(object):
+    """Hashes the blocks of a `size` byte file as they are written.
+
+    Blocks can arrive in any order, but a block is only hashed on the fly
+    if it is written from its start, in order. `hash_missing` reads the
+    ones that were not from the file.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.leaves = [None] * block_count(size)
+        self.pending = {}
+
+    def update(self, offset, data):
+        while data:
+            index, position = divmod(offset, BLOCK_SIZE)
+            block_offset, length = block_range(self.size, index)
+            chunk = data[:length - position]
+            data = data[len(chunk):]
+
+            self.leaves[index] = None
+            if position == 0:
+                hasher = hashlib.sha256(_LEAF_PREFIX)
+            else:
+                hasher, expected = self.pending.pop(index, (None, None))
+                if expected != offset:
+                    hasher = None
+
+            offset += len(chunk)
+            if hasher is None:
+                continue
+
+            hasher.update(chunk)
+            if offset == block_offset + length:
+                self.leaves[index] = hasher.digest()
+            else:
+                self.pending[index] = (hasher, offset)
+
+    def missing(self):
+        return [index for index, leaf in enumerate(self.leaves)
+                if leaf is None]
+
+    def hash_missing(self, path):
+        """Hashes the blocks not seen whole from the file. Blocks, so it is
+        meant to run in a thread"""
+
+        missing = self.missing()
+        if not missing:
+            return
+
+        with open(path, 'rb') as f:
+            for index in missing:
+                offset, length = block_range(self.size, index)
+                f.seek(offset)
+                self.leaves[index] = leaf_hash(f.read(length))
+
+        self.pending.clear()
+
+    def tree(self):
+        return MerkleTree(self.leaves)
+
+
+@defer.inlineCallbacks
+def find_corrupted(tree, fetch):
+    """Indexes of the blocks of `tree` that differ from the sender's.
+
+    `fetch(level, first, count)` returns a Deferred firing with the
+    sender's hex hashes for those nodes. Only the nodes below the ones that
+    differ are fetched.
+    """
+
+    differing = [0]
+    for level in xrange(tree.height - 1, 0, -1):
+        below = []
+        for index in differing:
+            first, count = tree.children(level, index)
+            theirs = yield fetch(level - 1, first, count)
+            ours = tree.hashes(level - 1, first, count)
+            if len(theirs) != len(ours):
+                raise IntegrityError("Invalid hashes for level {0}".format(
+                    level - 1))
+
+            below.extend(first + n for n, (a, b) in
+                         enumerate(zip(ours, theirs)) if a != b)
+
+        differing = below
+
+    defer.returnValue(differing)
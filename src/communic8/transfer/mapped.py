@@ -0,0 +1,214 @@
+"""Receiving into a preallocated, memory mapped file.
+
+`MappedFileConsumer` reserves the space for the whole file up front, maps
+it in windows, and copies what arrives straight into the mapping, without
+a system call per chunk. Once the last byte is in, the file is synced to
+disk in the disk pool, off the reactor.
+
+Mapping a file that may not get its blocks is unsafe: a write that finds
+the disk full raises SIGBUS instead of an error. So the consumer is only
+used where the space can be reserved with fallocate(2).
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import mmap
+import os
+
+from zope.interface import implements
+from twisted.internet import defer, interfaces
+from twisted.python import failure
+
+from communic8.transfer.pipeline import defer_to_disk
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fallocate = _libc.fallocate
+except (AttributeError, OSError, TypeError):
+    _fallocate = None
+else:
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+                           ctypes.c_int64]
+    _fallocate.restype = ctypes.c_int
+
+_fdatasync = getattr(os, 'fdatasync', os.fsync)
+
+
+class MappingError(RuntimeError):
+    pass
+
+
+def preallocate(file_object, size):
+    """Reserves disk space for `size` bytes of `file_object`, extending it
+    if needed. Returns False if the file system cannot do so.
+
+    fallocate(2) is used directly, rather than posix_fallocate(3), as the
+    latter falls back to writing every block where it is not supported.
+    """
+
+    if _fallocate is None:
+        return False
+
+    if _fallocate(file_object.fileno(), 0, 0, size) == 0:
+        return True
+
+    error = ctypes.get_errno()
+    if error in (errno.EOPNOTSUPP, errno.ENOSYS):
+        return False
+
+    raise IOError(error, os.strerror(error))
+
+
+class MappedFileConsumer(object):
+    """Writes a transfer to `file_object`, which must be open for reading
+    and writing, through a memory mapping. Takes the same arguments as
+    `FileConsumer`.
+
+    Raises `MappingError` if the space for the file cannot be reserved.
+    Once the last byte is copied, `ended` is set and `write` returns
+    whatever followed it, while the file is synced.
+    """
+
+    implements(interfaces.IConsumer)
+
+    checkpoint_interval = 16 * 1024 * 1024
+
+    # Bytes of the file mapped at a time
+    window_size = 64 * 1024 * 1024
+
+    def __init__(self, file_object, size, offset=0, checkpoint=None,
+                 hasher=None):
+        assert size > 0
+        assert 0 <= offset < size
+
+        try:
+            if not preallocate(file_object, size):
+                raise MappingError("Cannot reserve space for the file")
+        except (IOError, OSError, MappingError):
+            file_object.close()
+            raise
+
+        self.file_object = file_object
+        self.size = size
+        self.offset = offset
+        self.partial_size = offset
+        self.deferred = None
+        self.producer = None
+        self.syncing = False
+        self.ended = False
+        self.error = None
+
+        self.mapping = None
+        self.window_end = offset
+
+        self.checkpoint = checkpoint
+        self.next_checkpoint = offset + self.checkpoint_interval
+        self.hasher = hasher
+
+    def registerProducer(self, producer, streaming):
+        assert streaming
+        self.producer = producer
+        if not self.deferred:
+            self.deferred = defer.Deferred()
+
+        return self.deferred
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def _map(self):
+        self._unmap()
+
+        # Mappings have to start at a multiple of the granularity
+        start = self.partial_size - \
+            self.partial_size % mmap.ALLOCATIONGRANULARITY
+        length = min(self.window_size, self.size - start)
+        self.mapping = mmap.mmap(self.file_object.fileno(), length,
+                                 offset=start)
+        self.mapping.seek(self.partial_size - start)
+        self.window_end = start + length
+
+    def _unmap(self):
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+    def finish(self):
+        if self.syncing:
+            # Stopped while syncing, nobody is waiting for the result
+            self.deferred = None
+            return
+
+        if not self.file_object:
+            return
+
+        self.unregisterProducer()
+        self._unmap()
+        self.file_object.close()
+
+        deferred = self.deferred
+        self.file_object = None
+        self.deferred = None
+
+        if self.checkpoint and self.partial_size < self.size:
+            self.checkpoint(self.partial_size)
+
+        if deferred:
+            if self.error is not None:
+                deferred.errback(self.error)
+            elif self.partial_size < self.size:
+                deferred.errback(
+                    MappingError("Transfer terminated before completion"))
+            else:
+                deferred.callback(self.size)
+
+    def _sync(self):
+        self.unregisterProducer()
+        self._unmap()
+        self.syncing = True
+
+        def on_synced(result):
+            self.syncing = False
+            if isinstance(result, failure.Failure):
+                self.error = result.value
+
+            self.finish()
+
+        defer_to_disk(_fdatasync, self.file_object.fileno()) \
+            .addBoth(on_synced)
+
+    def write(self, bytes_):
+        if self.ended:
+            return bytes_
+
+        assert self.producer is not None
+        assert self.file_object is not None
+
+        remaining = min(len(bytes_), self.size - self.partial_size)
+        position = 0
+        while remaining:
+            if self.partial_size == self.window_end:
+                self._map()
+
+            length = min(remaining, self.window_end - self.partial_size)
+            chunk = buffer(bytes_, position, length)
+            self.mapping.write(chunk)
+            if self.hasher is not None:
+                self.hasher.update(self.partial_size, chunk)
+
+            self.partial_size += length
+            position += length
+            remaining -= length
+
+        if self.partial_size == self.size:
+            self.ended = True
+            self._sync()
+            return bytes_[position:]
+        elif self.checkpoint and self.partial_size >= self.next_checkpoint:
+            # What is written to a shared mapping is already in the page
+            # cache, as a flushed write would be
+            self.checkpoint(self.partial_size)
+            self.next_checkpoint = self.partial_size + \
+                self.checkpoint_interval
@@ -0,0 +1,246 @@
+"""Disk I/O for transfers, done off the reactor.
+
+Reads and writes of file data go to a thread pool of their own, at most
+`DISK_THREADS` threads shared by every transfer of the process, so a busy
+disk neither holds up the reactor nor takes the reactor's pool, used for
+hashing, compression and name resolution, away from everything else.
+
+`ReadAhead` keeps the next chunks of a file read before a sender asks for
+them, handing them back through Deferreds. `WriteBehind` queues writes and
+does them in order while the reactor goes on receiving. `prefetch` asks
+the kernel to read a range into the page cache, for senders that copy
+from it with sendfile(2).
+"""
+
+import ctypes
+import ctypes.util
+from collections import deque
+
+from twisted.internet import defer, reactor, threads
+from twisted.python import failure
+from twisted.python.threadpool import ThreadPool
+
+
+DISK_THREADS = 4
+
+_POSIX_FADV_WILLNEED = 3
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    _fadvise = _libc.posix_fadvise
+except (AttributeError, OSError, TypeError):
+    _fadvise = None
+else:
+    _fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64,
+                         ctypes.c_int]
+    _fadvise.restype = ctypes.c_int
+
+
+_disk_pools = {}
+
+
+def disk_pool(clock=reactor):
+    """The pool doing the disk I/O of transfers running on `clock`,
+    started on first use and stopped with the reactor"""
+
+    try:
+        return _disk_pools[clock]
+    except KeyError:
+        pool = _disk_pools[clock] = ThreadPool(0, DISK_THREADS,
+                                               name='communic8-disk')
+        pool.start()
+        clock.addSystemEventTrigger('during', 'shutdown', pool.stop)
+        return pool
+
+
+def defer_to_disk(f, *args, **kwargs):
+    return threads.deferToThreadPool(reactor, disk_pool(), f, *args,
+                                     **kwargs)
+
+
+def _advise(fd, offset, length):
+    _fadvise(fd, offset, length, _POSIX_FADV_WILLNEED)
+
+
+def prefetch(file_object, offset, length):
+    """Deferred fired once the kernel was asked to read `length` bytes of
+    `file_object` from `offset`, which it does in the background. Does
+    nothing where posix_fadvise(2) is not available"""
+
+    if _fadvise is None:
+        return defer.succeed(None)
+
+    return defer_to_disk(_advise, file_object.fileno(), offset, length)
+
+
+def _read_chunk(file_object, offset, length):
+    file_object.seek(offset)
+    return file_object.read(length)
+
+
+class ReadAhead(object):
+    """Reads `length` bytes of `file_object` from `offset` in chunks of
+    `chunk_size`, keeping up to `depth` of them read ahead of `read`.
+
+    Reads are done one at a time, in order, as they share the file's
+    position. The file is closed by `close`, once no read is using it.
+    """
+
+    depth = 4
+
+    def __init__(self, file_object, offset, length, chunk_size, depth=None):
+        if depth is not None:
+            self.depth = depth
+
+        self.file_object = file_object
+        self.position = offset
+        self.end = offset + length
+        self.chunk_size = chunk_size
+        self.ready = deque()
+        self.waiting = None
+        self.reading = False
+        self.closed = False
+
+        self._fill()
+
+    def read(self):
+        """Deferred fired with the next chunk, or an empty string at the
+        end of the range or of the file"""
+
+        assert self.waiting is None
+
+        d = defer.Deferred()
+        if self.ready:
+            self._deliver(d)
+        else:
+            self.waiting = d
+
+        return d
+
+    def close(self):
+        self.closed = True
+        self.ready.clear()
+        if not self.reading:
+            self.file_object.close()
+
+    def _deliver(self, d):
+        result = self.ready.popleft()
+        self._fill()
+        if isinstance(result, failure.Failure):
+            d.errback(result)
+        else:
+            d.callback(result)
+
+    def _fill(self):
+        if self.reading or self.closed or len(self.ready) >= self.depth or \
+                self.position >= self.end:
+            return
+
+        length = min(self.chunk_size, self.end - self.position)
+        self.reading = True
+        d = defer_to_disk(_read_chunk, self.file_object, self.position,
+                          length)
+        d.addBoth(self._read)
+
+    def _read(self, result):
+        self.reading = False
+        if self.closed:
+            self.file_object.close()
+            return
+
+        if isinstance(result, failure.Failure) or not result:
+            # Nothing is read past an error or the end of the file
+            self.end = self.position
+        else:
+            self.position += len(result)
+
+        self.ready.append(result)
+        if self.waiting is not None:
+            d, self.waiting = self.waiting, None
+            self._deliver(d)
+        else:
+            self._fill()
+
+
+def _write_data(file_object, data, flush, offset):
+    if offset is not None:
+        file_object.seek(offset)
+
+    file_object.write(data)
+    if flush:
+        file_object.flush()
+
+
+class WriteBehind(object):
+    """Writes to `file_object` in order, one write at a time. What is
+    queued while a write is in progress goes out together in the next, up
+    to a write given an offset of its own.
+
+    `write` returns a Deferred fired with the length of the data once it
+    is written, or failed with the error that stopped it, which also fails
+    every write queued after it. The file is closed by `close`, after the
+    write in progress if there is one, and the Deferreds of writes that
+    were not done by then are never fired.
+    """
+
+    def __init__(self, file_object):
+        self.file_object = file_object
+        self.queue = []
+        self.writing = False
+        self.closed = False
+
+    def write(self, data, flush=False, offset=None):
+        """Queues `data`, to be written at `offset` if given, flushing the
+        file after it if `flush` is set"""
+
+        assert not self.closed
+
+        d = defer.Deferred()
+        self.queue.append((data, flush, offset, d))
+        if not self.writing:
+            self._next()
+
+        return d
+
+    def close(self):
+        """Closes the file, dropping the writes that have not started"""
+
+        self.closed = True
+        del self.queue[:]
+        if not self.writing:
+            self.file_object.close()
+
+    def _next(self):
+        # A write at an offset of its own starts another batch
+        count = 1
+        while count < len(self.queue) and self.queue[count][2] is None:
+            count += 1
+
+        batch, self.queue = self.queue[:count], self.queue[count:]
+        data = ''.join(entry[0] for entry in batch)
+        flush = any(entry[1] for entry in batch)
+
+        self.writing = True
+        d = defer_to_disk(_write_data, self.file_object, data, flush,
+                          batch[0][2])
+        d.addBoth(self._written, batch)
+
+    def _written(self, result, batch):
+        self.writing = False
+        if self.closed:
+            self.file_object.close()
+            return
+
+        if isinstance(result, failure.Failure):
+            batch.extend(self.queue)
+            del self.queue[:]
+            for _, _, _, d in batch:
+                d.errback(result)
+
+            return
+
+        if self.queue:
+            self._next()
+
+        for data, _, _, d in batch:
+            d.callback(len(data))
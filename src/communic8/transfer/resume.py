@@ -0,0 +1,108 @@
+"""Bookkeeping for partially received files, so transfers can resume.
+
+A receiver records how far it got into a file when a transfer stops, and
+every so often while it runs. When the same file is offered again, matched
+by name, size and modification time, the receiver answers with that offset
+and the sender only sends what is missing.
+"""
+
+import json
+import os
+
+
+# Names of journals, and of the files they are written to, start with it
+JOURNAL_PREFIX = '.communic8-'
+
+
+def is_journal_name(name):
+    return name.startswith(JOURNAL_PREFIX)
+
+
+class DirectoryJournal(object):
+    """State kept for a directory in a hidden JSON file inside it.
+
+    The file is replaced atomically on every change, so an interrupted
+    receiver never leaves it half written. Every connection receiving into
+    a directory shares one instance.
+    """
+
+    journal_name = None
+
+    _instances = {}
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.journal_path = os.path.join(directory, self.journal_name)
+        self.entries = self._load()
+
+    @classmethod
+    def for_directory(cls, directory):
+        key = (cls, os.path.abspath(directory))
+        try:
+            return cls._instances[key]
+        except KeyError:
+            instance = cls._instances[key] = cls(key[1])
+            return instance
+
+    def _load(self):
+        try:
+            with open(self.journal_path, 'rb') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _store(self):
+        temp_path = self.journal_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            json.dump(self.entries, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.rename(temp_path, self.journal_path)
+
+
+class PartialTransfers(DirectoryJournal):
+    """Partially received files of one directory"""
+
+    journal_name = '.communic8-partial.json'
+
+    @staticmethod
+    def key(transfer):
+        return '{0}\t{1}\t{2}'.format(transfer.name, transfer.size,
+                                      transfer.mtime_timestamp())
+
+    def find(self, transfer):
+        """Path and offset of a partial copy of `transfer`, or None"""
+
+        entry = self.entries.get(self.key(transfer))
+        if entry is None:
+            return None
+
+        path = os.path.join(self.directory, entry['path'])
+        offset = entry['offset']
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+
+        # Receiving preallocates the whole file, anything else means it was
+        # replaced or truncated since
+        if size != transfer.size or not 0 < offset < transfer.size:
+            self.remove(transfer)
+            return None
+
+        return path, offset
+
+    def save(self, transfer, path, offset):
+        key = self.key(transfer)
+        entry = {'path': os.path.relpath(path, self.directory),
+                 'offset': offset}
+        if self.entries.get(key) == entry:
+            return
+
+        self.entries[key] = entry
+        self._store()
+
+    def remove(self, transfer):
+        if self.entries.pop(self.key(transfer), None) is not None:
+            self._store()
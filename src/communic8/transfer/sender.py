@@ -0,0 +1,287 @@
+"""Engines that stream a file, or part of it, to a transport.
+
+`SendfileSender` hands the copy to the kernel with sendfile(2), straight
+from the page cache to the socket, and is used for plain TCP connections
+when `os.sendfile` (Python 3) or the `sendfile` module (pysendfile) is
+available. Everything else, such as TLS, goes through `ChunkedSender`,
+which writes large chunks read in user space.
+
+Neither reads the disk on the reactor: `ChunkedSender` writes chunks a
+`ReadAhead` read beforehand in the disk pool, and `SendfileSender` has the
+kernel read ahead of what it copies, so sendfile finds it in the page
+cache.
+
+Both fire the Deferred returned by `start` with the number of bytes sent,
+and keep timing so the achieved throughput can be reported.
+"""
+
+import errno
+import os
+import time
+
+from zope.interface import implements
+from twisted.internet import defer, interfaces, reactor
+
+from communic8.transfer.pipeline import ReadAhead, prefetch
+
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+
+class SendError(RuntimeError):
+    pass
+
+
+class FileSender(object):
+    clock = reactor
+
+    def __init__(self, file_object, offset, length):
+        self.file_object = file_object
+        self.offset = offset
+        self.length = length
+        self.sent = 0
+
+        self.transport = None
+        self.deferred = None
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self, transport):
+        self.transport = transport
+        self.deferred = d = defer.Deferred()
+        self.started_at = time.time()
+
+        # Small transfers can be done before _start returns
+        self._start()
+        return d
+
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    def throughput(self):
+        """Bytes per second sent so far"""
+
+        elapsed = self.elapsed()
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    def stopProducing(self):
+        self._finish(SendError("Transfer stopped"))
+
+    def _finish(self, error=None):
+        if self.file_object is None:
+            return
+
+        self.finished_at = time.time()
+        self._close()
+        self.file_object = None
+        self.transport.unregisterProducer()
+
+        deferred, self.deferred = self.deferred, None
+        if error is None:
+            deferred.callback(self.sent)
+        else:
+            deferred.errback(error)
+
+    def _close(self):
+        self.file_object.close()
+
+
+class ChunkedSender(FileSender):
+    """Writes chunks of `chunk_size` bytes as a streaming producer, pausing
+    whenever the transport's buffer is full"""
+
+    implements(interfaces.IPushProducer)
+
+    chunk_size = 256 * 1024
+
+    # Chunks read ahead of the transport
+    read_ahead = 4
+
+    # Chunks written per reactor iteration, so other connections get a turn
+    chunks_per_iteration = 16
+
+    def __init__(self, file_object, offset, length, chunk_size=None):
+        super(ChunkedSender, self).__init__(file_object, offset, length)
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+
+        self.reader = None
+        self.paused = False
+        self.reading = False
+        self.burst = 0
+        self.call = None
+
+    def _start(self):
+        self.reader = ReadAhead(self.file_object, self.offset, self.length,
+                                self.chunk_size, self.read_ahead)
+        self.transport.registerProducer(self, True)
+        self._schedule()
+
+    def _close(self):
+        if self.reader is not None:
+            self.reader.close()
+        else:
+            self.file_object.close()
+
+    def _schedule(self):
+        if self.call is None and self.file_object is not None:
+            self.call = self.clock.callLater(0, self._produce)
+
+    def _produce(self):
+        self.call = None
+        self.burst = 0
+        self._read_next()
+
+    def _read_next(self):
+        if self.paused or self.reading or self.file_object is None:
+            return
+
+        if self.sent == self.length:
+            self._finish()
+        elif self.burst == self.chunks_per_iteration:
+            self._schedule()
+        else:
+            self.reading = True
+            self.reader.read().addCallbacks(self._send_chunk,
+                                            self._read_failed)
+
+    def _send_chunk(self, data):
+        self.reading = False
+        if self.file_object is None:
+            return
+
+        if not data:
+            self._finish(SendError("File ended before {0} bytes"
+                                   .format(self.length)))
+            return
+
+        self.sent += len(data)
+        self.burst += 1
+        self.transport.write(data)
+        self._read_next()
+
+    def _read_failed(self, f):
+        self.reading = False
+        if self.file_object is not None:
+            self._finish(SendError(f.getErrorMessage()))
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self._schedule()
+
+    def stopProducing(self):
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+
+        super(ChunkedSender, self).stopProducing()
+
+
+class SendfileSender(FileSender):
+    """Copies from the file to the transport's socket with sendfile(2).
+
+    Registered as a pull producer, the sender is asked for more whenever the
+    transport has flushed its own buffer, so anything written before the
+    transfer goes out first. Each time it sends until the socket is full,
+    then has the transport wait until it is writable again.
+    """
+
+    implements(interfaces.IPullProducer)
+
+    # Bytes sent per reactor iteration, so other connections get a turn
+    burst_size = 8 * 1024 * 1024
+
+    # Bytes the kernel is asked to read ahead of what has been sent
+    read_ahead = 32 * 1024 * 1024
+
+    def _start(self):
+        self.started = False
+        self.prefetched = self.offset
+        self.prefetching = False
+        self._prefetch()
+        self.transport.registerProducer(self, False)
+
+    def _prefetch(self):
+        end = self.offset + self.length
+        if self.prefetching or self.prefetched >= end or \
+                self.prefetched - (self.offset + self.sent) > \
+                self.read_ahead // 2:
+            return
+
+        def on_prefetched(_):
+            self.prefetching = False
+
+        length = min(self.read_ahead, end - self.prefetched)
+        self.prefetching = True
+        prefetch(self.file_object, self.prefetched, length) \
+            .addBoth(on_prefetched)
+        self.prefetched += length
+
+    def resumeProducing(self):
+        if self.file_object is None:
+            return
+
+        if not self.started:
+            # Called straight from registerProducer, with whatever was
+            # written before possibly still buffered
+            self.started = True
+            self.transport.startWriting()
+            return
+
+        out_fd = self.transport.fileno()
+        in_fd = self.file_object.fileno()
+        burst = 0
+        while burst < self.burst_size:
+            remaining = self.length - self.sent
+            if not remaining:
+                self._finish()
+                return
+
+            try:
+                count = sendfile(out_fd, in_fd, self.offset + self.sent,
+                                 min(remaining, self.burst_size - burst))
+            except (IOError, OSError) as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.EAGAIN:
+                    break
+
+                self._finish(SendError(os.strerror(e.errno)))
+                return
+
+            if not count:
+                self._finish(SendError("File ended before {0} bytes"
+                                       .format(self.length)))
+                return
+
+            self.sent += count
+            burst += count
+
+        self._prefetch()
+        self.transport.startWriting()
+
+
+def can_sendfile(transport):
+    """Whether `transport` writes straight to a socket sendfile can use"""
+
+    return (sendfile is not None and
+            not interfaces.ISSLTransport.providedBy(transport) and
+            interfaces.ITCPTransport.providedBy(transport) and
+            hasattr(transport, 'fileno') and hasattr(transport, 'startWriting'))
+
+
+def file_sender(file_object, offset, length, transport, chunk_size=None):
+    """The fastest engine that works for `transport`"""
+
+    if can_sendfile(transport):
+        return SendfileSender(file_object, offset, length)
+
+    return ChunkedSender(file_object, offset, length, chunk_size)
@@ -0,0 +1,390 @@
+"""Striped transfers: one file sent over several TCP connections at once.
+
+A single stream over a high-latency link is limited by its window, so the
+file is split in ranges of `range_size` bytes, sent concurrently over
+extra data connections. Each connection opens with the transfer's token on
+a line of its own, then carries ranges one after the other, each prefixed
+by its offset and length. Connections take the next unsent range when
+they finish one, so faster ones end up carrying more.
+
+The receiver writes every range at its offset, into a file preallocated to
+the full size, and keeps track of the complete ones in a `RangeBitmap`.
+Each connection writes through a `WriteBehind` of its own, and is paused
+while the disk is behind.
+"""
+
+import os
+import struct
+import time
+from collections import deque
+
+from twisted.internet import defer, protocol, reactor
+from twisted.protocols.basic import LineReceiver
+from twisted.python import failure
+
+from communic8.transfer.flow import Window
+from communic8.transfer.pipeline import WriteBehind
+from communic8.transfer.sender import SendError, file_sender
+
+
+_RANGE_HEADER = struct.Struct('!QQ')
+
+
+class StripeError(RuntimeError):
+    pass
+
+
+class RangeBitmap(object):
+    """Which of the `range_size` ranges of a `size` byte file are complete"""
+
+    def __init__(self, size, range_size):
+        self.size = size
+        self.range_size = range_size
+        self.count = (size + range_size - 1) // range_size
+        self.bits = bytearray((self.count + 7) // 8)
+        self.completed = 0
+
+    def range(self, index):
+        offset = index * self.range_size
+        return offset, min(self.range_size, self.size - offset)
+
+    def index(self, offset, length):
+        """Index of the range at `offset`, if `length` matches it"""
+
+        index, rest = divmod(offset, self.range_size)
+        if rest or not 0 <= index < self.count or \
+                self.range(index)[1] != length:
+            raise StripeError("Invalid range {0}+{1}".format(offset, length))
+
+        return index
+
+    def __contains__(self, index):
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def add(self, index):
+        if index not in self:
+            self.bits[index >> 3] |= 1 << (index & 7)
+            self.completed += 1
+
+    def complete(self):
+        return self.completed == self.count
+
+    def missing(self):
+        return (index for index in xrange(self.count) if index not in self)
+
+
+class StripeReceiverProtocol(LineReceiver):
+    """One incoming data connection. What it has yet to write is kept in a
+    `Window` of `window_size` bytes, which pauses it"""
+
+    window_size = 4 * 1024 * 1024
+
+    def connectionMade(self):
+        self.writer = None
+        self.window = Window(self.window_size)
+        self.unwritten = 0
+        self.lost = False
+        self.buffer = ''
+        self.range_index = None
+        self.range_remaining = 0
+        self.position = 0
+        self.seek = None
+
+    def lineReceived(self, line):
+        if line != self.factory.token:
+            self.transport.loseConnection()
+            return
+
+        self.writer = WriteBehind(open(self.factory.path, 'r+b'))
+        self.window.attach(self)
+        self.setRawMode()
+
+    def rawDataReceived(self, data):
+        receive = self.factory
+        if receive.deferred is None:
+            return
+
+        try:
+            while data:
+                if not self.range_remaining:
+                    data = self.buffer + data
+                    if len(data) < _RANGE_HEADER.size:
+                        self.buffer = data
+                        return
+
+                    self.buffer = ''
+                    offset, length = _RANGE_HEADER.unpack_from(data)
+                    data = data[_RANGE_HEADER.size:]
+                    self.range_index = receive.bitmap.index(offset, length)
+                    self.range_remaining = length
+                    self.position = offset
+                    self.seek = offset
+
+                chunk = data[:self.range_remaining]
+                data = data[len(chunk):]
+                if receive.hasher is not None:
+                    receive.hasher.update(self.position, chunk)
+
+                self.position += len(chunk)
+                self.range_remaining -= len(chunk)
+                receive.received += len(chunk)
+
+                # Complete only once it reached the file
+                complete = self.range_index \
+                    if not self.range_remaining else None
+                self.unwritten += len(chunk)
+                self.window.add(len(chunk))
+                d = self.writer.write(chunk, complete is not None, self.seek)
+                d.addCallbacks(self._written, self._failed,
+                               callbackArgs=(complete, ))
+                self.seek = None
+        except StripeError as e:
+            receive.fail(e)
+
+    def _written(self, length, complete):
+        self.unwritten -= length
+        self.window.remove(length)
+        if complete is not None and self.factory.deferred is not None:
+            self.factory.range_received(complete)
+
+        if self.lost and (not self.unwritten or
+                          self.factory.deferred is None):
+            self._close()
+
+    def _failed(self, f):
+        self.factory.fail(f.value)
+        self._close()
+
+    def _close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        # What was received is still written, unless the transfer is over
+        self.lost = True
+        self.window.attach(None)
+        if not self.unwritten or self.factory.deferred is None:
+            self._close()
+
+        self.factory.connection_closed(self)
+
+
+class StripedConsumer(protocol.ServerFactory):
+    """Receives the ranges of a file over data connections to `port`.
+
+    Takes the place of a `FileConsumer`: `registerProducer` returns a
+    Deferred fired with the size once every range is in, and `finish` stops
+    the transfer, failing it if that was early. If given, `hasher` is
+    updated with every range as it arrives.
+    """
+
+    protocol = StripeReceiverProtocol
+
+    range_size = 4 * 1024 * 1024
+
+    def __init__(self, path, size, interface='', range_size=None,
+                 hasher=None, clock=reactor):
+        if range_size is not None:
+            self.range_size = range_size
+
+        self.path = path
+        self.size = size
+        self.hasher = hasher
+        self.bitmap = RangeBitmap(size, self.range_size)
+        self.token = os.urandom(16).encode('hex')
+        self.received = 0
+        self.connections = set()
+        self.deferred = None
+
+        with open(path, 'wb') as f:
+            f.truncate(size)
+
+        self.listening_port = clock.listenTCP(0, self, interface=interface)
+
+    @property
+    def port(self):
+        return self.listening_port.getHost().port
+
+    def buildProtocol(self, addr):
+        if self.deferred is None:
+            return None
+
+        proto = protocol.ServerFactory.buildProtocol(self, addr)
+        self.connections.add(proto)
+        return proto
+
+    def registerProducer(self, producer, streaming):
+        if not self.deferred:
+            self.deferred = defer.Deferred()
+
+        return self.deferred
+
+    def unregisterProducer(self):
+        pass
+
+    def write(self, data):
+        raise StripeError("Striped transfers only take data connections")
+
+    def range_received(self, index):
+        self.bitmap.add(index)
+        if self.bitmap.complete():
+            self._stop(None)
+
+    def connection_closed(self, proto):
+        self.connections.discard(proto)
+
+    def fail(self, error):
+        self._stop(failure.Failure(error))
+
+    def finish(self):
+        if self.bitmap.complete():
+            self._stop(None)
+        else:
+            self._stop(failure.Failure(StripeError(
+                "Transfer terminated before completion")))
+
+    def _stop(self, result):
+        if self.listening_port is not None:
+            self.listening_port.stopListening()
+            self.listening_port = None
+
+        for proto in list(self.connections):
+            proto.transport.loseConnection()
+
+        deferred, self.deferred = self.deferred, None
+        if deferred is None:
+            return
+
+        if result is None:
+            deferred.callback(self.size)
+        else:
+            deferred.errback(result)
+
+
+class StripeSenderProtocol(protocol.Protocol):
+    """One outgoing data connection, sending ranges until none are left"""
+
+    def connectionMade(self):
+        self.sender = None
+        self.transport.write(self.factory.token + '\r\n')
+        self.send_next()
+
+    def send_next(self):
+        send = self.factory
+        try:
+            index = send.pending.popleft()
+        except IndexError:
+            self.transport.loseConnection()
+            return
+
+        offset, length = send.bitmap.range(index)
+        self.transport.write(_RANGE_HEADER.pack(offset, length))
+
+        self.sender = file_sender(open(send.path, 'rb'), offset, length,
+                                  self.transport)
+        d = self.sender.start(self.transport)
+
+        def on_sent(sent):
+            send.sent += sent
+            self.sender = None
+            self.send_next()
+
+        def on_failure(f):
+            send.pending.appendleft(index)
+            send.fail(f)
+
+        d.addCallbacks(on_sent, on_failure)
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        if self.sender is not None:
+            self.sender.stopProducing()
+            self.sender = None
+
+        self.factory.connection_closed(self, reason)
+
+
+class StripedSender(protocol.ClientFactory):
+    """Sends a file over `streams` data connections to `host`:`port`.
+
+    Has the interface of the engines in `communic8.transfer.sender`, with
+    the control connection only used to find the peer.
+    """
+
+    protocol = StripeSenderProtocol
+
+    def __init__(self, path, size, host, port, token, streams, range_size,
+                 clock=reactor):
+        self.path = path
+        self.size = size
+        self.host = host
+        self.port = port
+        self.token = token
+        self.streams = streams
+        self.clock = clock
+
+        self.bitmap = RangeBitmap(size, range_size)
+        self.pending = deque(xrange(self.bitmap.count))
+        self.sent = 0
+        self.connections = set()
+        self.connecting = 0
+
+        self.deferred = None
+        self.error = None
+        self.started_at = None
+        self.finished_at = None
+
+    def start(self, transport=None):
+        self.deferred = defer.Deferred()
+        self.started_at = time.time()
+        for _ in xrange(min(self.streams, self.bitmap.count)):
+            self.connecting += 1
+            self.clock.connectTCP(self.host, self.port, self)
+
+        return self.deferred
+
+    def elapsed(self):
+        return (self.finished_at or time.time()) - self.started_at
+
+    def throughput(self):
+        elapsed = self.elapsed()
+        return self.sent / elapsed if elapsed > 0 else 0.0
+
+    def buildProtocol(self, addr):
+        self.connecting -= 1
+        proto = protocol.ClientFactory.buildProtocol(self, addr)
+        self.connections.add(proto)
+        return proto
+
+    def clientConnectionFailed(self, connector, reason):
+        self.connecting -= 1
+        self.fail(reason)
+
+    def connection_closed(self, proto, reason):
+        self.connections.discard(proto)
+        if self.pending and self.error is None:
+            self.fail(reason)
+        else:
+            self._check_done()
+
+    def fail(self, reason):
+        if self.error is None:
+            self.error = reason
+            for proto in list(self.connections):
+                proto.transport.abortConnection()
+
+        self._check_done()
+
+    def stopProducing(self):
+        self.fail(failure.Failure(SendError("Transfer stopped")))
+
+    def _check_done(self):
+        if self.connections or self.connecting or self.deferred is None:
+            return
+
+        self.finished_at = time.time()
+        deferred, self.deferred = self.deferred, None
+        if self.error is not None:
+            deferred.errback(self.error)
+        else:
+            deferred.callback(self.sent)
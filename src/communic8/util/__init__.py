@@ -1,18 +1,204 @@
 import fysom
+from fysom import FysomError, Canceled, WILDCARD, SAME_DST
+
+
+class _Event(object):
+    def __init__(self, fsm, event, src, dst, args, kwargs):
+        self.fsm = fsm
+        self.event = event
+        self.src = src
+        self.dst = dst
+        self.args = args
+        for k, v in kwargs.iteritems():
+            setattr(self, k, v)
+
+
+def _resolve_callback(cls, *names):
+    for name in names:
+        f = getattr(cls, name, None)
+        if f is not None:
+            return getattr(f, '__func__', f)
+
+    return None
+
+
+def _event_method(event):
+    def fn(self, *args, **kwargs):
+        return self._fire(event, args, kwargs)
+
+    fn.__name__ = str(event)
+    return fn
+
+
+class StateMachine(object):
+    """Transition map and callbacks of a Fysom class, compiled once.
+
+    Callback lookups that used to be string concatenation plus
+    `hasattr`/`getattr` on every transition are resolved to plain functions
+    here, so instances only carry their current state.
+    """
+
+    def __init__(self, cls, initial, events):
+        self.initial = initial
+        self.map = {}
+
+        if initial:
+            self._add('startup', 'none', initial)
+
+        for event in events:
+            name, src, dst = list(event)[:3]
+            self._add(name, src, dst)
+
+        states = set(['none'])
+        for targets in self.map.itervalues():
+            states.update(s for s in targets if s != WILDCARD)
+            states.update(d for d in targets.itervalues() if d != SAME_DST)
+
+        self.before = dict(
+            (event, _resolve_callback(cls, 'on_before_' + event))
+            for event in self.map)
+        self.after = dict(
+            (event, _resolve_callback(cls, 'on_after_' + event,
+                                      'on_' + event))
+            for event in self.map)
+        self.leave = dict(
+            (state, _resolve_callback(cls, 'on_leave_' + state))
+            for state in states)
+        self.enter = dict(
+            (state, _resolve_callback(cls, 'on_enter_' + state,
+                                      'on_' + state))
+            for state in states)
+        self.reenter = dict(
+            (state, _resolve_callback(cls, 'onreenter' + state,
+                                      'on_reenter_' + state))
+            for state in states)
+        self.change_state = _resolve_callback(cls, 'on_change_state')
+
+    def _add(self, name, src, dst):
+        if isinstance(src, basestring):
+            src = [src]
+
+        targets = self.map.setdefault(name, {})
+        for s in src:
+            targets[s] = dst
+
+    def event_methods(self):
+        return dict((event, _event_method(event)) for event in self.map)
 
 
 class Fysom(fysom.Fysom):
+    """Fysom with transitions compiled once per class.
+
+    Subclasses declare `initial` and `events` as class attributes; passing
+    them to `__init__` still works but builds a machine for that instance
+    alone.
+    """
+
     async_transitions = False
+    initial = None
+    events = None
+
+    # Events that keep the current state and may fire while another
+    # transition is pending, without disturbing it
+    concurrent_events = frozenset()
+
+    _final = None
+
+    def __init__(self, initial=None, events=None):
+        if events is None:
+            machine = self.state_machine()
+        else:
+            machine = StateMachine(type(self), initial, events)
+            self._machine = machine
+            self._map = machine.map
+            for name, fn in machine.event_methods().iteritems():
+                setattr(self, name, fn.__get__(self, type(self)))
 
-    def __init__(self, *args, **kwargs):
-        fysom.Fysom.__init__(self, *args, **kwargs)
         self._current_event = None
+        self.current = 'none'
+        if machine.initial:
+            self.startup()
+
+    @classmethod
+    def state_machine(cls):
+        try:
+            return cls.__dict__['_machine']
+        except KeyError:
+            pass
+
+        machine = StateMachine(cls, cls.initial, cls.events or ())
+        cls._machine = machine
+        cls._map = machine.map
+        for name, fn in machine.event_methods().iteritems():
+            setattr(cls, name, fn)
+
+        return machine
+
+    def _fire(self, event, args, kwargs):
+        pending = hasattr(self, 'transition')
+        if pending and event not in self.concurrent_events:
+            raise FysomError(
+                "event %s inappropriate because previous transition did not "
+                "complete" % event)
+
+        src = self.current
+        targets = self._map[event]
+        dst = targets.get(src) or targets.get(WILDCARD)
+        if not dst:
+            raise FysomError(
+                "event %s inappropriate in current state %s" % (event, src))
+        elif dst == SAME_DST:
+            dst = src
+
+        e = _Event(self, event, src, dst, args, kwargs)
+
+        if pending:
+            if dst != src:
+                raise FysomError(
+                    "event %s cannot change state while another transition "
+                    "is pending" % event)
+
+            current_event = self._current_event
+            try:
+                self._fire_same_state(e)
+            finally:
+                self._current_event = current_event
+
+            return
+
+        if self._before_event(e) is False:
+            raise Canceled(
+                "Cannot trigger event {0} because the onbefore{0} handler "
+                "returns False".format(event))
+
+        if self.current != dst:
+            def _tran():
+                del self.transition
+                self.current = dst
+                self._enter_state(e)
+                self._change_state(e)
+                self._after_event(e)
+
+            self.transition = _tran
+
+            if self._leave_state(e) is not False:
+                self.transition()
+        else:
+            self._reenter_state(e)
+            self._after_event(e)
+
+    def _fire_same_state(self, e):
+        if self._before_event(e) is False:
+            raise Canceled(
+                "Cannot trigger event {0} because the onbefore{0} handler "
+                "returns False".format(e.event))
+
+        self._reenter_state(e)
+        self._after_event(e)
 
     def _before_event(self, e):
-        fnname = 'on_before_' + e.event
-        ret = None
-        if hasattr(self, fnname):
-            ret = getattr(self, fnname)(e)
+        f = self._machine.before[e.event]
+        ret = f(self, e) if f else None
 
         if ret is False:
             if hasattr(e, 'error_callback'):
@@ -26,11 +212,8 @@ class Fysom(fysom.Fysom):
         return ret
 
     def _after_event(self, e):
-        ret = None
-        for fnname in ['on_after_' + e.event, 'on_' + e.event]:
-            if hasattr(self, fnname):
-                ret = getattr(self, fnname)(e)
-                break
+        f = self._machine.after[e.event]
+        ret = f(self, e) if f else None
 
         if hasattr(e, 'callback'):
             e.callback(ret)
@@ -40,10 +223,8 @@ class Fysom(fysom.Fysom):
         return ret
 
     def _leave_state(self, e):
-        fnname = 'on_leave_' + e.src
-        ret = None
-        if hasattr(self, fnname):
-            ret = getattr(self, fnname)(e)
+        f = self._machine.leave[e.src]
+        ret = f(self, e) if f else None
 
         if ret is False:
             return False
@@ -55,14 +236,19 @@ class Fysom(fysom.Fysom):
         return ret
 
     def _enter_state(self, e):
-        for fnname in ['on_enter_' + e.dst, 'on_' + e.dst]:
-            if hasattr(self, fnname):
-                return getattr(self, fnname)(e)
+        f = self._machine.enter[e.dst]
+        if f:
+            return f(self, e)
+
+    def _reenter_state(self, e):
+        f = self._machine.reenter[e.dst]
+        if f:
+            return f(self, e)
 
     def _change_state(self, e):
-        fnname = 'on_change_state'
-        if hasattr(self, fnname):
-            return getattr(self, fnname)(e)
+        f = self._machine.change_state
+        if f:
+            return f(self, e)
 
     def cancel_transition(self):
         if not hasattr(self, 'transition'):
@@ -75,4 +261,3 @@ class Fysom(fysom.Fysom):
                 ev.error_callback()
 
         self._current_event = None
-
@@ -0,0 +1,270 @@
+"""Leveled logging by category, cheap when a level is disabled.
+
+Messages are only formatted once they pass the level check and the
+category's sampling. Records go to a single sink: by default Twisted's log,
+or a `BufferedSink` that hands batches to a writer thread so the reactor
+never waits on the disk or terminal.
+"""
+
+import sys
+import time
+import threading
+import Queue
+
+from twisted.internet import reactor, task
+from twisted.python import log
+
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVELS = {
+    'debug': DEBUG,
+    'info': INFO,
+    'warning': WARNING,
+    'error': ERROR
+}
+
+LEVEL_NAMES = dict((level, name.upper()) for name, level in LEVELS.items())
+
+
+def parse_level(name):
+    try:
+        return LEVELS[name.lower()]
+    except KeyError:
+        raise ValueError("Unknown log level '{0}'".format(name))
+
+
+class TwistedSink(object):
+    """Sends records to `twisted.python.log`"""
+
+    def emit(self, timestamp, level, category, message):
+        log.msg(message, system=category)
+
+
+class BufferedSink(object):
+    """Writes records to a stream from a separate thread.
+
+    The reactor only appends records to a list; every `flush_interval`
+    seconds, or once `batch_size` records are waiting, the list is passed to
+    the writer thread, which formats and writes it in one go. If the writer
+    falls `max_batches` behind, further batches are dropped and counted
+    rather than blocking the reactor.
+    """
+
+    def __init__(self, stream=sys.stderr, flush_interval=0.5,
+                 batch_size=1000, max_batches=100, clock=reactor):
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.clock = clock
+        self.dropped = 0
+
+        self._records = []
+        self._batches = Queue.Queue(max_batches)
+        self._thread = None
+        self._flush_loop = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._write_batches,
+                                        name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+        self._flush_loop = task.LoopingCall(self.flush)
+        self._flush_loop.clock = self.clock
+        self._flush_loop.start(self.flush_interval, now=False)
+
+    def stop(self):
+        if self._flush_loop is not None and self._flush_loop.running:
+            self._flush_loop.stop()
+
+        self.flush()
+        if self._thread is not None:
+            self._batches.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def emit(self, timestamp, level, category, message):
+        self._records.append((timestamp, level, category, message))
+        if len(self._records) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._records:
+            return
+
+        batch, self._records = self._records, []
+        if self._thread is None:
+            self._write(batch)
+            return
+
+        try:
+            self._batches.put_nowait(batch)
+        except Queue.Full:
+            self.dropped += len(batch)
+
+    def _write_batches(self):
+        while True:
+            batch = self._batches.get()
+            if batch is None:
+                return
+
+            try:
+                self._write(batch)
+            except Exception:
+                # Nowhere left to report it
+                pass
+
+    def _write(self, batch):
+        lines = []
+        for timestamp, level, category, message in batch:
+            lines.append('{0}.{1:03d} {2:<7} [{3}] {4}\n'.format(
+                time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)),
+                int(timestamp * 1000) % 1000, LEVEL_NAMES.get(level, level),
+                category, message))
+
+        self.stream.write(''.join(lines))
+        self.stream.flush()
+
+
+_sink = TwistedSink()
+
+
+class Logger(object):
+    """Logger for one category, with its own level and sampling.
+
+    With `sample_every` set to N only one in N records below WARNING that
+    pass the level check is written. Warnings and errors are always written.
+    """
+
+    def __init__(self, category, level=INFO, sample_every=1):
+        self.category = category
+        self.level = level
+        self.sample_every = sample_every
+        self._sample_count = 0
+
+    def enabled(self, level):
+        return level >= self.level
+
+    def bind(self, prefix):
+        return PrefixedLogger(self, prefix)
+
+    def emit(self, level, prefix, fmt, args, kwargs):
+        if self.sample_every > 1 and level < WARNING:
+            self._sample_count += 1
+            if self._sample_count < self.sample_every:
+                return
+            self._sample_count = 0
+
+        message = fmt.format(*args, **kwargs) if args or kwargs else fmt
+        _sink.emit(time.time(), level, self.category, prefix + message)
+
+    def log(self, level, fmt, *args, **kwargs):
+        if level >= self.level:
+            self.emit(level, '', fmt, args, kwargs)
+
+    def debug(self, fmt, *args, **kwargs):
+        if DEBUG >= self.level:
+            self.emit(DEBUG, '', fmt, args, kwargs)
+
+    def info(self, fmt, *args, **kwargs):
+        if INFO >= self.level:
+            self.emit(INFO, '', fmt, args, kwargs)
+
+    def warning(self, fmt, *args, **kwargs):
+        if WARNING >= self.level:
+            self.emit(WARNING, '', fmt, args, kwargs)
+
+    def error(self, fmt, *args, **kwargs):
+        if ERROR >= self.level:
+            self.emit(ERROR, '', fmt, args, kwargs)
+
+
+class PrefixedLogger(object):
+    """A logger whose messages all start with `prefix`, such as a peer"""
+
+    __slots__ = ('logger', 'prefix')
+
+    def __init__(self, logger, prefix):
+        self.logger = logger
+        self.prefix = prefix
+
+    def enabled(self, level):
+        return level >= self.logger.level
+
+    def log(self, level, fmt, *args, **kwargs):
+        if level >= self.logger.level:
+            self.logger.emit(level, self.prefix, fmt, args, kwargs)
+
+    def debug(self, fmt, *args, **kwargs):
+        if DEBUG >= self.logger.level:
+            self.logger.emit(DEBUG, self.prefix, fmt, args, kwargs)
+
+    def info(self, fmt, *args, **kwargs):
+        if INFO >= self.logger.level:
+            self.logger.emit(INFO, self.prefix, fmt, args, kwargs)
+
+    def warning(self, fmt, *args, **kwargs):
+        if WARNING >= self.logger.level:
+            self.logger.emit(WARNING, self.prefix, fmt, args, kwargs)
+
+    def error(self, fmt, *args, **kwargs):
+        if ERROR >= self.logger.level:
+            self.logger.emit(ERROR, self.prefix, fmt, args, kwargs)
+
+
+_loggers = {}
+
+# Settings for categories without their own
+_default_level = INFO
+_default_sample_every = 1
+
+
+def get_logger(category):
+    try:
+        return _loggers[category]
+    except KeyError:
+        logger = _loggers[category] = Logger(category, _default_level,
+                                             _default_sample_every)
+        return logger
+
+
+def set_sink(sink):
+    global _sink
+    _sink = sink
+
+
+def configure(levels=None, sampling=None, sink=None):
+    """Set levels and sampling by category name, '*' for every category.
+
+    Settings for '*' also apply to categories created later, unless they
+    have their own.
+    """
+
+    global _default_level, _default_sample_every
+
+    levels = dict(levels or {})
+    sampling = dict((name, max(1, every))
+                    for name, every in (sampling or {}).iteritems())
+
+    if '*' in levels:
+        _default_level = levels.pop('*')
+        for logger in _loggers.values():
+            logger.level = _default_level
+
+    if '*' in sampling:
+        _default_sample_every = sampling.pop('*')
+        for logger in _loggers.values():
+            logger.sample_every = _default_sample_every
+
+    for name, level in levels.iteritems():
+        get_logger(name).level = level
+
+    for name, every in sampling.iteritems():
+        get_logger(name).sample_every = every
+
+    if sink is not None:
+        set_sink(sink)
@@ -0,0 +1,221 @@
+"""In-process counters, gauges and histograms.
+
+Recording is a dict update (plus a bisect for histograms), so it can sit on
+the hot path. Values are keyed by a tuple of label values, or None when a
+metric has no labels, and rendered on demand in the Prometheus text format
+or as a JSON-friendly snapshot.
+"""
+
+from bisect import bisect_left
+from collections import defaultdict
+
+from twisted.web import resource
+
+
+class Metric(object):
+    kind = 'untyped'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+
+    def items(self):
+        return self.values.items()
+
+    def label_pairs(self, key):
+        if key is None:
+            return []
+        if not isinstance(key, tuple):
+            key = (key, )
+
+        return zip(self.labels, key)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super(Counter, self).__init__(name, help, labels)
+        self.values = defaultdict(int)
+
+    def inc(self, key=None, amount=1):
+        self.values[key] += amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super(Gauge, self).__init__(name, help, labels)
+        self.values = defaultdict(int)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def inc(self, key=None, amount=1):
+        self.values[key] += amount
+
+    def dec(self, key=None, amount=1):
+        self.values[key] -= amount
+
+
+class Histogram(Metric):
+    """Bucketed observations; each value holds the per-bucket counts, with
+    an overflow bucket, followed by the sum of everything observed"""
+
+    kind = 'histogram'
+
+    # Seconds, from a tenth of a millisecond to ten seconds
+    DEFAULT_BOUNDS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                      0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name, help, labels=(), bounds=DEFAULT_BOUNDS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.bounds = tuple(bounds)
+
+    def observe(self, key, value):
+        try:
+            counts = self.values[key]
+        except KeyError:
+            counts = self.values[key] = [0] * (len(self.bounds) + 1) + [0.0]
+
+        counts[bisect_left(self.bounds, value)] += 1
+        counts[-1] += value
+
+
+class CallbackMetric(Metric):
+    """Metric read from `fn` when collected; `fn` returns a single value or
+    a dict of values by key"""
+
+    def __init__(self, name, help, fn, kind='gauge', labels=()):
+        super(CallbackMetric, self).__init__(name, help, labels)
+        self.kind = kind
+        self.fn = fn
+
+    def items(self):
+        values = self.fn()
+        if isinstance(values, dict):
+            return values.items()
+
+        return [(None, values)]
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+
+    return '{' + ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\')
+                                           .replace('"', '\\"')
+                                           .replace('\n', '\\n'))
+        for name, value in pairs) + '}'
+
+
+def _format_number(value):
+    if isinstance(value, float):
+        return repr(value)
+
+    return str(value)
+
+
+class Registry(object):
+    def __init__(self, prefix='communic8_'):
+        self.prefix = prefix
+        self.metrics = {}
+
+    def register(self, metric):
+        # Registering again returns the existing metric, so independent
+        # modules can share one
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.register(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), bounds=Histogram.DEFAULT_BOUNDS):
+        return self.register(Histogram(name, help, labels, bounds))
+
+    def callback(self, name, help, fn, kind='gauge', labels=()):
+        # Callbacks usually close over an object, the newest one wins
+        metric = self.metrics[name] = CallbackMetric(name, help, fn, kind,
+                                                     labels)
+        return metric
+
+    def render_prometheus(self):
+        lines = []
+        for name, metric in sorted(self.metrics.iteritems()):
+            full_name = self.prefix + name
+            lines.append('# HELP {0} {1}'.format(full_name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(full_name, metric.kind))
+
+            for key, value in sorted(metric.items()):
+                pairs = metric.label_pairs(key)
+                if metric.kind != 'histogram':
+                    lines.append('{0}{1} {2}'.format(
+                        full_name, _format_labels(pairs),
+                        _format_number(value)))
+                    continue
+
+                cumulative = 0
+                for bound, count in zip(metric.bounds + ('+Inf', ), value):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        full_name,
+                        _format_labels(pairs + [('le', bound)]),
+                        cumulative))
+
+                lines.append('{0}_sum{1} {2}'.format(
+                    full_name, _format_labels(pairs), repr(value[-1])))
+                lines.append('{0}_count{1} {2}'.format(
+                    full_name, _format_labels(pairs), cumulative))
+
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """Current values by metric name, keyed by comma-joined labels"""
+
+        snapshot = {}
+        for name, metric in self.metrics.iteritems():
+            values = {}
+            for key, value in metric.items():
+                if key is None:
+                    label = ''
+                elif isinstance(key, tuple):
+                    label = ','.join(map(str, key))
+                else:
+                    label = str(key)
+
+                if metric.kind == 'histogram':
+                    value = {'count': sum(value[:-1]), 'sum': value[-1],
+                             'buckets': dict(zip(map(str, metric.bounds) +
+                                                 ['+Inf'], value[:-1]))}
+
+                values[label] = value
+
+            if values.keys() == ['']:
+                values = values['']
+
+            snapshot[name] = values
+
+        return snapshot
+
+
+class MetricsResource(resource.Resource):
+    """Serves a registry in the Prometheus text format"""
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        request.setHeader('Content-Type', 'text/plain; version=0.0.4')
+        return self.registry.render_prometheus()
+
+
+registry = Registry()
@@ -0,0 +1,128 @@
+import math
+
+from twisted.internet import reactor, task
+from twisted.python import log
+
+
+class Timer(object):
+    """Handle of a call scheduled on a `TimerWheel`"""
+
+    __slots__ = ('wheel', 'tick', 'when', 'f', 'args', 'kwargs', 'cancelled',
+                 'called')
+
+    def __init__(self, wheel, tick, when, f, args, kwargs):
+        self.wheel = wheel
+        self.tick = tick
+        self.when = when
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.called = False
+
+    def active(self):
+        return not (self.cancelled or self.called)
+
+    def cancel(self):
+        if self.active():
+            self.cancelled = True
+            self.wheel._remove(self)
+
+
+class TimerWheel(object):
+    """Hashed timing wheel for large numbers of coarse deadlines.
+
+    Deadlines are rounded up to the next tick of `resolution` seconds and
+    kept in slot `tick % size`, which maps each tick to its timers, so
+    deadlines more than one turn ahead share a slot without being looked at.
+    Scheduling and cancelling are O(1) and every tick only touches the
+    timers expiring on it. A single looping call drives the wheel, and only
+    while it has timers.
+    """
+
+    def __init__(self, resolution=1.0, size=512, clock=reactor):
+        self.resolution = resolution
+        self.clock = clock
+        self.slots = [{} for _ in xrange(size)]
+        self.tick = self._current_tick()
+        self.pending = 0
+        self._loop = None
+
+    def _current_tick(self):
+        return int(self.clock.seconds() // self.resolution)
+
+    def call_at(self, when, f, *args, **kwargs):
+        if self._loop is None:
+            # Nothing was pending, so no tick since the last one was missed
+            self.tick = self._current_tick()
+            self._loop = task.LoopingCall(self.advance)
+            self._loop.clock = self.clock
+            self._loop.start(self.resolution, now=False)
+
+        tick = max(int(math.ceil(when / self.resolution)), self.tick + 1)
+        timer = Timer(self, tick, when, f, args, kwargs)
+        self.slots[tick % len(self.slots)].setdefault(tick, set()).add(timer)
+        self.pending += 1
+        return timer
+
+    def call_later(self, delay, f, *args, **kwargs):
+        return self.call_at(self.clock.seconds() + delay, f, *args, **kwargs)
+
+    def _remove(self, timer):
+        slot = self.slots[timer.tick % len(self.slots)]
+        timers = slot.get(timer.tick)
+        if not timers or timer not in timers:
+            # Already taken out by the tick that is firing it
+            return
+
+        timers.discard(timer)
+        if not timers:
+            del slot[timer.tick]
+
+        self.pending -= 1
+        if not self.pending:
+            self._stop()
+
+    def _stop(self):
+        if self._loop is not None:
+            if self._loop.running:
+                self._loop.stop()
+            self._loop = None
+
+    def advance(self):
+        """Fire every timer due up to the current time"""
+
+        now_tick = self._current_tick()
+        while self.tick < now_tick:
+            self.tick += 1
+            timers = self.slots[self.tick % len(self.slots)].pop(self.tick,
+                                                                None)
+            if not timers:
+                continue
+
+            self.pending -= len(timers)
+            for timer in timers:
+                if timer.cancelled:
+                    continue
+
+                timer.called = True
+                try:
+                    timer.f(*timer.args, **timer.kwargs)
+                except Exception:
+                    log.err(None, "Error in timer callback")
+
+        if not self.pending:
+            self._stop()
+
+
+_shared_wheels = {}
+
+
+def shared_wheel(clock=reactor):
+    """The wheel shared by every coarse timeout running on `clock`"""
+
+    try:
+        return _shared_wheels[clock]
+    except KeyError:
+        wheel = _shared_wheels[clock] = TimerWheel(clock=clock)
+        return wheel
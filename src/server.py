@@ -1,17 +1,177 @@
+import os
 import sys
+import shutil
+import argparse
+import tempfile
 
-from twisted.internet import reactor
+from twisted.internet import reactor, protocol
 from twisted.python import log
-from communic8.protocol import server
+from twisted.web import server as web_server
+from communic8.protocol import server, cluster
+from communic8.util import logger, metrics
 
 
-def main():
-    log.startLogging(sys.stderr)
+def serve_metrics(port):
+    site = web_server.Site(metrics.MetricsResource(metrics.registry))
+    site.noisy = False
+    reactor.listenTCP(port, site, interface='127.0.0.1')
+
 
-    tcp_factory = server.Factory()
+def run_single(args):
+    tcp_factory = server.Factory(idle_timeout=args.idle_timeout)
     udp_factory = server.FactoryUDP()
-    reactor.listenTCP(8125, tcp_factory)
-    reactor.listenUDP(8125,udp_factory)
+    reactor.listenTCP(args.port, tcp_factory)
+    reactor.listenUDP(args.port, udp_factory)
+
+
+class WorkerProcess(protocol.ProcessProtocol):
+    def __init__(self, number):
+        self.number = number
+
+    def processEnded(self, reason):
+        log.msg("Worker {0} exited: {1}".format(self.number,
+                                                reason.getErrorMessage()))
+
+
+def run_coordinator(args):
+    if args.coordinator:
+        socket_path = args.coordinator
+    else:
+        socket_dir = tempfile.mkdtemp(prefix='communic8-')
+        socket_path = os.path.join(socket_dir, 'coordinator.sock')
+        reactor.addSystemEventTrigger('after', 'shutdown', shutil.rmtree,
+                                      socket_dir, ignore_errors=True)
+
+    reactor.listenUNIX(socket_path, cluster.CoordinatorFactory())
+
+    worker_args = [sys.executable, os.path.abspath(__file__), '--worker',
+                   '--coordinator', socket_path, '--port', str(args.port),
+                   '--idle-timeout', str(args.idle_timeout)]
+    for level in args.log_level:
+        worker_args += ['--log-level', level]
+    for sample in args.log_sample:
+        worker_args += ['--log-sample', sample]
+    if args.log_file:
+        worker_args += ['--log-file', args.log_file]
+    child_fds = {0: 'w', 1: 1, 2: 2}
+
+    if not hasattr(cluster.socket, 'SO_REUSEPORT'):
+        listening = cluster.shared_listening_socket(args.port)
+        worker_args += ['--listen-fd', str(listening.fileno())]
+        child_fds[listening.fileno()] = listening.fileno()
+
+        # Datagrams cannot be balanced between the workers, so they are all
+        # handled here
+        reactor.listenUDP(args.port, server.FactoryUDP())
+
+    processes = []
+    for n in range(args.workers):
+        # Each worker serves its own metrics on the following ports
+        metrics_args = []
+        if args.metrics_port:
+            metrics_args = ['--metrics-port', str(args.metrics_port + n + 1)]
+
+        processes.append(reactor.spawnProcess(
+            WorkerProcess(n), sys.executable, worker_args + metrics_args,
+            env=os.environ, childFDs=child_fds))
+
+    def stop_workers():
+        for process in processes:
+            if process.pid is not None:
+                process.signalProcess('TERM')
+
+    reactor.addSystemEventTrigger('before', 'shutdown', stop_workers)
+
+
+def run_worker(args):
+    tcp_factory = server.Factory(idle_timeout=args.idle_timeout)
+    link_factory = cluster.WorkerFactory(tcp_factory)
+    reactor.connectUNIX(args.coordinator, link_factory)
+
+    def on_ready(_):
+        cluster.listen_shared(args.port, tcp_factory, fd=args.listen_fd)
+        if args.listen_fd is None:
+            cluster.listen_shared_udp(args.port, server.FactoryUDP())
+        log.msg("Worker {0} accepting connections".format(os.getpid()))
+
+    def on_failure(failure):
+        log.err(failure, "Could not connect to the coordinator")
+        reactor.stop()
+
+    link_factory.ready.addCallbacks(on_ready, on_failure)
+
+
+def category_settings(settings, parse_value):
+    parsed = {}
+    for setting in settings:
+        category, _, value = setting.rpartition('=')
+        parsed[category or '*'] = parse_value(value)
+
+    return parsed
+
+
+def setup_logging(args):
+    levels = category_settings(args.log_level, logger.parse_level)
+    sampling = category_settings(args.log_sample, int)
+
+    log.startLogging(sys.stderr)
+
+    stream = open(args.log_file, 'a') if args.log_file else sys.stderr
+    sink = logger.BufferedSink(stream)
+    sink.start()
+    reactor.addSystemEventTrigger('after', 'shutdown', sink.stop)
+
+    logger.configure(levels=levels, sampling=sampling, sink=sink)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8125)
+    parser.add_argument('--workers', type=int, default=0,
+                        help="Number of worker processes, 0 to serve from "
+                             "this process alone")
+    parser.add_argument('--idle-timeout', type=int,
+                        default=server.Factory.idle_timeout, metavar='SECONDS',
+                        help="Disconnect users that send nothing for this "
+                             "long, 0 to never disconnect them")
+    parser.add_argument('--log-level', action='append', default=[],
+                        metavar='[CATEGORY=]LEVEL',
+                        help="Log level (debug, info, warning or error) for "
+                             "a category such as protocol, traffic, server "
+                             "or cluster, or for all of them. traffic=debug "
+                             "logs every message and response")
+    parser.add_argument('--log-sample', action='append', default=[],
+                        metavar='[CATEGORY=]N',
+                        help="Only log one in N debug and info records of "
+                             "a category")
+    parser.add_argument('--log-file', metavar='PATH',
+                        help="Append log records to a file instead of "
+                             "standard error")
+    parser.add_argument('--metrics-port', type=int, metavar='PORT',
+                        help="Serve metrics in the Prometheus text format "
+                             "on this port of the loopback interface")
+    parser.add_argument('--coordinator', metavar='PATH',
+                        help="Unix socket of the worker coordinator")
+    parser.add_argument('--worker', action='store_true',
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--listen-fd', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    try:
+        setup_logging(args)
+    except (ValueError, IOError) as e:
+        parser.error(str(e))
+
+    if args.metrics_port:
+        serve_metrics(args.metrics_port)
+
+    if args.worker:
+        run_worker(args)
+    elif args.workers > 0:
+        run_coordinator(args)
+    else:
+        run_single(args)
+
     reactor.run()
 
 if __name__ == '__main__':